@@ -0,0 +1,310 @@
+"""
+Benchmark the stages on a synthetic dump (see 'generate_dump'), or on a given dump.
+The stages run one after another in a working directory, each in a fresh process with a single worker:
+
+    extract_special_predicates -> prune_triples -> create_unique_predicates -> resolve_qualifiers
+    -> prune_duplicate_lines
+
+Per stage, the time, the throughput (input lines and bytes per second) and the peak RSS of its process are measured,
+and its outputs are fingerprinted (SHA-1 of their contents). The results can be stored as a baseline (JSON),
+against which later runs on the same dump are compared: relative change of throughput and peak RSS,
+and whether the outputs are identical. With --drop-caches, the page cache is dropped before each stage,
+such that the stages read from the storage (e.g. to measure the read-ahead of 'stream_io' on slow storage).
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dump_io import fingerprint_file, get_dump_size, get_shard_paths, iter_line_batches, write_manifest
+from extract_special_predicates import (
+    extract_predicate_types,
+    get_catalog_path,
+    load_special_predicates,
+    store_predicate_catalog,
+)
+from filter_wikidata import PATH_TO_OUTPUT_DIR, PATH_TO_RUNS_DIR, init_worker, load_filter_config, prune_triples
+from generate_dump import PRESETS, generate_dump
+from metrics import get_peak_rss
+from resolve_qualifiers import (
+    PATH_TO_INPUT_DIR,
+    PATH_TO_INTERMEDIATE_NODES,
+    PATH_TO_OUTPUT_FILE,
+    PATH_TO_QUALIFIER_DUMP,
+    PATH_TO_QUALIFIER_TRIPLES,
+    PATH_TO_UNIQUE_PREDICATES_DUMP,
+    create_unique_predicates,
+    prune_duplicate_lines,
+    resolve_qualifiers,
+)
+from stream_io import add_io_arguments, configure_io_from_args
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+STAGES = [
+    "extract_special_predicates",
+    "prune_triples",
+    "create_unique_predicates",
+    "resolve_qualifiers",
+    "prune_duplicate_lines",
+]
+DIRECTORIES = ["dicts", PATH_TO_RUNS_DIR, PATH_TO_OUTPUT_DIR, "tmp_dumps"]
+# relative change of throughput or peak RSS that is reported as a regression
+DEFAULT_TOLERANCE = 0.1
+HASH_BLOCK_SIZE = 1 << 20
+DROP_CACHES_PATH = "/proc/sys/vm/drop_caches"
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def extract_catalog(dump_path):
+    predicate_types = extract_predicate_types(dump_path, 0, get_dump_size(dump_path))
+    catalog_path = get_catalog_path(dump_path)
+    store_predicate_catalog(predicate_types, catalog_path)
+    return [catalog_path]
+
+
+def filter_dump(dump_path):
+    ext_id_predicates, geo_predicates = load_special_predicates(dump_path)
+    init_worker({p.encode("utf-8") for p in ext_id_predicates}, {p.encode("utf-8") for p in geo_predicates})
+    for name in os.listdir(PATH_TO_RUNS_DIR):
+        os.remove(os.path.join(PATH_TO_RUNS_DIR, name))
+    result = prune_triples(dump_path, 0, get_dump_size(dump_path), 0, load_filter_config())
+    write_manifest(PATH_TO_OUTPUT_DIR, [result["shard"]])
+    run_paths = sorted(os.path.join(PATH_TO_RUNS_DIR, name) for name in os.listdir(PATH_TO_RUNS_DIR))
+    return get_shard_paths(PATH_TO_OUTPUT_DIR) + run_paths
+
+
+def run_unique_predicates(dump_path):
+    create_unique_predicates()
+    return [PATH_TO_UNIQUE_PREDICATES_DUMP, PATH_TO_INTERMEDIATE_NODES]
+
+
+def run_resolve_qualifiers(dump_path):
+    resolve_qualifiers()
+    return [PATH_TO_QUALIFIER_DUMP, PATH_TO_QUALIFIER_TRIPLES]
+
+
+def run_prune_duplicate_lines(dump_path):
+    prune_duplicate_lines()
+    return [PATH_TO_OUTPUT_FILE]
+
+
+STAGE_FUNCTIONS = {
+    "extract_special_predicates": extract_catalog,
+    "prune_triples": filter_dump,
+    "create_unique_predicates": run_unique_predicates,
+    "resolve_qualifiers": run_resolve_qualifiers,
+    "prune_duplicate_lines": run_prune_duplicate_lines,
+}
+
+
+def get_stage_inputs(stage, dump_path):
+    """
+    Get the input files of the stage (available once the previous stages ran).
+    Return: list of str
+    """
+    if stage in ("extract_special_predicates", "prune_triples"):
+        return [dump_path]
+    if stage == "create_unique_predicates":
+        return get_shard_paths(PATH_TO_INPUT_DIR)
+    if stage == "resolve_qualifiers":
+        return [PATH_TO_UNIQUE_PREDICATES_DUMP]
+    return [PATH_TO_QUALIFIER_DUMP]
+
+
+def count_lines(paths):
+    """
+    Count the lines and (uncompressed) bytes of the files.
+    Return: (int, int)
+    """
+    lines = 0
+    size = 0
+    for path in paths:
+        for batch in iter_line_batches(path):
+            lines += len(batch)
+            size += sum(map(len, batch)) + len(batch)
+    return lines, size
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_stage(stage, dump_path):
+    """
+    Run the stage (in a fresh worker process), and fingerprint its outputs.
+    Return: (seconds, peak RSS in bytes, dict of output path -> SHA-1)
+    """
+    start_time = time.perf_counter()
+    output_paths = STAGE_FUNCTIONS[stage](dump_path)
+    seconds = time.perf_counter() - start_time
+    return seconds, get_peak_rss(), {path: hash_file(path) for path in output_paths}
+
+
+def drop_caches():
+    """
+    Write back dirty pages, and drop the page cache (Linux, requires root).
+    Return: None
+    """
+    os.sync()
+    with open(DROP_CACHES_PATH, "w") as fp:
+        fp.write("1\n")
+
+
+def run_benchmark(dump_path, repeat=1, cold=False):
+    """
+    Run all stages on the dump in the current directory (each stage repeat times, keeping the fastest run),
+    optionally with a cold page cache.
+    Return: dict (stage -> results)
+    """
+    for directory in DIRECTORIES:
+        os.makedirs(directory, exist_ok=True)
+    # spawned processes start without the memory of this process, such that their peak RSS is the one of the stage
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for stage in STAGES:
+        lines, size = count_lines(get_stage_inputs(stage, dump_path))
+        runs = list()
+        for _ in range(repeat):
+            if cold:
+                drop_caches()
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                runs.append(executor.submit(run_stage, stage, dump_path).result())
+        seconds = min(run[0] for run in runs)
+        results[stage] = {
+            "seconds": round(seconds, 3),
+            "lines": lines,
+            "bytes": size,
+            "lines_per_second": round(lines / seconds, 1),
+            "bytes_per_second": round(size / seconds, 1),
+            "peak_rss_bytes": max(run[1] for run in runs),
+            "outputs": runs[-1][2],
+        }
+        print_stage(stage, results[stage])
+    return results
+
+
+def print_stage(stage, result):
+    throughput = str(int(result["lines_per_second"])) + " lines/s, " + str(round(result["bytes_per_second"] / 1e6, 1))
+    memory = str(round(result["peak_rss_bytes"] / 2**20, 1)) + " MB peak RSS"
+    print(stage + ": " + str(result["seconds"]) + "s, " + throughput + " MB/s, " + memory)
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the results of the stages against the baseline, and print the comparison.
+    Return: (whether all outputs are identical, whether any stage regressed beyond the tolerance)
+    """
+    identical = True
+    regressed = False
+    for stage, result in results.items():
+        if not stage in baseline:
+            print(stage + ": not in baseline")
+            continue
+        reference = baseline[stage]
+        speedup = result["lines_per_second"] / reference["lines_per_second"] - 1
+        memory = result["peak_rss_bytes"] / reference["peak_rss_bytes"] - 1
+        same_outputs = result["outputs"] == reference["outputs"]
+        identical = identical and same_outputs
+        stage_regressed = speedup < -tolerance or memory > tolerance
+        regressed = regressed or stage_regressed
+        comparison = "throughput %+.1f%%, peak RSS %+.1f%%" % (100 * speedup, 100 * memory)
+        outputs = "outputs identical" if same_outputs else "OUTPUTS DIFFER"
+        print(stage + ": " + comparison + ", " + outputs + (" (REGRESSION)" if stage_regressed else ""))
+        for path in sorted(set(result["outputs"]) | set(reference["outputs"])):
+            if result["outputs"].get(path) != reference["outputs"].get(path):
+                print("    differs: " + path)
+    return identical, regressed
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dump", help="path of the dump to benchmark on (by default, a synthetic dump is generated)")
+    parser.add_argument("--entities", type=int, default=20000, help="number of entities of the synthetic dump")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic dump")
+    parser.add_argument("--skew", type=float, default=1.0, help="skew of the synthetic dump (see generate_dump.py)")
+    parser.add_argument(
+        "--preset",
+        choices=sorted(PRESETS),
+        help="shape of the synthetic dump (see generate_dump.py), e.g. hub: few entities with thousands of statements",
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="directory for the dump and the outputs of the stages (by default, a temporary directory is removed)",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the fastest run counts")
+    parser.add_argument("--baseline", help="path of a baseline (JSON) to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="relative loss of throughput (or growth of peak RSS) reported as a regression",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with an error on regressions (differing outputs are always an error)",
+    )
+    parser.add_argument(
+        "--drop-caches",
+        action="store_true",
+        help="drop the page cache before each stage (Linux, requires root), such that inputs are read from storage",
+    )
+    add_io_arguments(parser)
+    args = parser.parse_args()
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline requires --baseline")
+    if args.drop_caches and not os.access(DROP_CACHES_PATH, os.W_OK):
+        parser.error("--drop-caches requires write access to " + DROP_CACHES_PATH)
+    configure_io_from_args(args)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wikidata_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    if args.dump:
+        dump_path = os.path.abspath(args.dump)
+        dump = {"name": os.path.basename(dump_path), "fingerprint": fingerprint_file(dump_path)}
+    os.chdir(work_dir)
+    if not args.dump:
+        dump_path = os.path.abspath("dump.nt")
+        settings = {"entities": args.entities, "skew": args.skew}
+        settings.update(PRESETS.get(args.preset, {}))
+        dump = dict(settings, seed=args.seed)
+        if args.preset:
+            dump["preset"] = args.preset
+        generate_dump(dump_path, seed=args.seed, **settings)
+    try:
+        results = run_benchmark(dump_path, args.repeat, args.drop_caches)
+    finally:
+        if not args.work_dir:
+            os.chdir(os.path.dirname(work_dir))
+            shutil.rmtree(work_dir)
+    if args.save_baseline:
+        with open(baseline_path, "w") as fp:
+            json.dump({"dump": dump, "stages": results}, fp, indent=2)
+        print("Stored baseline: " + baseline_path)
+    elif baseline_path:
+        with open(baseline_path, "r") as fp:
+            baseline = json.load(fp)
+        if baseline["dump"] != dump:
+            sys.exit("The baseline was measured on another dump: " + json.dumps(baseline["dump"]))
+        identical, regressed = compare_results(results, baseline["stages"], args.tolerance)
+        if not identical or (regressed and args.fail_on_regression):
+            sys.exit(1)
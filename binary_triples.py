@@ -0,0 +1,196 @@
+"""
+Compact binary format for the triples passed between pipeline stages
+(shards of the filtered dump, intermediate dumps of resolve_qualifiers.py).
+Triples consist of normalized terms (see 'resolve_qualifiers.parse_triple'), e.g. (Q42, P31-7, Q5-12).
+
+Terms are split into a base and an integer counter (the '-N' suffix of fact-specific predicates and types),
+and bases (IDs, statement nodes, literals) are interned in a string heap per block: term ids are indices
+into the heap of their block, not global IDs (Q42 is stored as a string, not as the number 42).
+A file consists of a header, followed by independent blocks, such that files can be streamed block by block,
+and blocks can be counted or skipped by their headers without decompressing them (see 'iter_block_headers').
+The payload of a block is zlib-compressed and decoded as a whole, so there is no random access within a block:
+
+File:    magic
+Block:   number of triples | size of payload | payload (zlib-compressed)
+Payload: term ids (uint32, 3 per triple) | counters (uint64, 3 per triple, 0 = no counter) | heap
+Heap:    interned terms, separated by newlines (terms of n-triples cannot contain newlines)
+"""
+
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from stream_io import WriteBehind, iter_ahead
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+MAGIC = b"WDTRIP01"
+BLOCK_HEADER = struct.Struct("<IQ")
+BLOCK_TRIPLES = 1 << 16
+COMPRESSION_LEVEL = 1
+EXTENSION = ".wdt"
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def is_binary_path(path):
+    return path.endswith(EXTENSION)
+
+
+def split_counter(term):
+    """
+    Split the term into base and counter, if the term ends with '-N' (N without leading zeros).
+    Return: (base, counter + 1), or (term, 0) if the term has no counter
+    """
+    base, _, counter = term.rpartition(b"-")
+    if base and counter.isdigit() and len(counter) < 19 and (len(counter) == 1 or not counter.startswith(b"0")):
+        return base, int(counter) + 1
+    return term, 0
+
+
+def encode_block(triples):
+    """
+    Encode the triples as a block.
+    Return: bytes
+    """
+    heap = dict()
+    term_ids = array("I")
+    counters = array("Q")
+    for triple in triples:
+        for term in triple:
+            # inlined 'split_counter'
+            base, _, counter = term.rpartition(b"-")
+            if base and counter.isdigit() and len(counter) < 19 and (len(counter) == 1 or counter[0] != 48):
+                term = base
+                counter = int(counter) + 1
+            else:
+                counter = 0
+            term_id = heap.get(term)
+            if term_id is None:
+                term_id = heap[term] = len(heap)
+            term_ids.append(term_id)
+            counters.append(counter)
+    if sys.byteorder == "big":
+        term_ids.byteswap()
+        counters.byteswap()
+    payload = zlib.compress(term_ids.tobytes() + counters.tobytes() + b"\n".join(heap), COMPRESSION_LEVEL)
+    return BLOCK_HEADER.pack(len(triples), len(payload)) + payload
+
+
+def decode_block(number_of_triples, payload):
+    """
+    Decode the payload of a block with the given number of triples.
+    Return: list of (s, p, o)
+    """
+    data = zlib.decompress(payload)
+    counters_offset = 12 * number_of_triples
+    heap_offset = 36 * number_of_triples
+    term_ids = array("I")
+    term_ids.frombytes(data[:counters_offset])
+    counters = array("Q")
+    counters.frombytes(data[counters_offset:heap_offset])
+    if sys.byteorder == "big":
+        term_ids.byteswap()
+        counters.byteswap()
+    heap = data[heap_offset:].split(b"\n")
+    terms = [
+        heap[term_id] + b"-" + str(counter - 1).encode() if counter else heap[term_id]
+        for term_id, counter in zip(term_ids, counters)
+    ]
+    return list(zip(terms[0::3], terms[1::3], terms[2::3]))
+
+
+def iter_block_headers(fp):
+    """
+    Iterate over the block headers of the binary triples file, skipping the payloads.
+    Return: generator of (number of triples, size of payload)
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary triples file: " + fp.name)
+    while True:
+        header = fp.read(BLOCK_HEADER.size)
+        if not header:
+            break
+        number_of_triples, payload_size = BLOCK_HEADER.unpack(header)
+        yield number_of_triples, payload_size
+        fp.seek(payload_size, os.SEEK_CUR)
+
+
+def count_triples(path):
+    with open(path, "rb") as fp:
+        return sum(number_of_triples for number_of_triples, _ in iter_block_headers(fp))
+
+
+def read_blocks(path):
+    """
+    Read the (compressed) blocks of the binary triples file.
+    Return: generator of (number of triples, payload)
+    """
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a binary triples file: " + path)
+        header = fp.read(BLOCK_HEADER.size)
+        while header:
+            number_of_triples, payload_size = BLOCK_HEADER.unpack(header)
+            yield number_of_triples, fp.read(payload_size)
+            header = fp.read(BLOCK_HEADER.size)
+
+
+def iter_triple_blocks(path):
+    """
+    Iterate over the blocks of the binary triples file, read ahead of the consumer (see 'stream_io.iter_ahead').
+    Return: generator of lists of (s, p, o)
+    """
+    for number_of_triples, payload in iter_ahead(read_blocks(path)):
+        yield decode_block(number_of_triples, payload)
+
+
+class TripleWriter:
+    """
+    Write triples to a binary triples file, block by block.
+    """
+
+    def __init__(self, path, block_triples=BLOCK_TRIPLES):
+        self.fp = WriteBehind(open(path, "wb"))
+        self.block_triples = block_triples
+        self.triples = list()
+        self.written_triples = 0
+        # size and crc32 checksum of the file
+        self.size = 0
+        self.checksum = 0
+        self.write_data(MAGIC)
+
+    def write_data(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def write(self, triples):
+        """
+        Write the given list of (s, p, o).
+        Return: None
+        """
+        self.triples.extend(triples)
+        while len(self.triples) >= self.block_triples:
+            self.flush(self.triples[: self.block_triples])
+            self.triples = self.triples[self.block_triples :]
+
+    def flush(self, triples):
+        if triples:
+            self.write_data(encode_block(triples))
+            self.written_triples += len(triples)
+
+    def close(self):
+        self.flush(self.triples)
+        self.triples = list()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,111 @@
+"""
+Checkpoints of the pipeline stages.
+Each stage records its committed progress (e.g. the processed chunks of the dump, or the resolved partitions)
+in a small JSON file, which is replaced atomically after each step. The checkpoint is keyed by the
+content fingerprints of the inputs of the stage and the parameters affecting its output:
+a rerun with the same key continues after the last committed step, a rerun with a different key starts over.
+When a stage is finished, the fingerprints of its outputs are recorded, so that the stage is
+skipped as long as neither its inputs nor its outputs have changed.
+"""
+
+import hashlib
+import json
+import os
+
+from dump_io import fingerprint_file
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+PATH_TO_CHECKPOINTS_DIR = "checkpoints"
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def get_stage_key(input_paths, parameters):
+    """
+    Compute the key of a stage from the content fingerprints of its input files (see 'dump_io.fingerprint_file')
+    and the parameters affecting its output (JSON-serializable).
+    Return: str
+    """
+    fingerprints = {path: fingerprint_file(path) for path in input_paths}
+    data = json.dumps({"inputs": fingerprints, "parameters": parameters}, sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def fingerprint_outputs(output_paths):
+    """
+    Compute the content fingerprints of the output files (None for missing files).
+    Return: dict (path -> fingerprint)
+    """
+    return {path: fingerprint_file(path) if os.path.exists(path) else None for path in output_paths}
+
+
+def remove_checkpoint(stage, directory=PATH_TO_CHECKPOINTS_DIR):
+    path = os.path.join(directory, stage + ".json")
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class Checkpoint:
+    """
+    Committed progress of a stage: completed steps (with a JSON-serializable value each),
+    stored in checkpoints/<stage>.json.
+    """
+
+    def __init__(self, stage, key, restart=False, directory=PATH_TO_CHECKPOINTS_DIR):
+        self.path = os.path.join(directory, stage + ".json")
+        self.key = key
+        self.state = {"key": key, "steps": {}, "outputs": None}
+        if not restart and os.path.exists(self.path):
+            with open(self.path, "r") as fp:
+                state = json.load(fp)
+            if state["key"] == key:
+                self.state = state
+        os.makedirs(directory, exist_ok=True)
+
+    def is_finished(self, output_paths):
+        """
+        Check whether the stage was finished with the same key, and its outputs are unchanged.
+        If the outputs have changed since (or are requested differently), the stage starts over.
+        Return: bool
+        """
+        outputs = self.state["outputs"]
+        if outputs is None:
+            return False
+        if outputs == fingerprint_outputs(output_paths):
+            return True
+        self.reset()
+        return False
+
+    def reset(self):
+        self.state = {"key": self.key, "steps": {}, "outputs": None}
+        self.save()
+
+    def get(self, step, default=None):
+        return self.state["steps"].get(step, default)
+
+    def is_done(self, step):
+        return step in self.state["steps"]
+
+    def commit(self, step, value=True):
+        """
+        Record the step (with its value) as done.
+        Return: None
+        """
+        self.state["steps"][step] = value
+        self.save()
+
+    def finish(self, output_paths):
+        """
+        Record the stage as finished, with the fingerprints of its outputs.
+        Return: None
+        """
+        self.state["outputs"] = fingerprint_outputs(output_paths)
+        self.save()
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as fp:
+            json.dump(self.state, fp)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,287 @@
+"""
+Columnar export of the resolved dump (in the style of Parquet/Arrow).
+Rows are stored in row groups. Within a row group, each column is stored (and compressed) separately,
+such that consumers only need to read the columns they need. Row groups can be skipped by
+their statistics (e.g. the predicates they contain).
+
+Columns:
+    subject, predicate, object:     dictionary-encoded term bases (per row group)
+    subject_counter, predicate_counter, object_counter:
+                                    counters of the fact-specific terms (N + 1 for the suffix '-N', 0 = no counter)
+    literal:                        literal objects (in row order); the object column marks literal rows
+
+File: magic | row groups | footer (JSON: columns, row groups with column offsets and statistics) | footer size | magic
+
+Run 'python columnar.py <columnar_path> <csv_path>' to convert an export to (properly escaped) CSV.
+"""
+
+import csv
+import json
+import struct
+import sys
+import time
+import zlib
+from array import array
+
+from binary_triples import split_counter
+from stream_io import WriteBehind
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+MAGIC = b"WDCOL001"
+FOOTER_SIZE = struct.Struct("<Q")
+EXTENSION = ".wdc"
+ROW_GROUP_SIZE = 1 << 20
+COMPRESSION_LEVEL = 1
+TERM_COLUMNS = ["subject", "predicate", "object"]
+COLUMNS = TERM_COLUMNS + [column + "_counter" for column in TERM_COLUMNS] + ["literal"]
+# index of the object column for literal rows
+LITERAL = 0xFFFFFFFF
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def is_columnar_path(path):
+    return path.endswith(EXTENSION)
+
+
+def encode_strings(strings):
+    """
+    Encode the strings as offsets (uint64, one more than strings) and concatenated data.
+    Return: bytes
+    """
+    offsets = array("Q", [0])
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return struct.pack("<Q", len(strings)) + offsets.tobytes() + b"".join(strings)
+
+
+def decode_strings(data):
+    """
+    Decode the strings from offsets and concatenated data.
+    Return: (list of bytes, end of the strings in data)
+    """
+    (number_of_strings,) = struct.unpack_from("<Q", data)
+    data_offset = 8 + 8 * (number_of_strings + 1)
+    offsets = array("Q")
+    offsets.frombytes(data[8:data_offset])
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    strings = [data[data_offset + start : data_offset + end] for start, end in zip(offsets, offsets[1:])]
+    return strings, data_offset + offsets[-1]
+
+
+def encode_array(values, typecode):
+    values = array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def decode_array(data, typecode):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def encode_row_group(triples):
+    """
+    Encode the triples as a row group.
+    Return: (dict column -> compressed column data, statistics)
+    """
+    dictionaries = {column: dict() for column in TERM_COLUMNS}
+    indices = {column: array("I") for column in TERM_COLUMNS}
+    counters = {column: array("Q") for column in TERM_COLUMNS}
+    literals = list()
+    for triple in triples:
+        for column, term in zip(TERM_COLUMNS, triple):
+            if column == "object" and term.startswith(b'"'):
+                literals.append(term)
+                indices[column].append(LITERAL)
+                counters[column].append(0)
+                continue
+            base, counter = split_counter(term)
+            dictionary = dictionaries[column]
+            index = dictionary.get(base)
+            if index is None:
+                index = dictionary[base] = len(dictionary)
+            indices[column].append(index)
+            counters[column].append(counter)
+    columns = dict()
+    for column in TERM_COLUMNS:
+        data = encode_strings(list(dictionaries[column])) + encode_array(indices[column], "I")
+        columns[column] = zlib.compress(data, COMPRESSION_LEVEL)
+        columns[column + "_counter"] = zlib.compress(encode_array(counters[column], "Q"), COMPRESSION_LEVEL)
+    columns["literal"] = zlib.compress(encode_strings(literals), COMPRESSION_LEVEL)
+    subjects = sorted(dictionaries["subject"])
+    statistics = {
+        "rows": len(triples),
+        "literals": len(literals),
+        "subject_min": subjects[0].decode("utf-8", "surrogateescape") if subjects else None,
+        "subject_max": subjects[-1].decode("utf-8", "surrogateescape") if subjects else None,
+        "predicates": sorted(p.decode("utf-8", "surrogateescape") for p in dictionaries["predicate"]),
+    }
+    return columns, statistics
+
+
+def decode_column(column, data):
+    """
+    Decode the (decompressed) column data.
+    Return: list of term bases (None for literal rows in the object column), or array of counters
+    """
+    if column.endswith("_counter"):
+        return decode_array(data, "Q")
+    if column == "literal":
+        return decode_strings(data)[0]
+    dictionary, end = decode_strings(data)
+    indices = decode_array(data[end:], "I")
+    if column == "object":
+        return [dictionary[index] if index != LITERAL else None for index in indices]
+    return [dictionary[index] for index in indices]
+
+
+def join_counter(base, counter):
+    if counter:
+        return base + b"-" + str(counter - 1).encode()
+    return base
+
+
+def read_footer(fp):
+    """
+    Read the footer of the columnar file.
+    Return: dict
+    """
+    fp.seek(-(FOOTER_SIZE.size + len(MAGIC)), 2)
+    (footer_size,) = FOOTER_SIZE.unpack(fp.read(FOOTER_SIZE.size))
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar file: " + fp.name)
+    fp.seek(-(footer_size + FOOTER_SIZE.size + len(MAGIC)), 2)
+    return json.loads(fp.read(footer_size))
+
+
+def iter_row_groups(path, columns=None, predicates=None):
+    """
+    Iterate over the row groups of the columnar file, reading only the given columns (default: all).
+    With predicates (bases, e.g. 'P31'), row groups without any of the predicates are skipped.
+    Return: generator of (statistics, dict column -> values)
+    """
+    columns = columns or COLUMNS
+    with open(path, "rb") as fp:
+        footer = read_footer(fp)
+        for row_group in footer["row_groups"]:
+            statistics = row_group["statistics"]
+            if predicates and not set(predicates) & set(statistics["predicates"]):
+                continue
+            values = dict()
+            for column in columns:
+                offset, size = row_group["columns"][column]
+                fp.seek(offset)
+                values[column] = decode_column(column, zlib.decompress(fp.read(size)))
+            yield statistics, values
+
+
+def iter_rows(path, predicates=None):
+    """
+    Iterate over the rows (s, p, o) of the columnar file.
+    With predicates (bases, e.g. 'P31'), only rows with one of the predicates are returned.
+    Return: generator of lists of (s, p, o)
+    """
+    predicate_bases = {predicate.encode("utf-8") for predicate in predicates} if predicates else None
+    for _, values in iter_row_groups(path, predicates=predicates):
+        literals = iter(values["literal"])
+        rows = list()
+        for s, s_counter, p, p_counter, o, o_counter in zip(
+            values["subject"],
+            values["subject_counter"],
+            values["predicate"],
+            values["predicate_counter"],
+            values["object"],
+            values["object_counter"],
+        ):
+            o = next(literals) if o is None else join_counter(o, o_counter)
+            if predicate_bases and not p in predicate_bases:
+                continue
+            rows.append((join_counter(s, s_counter), join_counter(p, p_counter), o))
+        yield rows
+
+
+def convert_to_csv(path, csv_path):
+    """
+    Convert the columnar file into a CSV file with one row (s, p, o) per triple.
+    Unlike the plain output of resolve_qualifiers.py, fields containing commas, quotes
+    or line breaks are quoted (and quotes are escaped), such that the conversion is loss-free.
+    Return: number of rows
+    """
+    number_of_rows = 0
+    with open(csv_path, "w", encoding="utf-8", errors="surrogateescape", newline="") as fp_out:
+        writer = csv.writer(fp_out, lineterminator="\n")
+        for rows in iter_rows(path):
+            writer.writerows([term.decode("utf-8", "surrogateescape") for term in row] for row in rows)
+            number_of_rows += len(rows)
+    return number_of_rows
+
+
+class ColumnarWriter:
+    """
+    Write triples to a columnar file, row group by row group.
+    Same interface as 'binary_triples.TripleWriter'.
+    """
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE):
+        self.fp = WriteBehind(open(path, "wb"))
+        self.fp.write(MAGIC)
+        self.row_group_size = row_group_size
+        self.triples = list()
+        self.row_groups = list()
+
+    def write(self, triples):
+        """
+        Write the given list of (s, p, o).
+        Return: None
+        """
+        self.triples.extend(triples)
+        while len(self.triples) >= self.row_group_size:
+            self.flush(self.triples[: self.row_group_size])
+            self.triples = self.triples[self.row_group_size :]
+
+    def flush(self, triples):
+        if not triples:
+            return
+        columns, statistics = encode_row_group(triples)
+        offsets = dict()
+        for column in COLUMNS:
+            offsets[column] = [self.fp.tell(), len(columns[column])]
+            self.fp.write(columns[column])
+        self.row_groups.append({"columns": offsets, "statistics": statistics})
+
+    def close(self):
+        self.flush(self.triples)
+        self.triples = list()
+        footer = json.dumps({"columns": COLUMNS, "row_groups": self.row_groups}).encode("utf-8")
+        self.fp.write(footer + FOOTER_SIZE.pack(len(footer)) + MAGIC)
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: columnar.py <columnar_path> <csv_path>")
+        sys.exit()
+    start_time = time.time()
+    rows = convert_to_csv(sys.argv[1], sys.argv[2])
+    print("Converted " + str(rows) + " rows")
+    print("Time(columnar): " + str(time.time() - start_time))
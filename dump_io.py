@@ -0,0 +1,562 @@
+"""
+Read the n-triples dump in place, and manage the output shards of the workers.
+The dump is partitioned into byte ranges, such that each worker
+streams its own slice of the original file (no split step needed).
+Each worker writes its own output shard, and a manifest lists
+the shards (in dump order) together with line counts and checksums.
+
+Compressed dumps are read in place as well:
+bzip2 dumps are partitioned at block boundaries (each block is decompressed independently),
+gzip dumps are partitioned by their uncompressed size, using an index of the gzip members built once.
+Shards can be written compressed (gzip or, with the zstandard package, zstd).
+Reading (and decompressing) runs ahead of the consumer, writing (and compressing) behind it,
+in background threads (see 'stream_io').
+"""
+
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import os
+import zlib
+from bisect import bisect_right
+
+from binary_triples import count_triples, is_binary_path
+from stream_io import WriteBehind, get_block_size, iter_ahead, iter_file_blocks
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+MANIFEST_NAME = "manifest.json"
+COPY_BLOCK_SIZE = 1 << 30
+READ_BLOCK_SIZE = 1 << 24
+READ_BUFFER_SIZE = 1 << 23
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "bzip2": ".bz2", "zstd": ".zst"}
+GZIP_COMPRESSION_LEVEL = 1
+GZIP_WBITS = 31
+PATH_TO_GZIP_INDEX = "dicts/gzip_index_{}.json"
+# bzip2 blocks (and streams) start and end with 48-bit markers, which are not byte-aligned
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_END_MAGIC = 0x177245385090
+# header of a stream with the largest block size, such that any block can be decompressed
+BZ2_HEADER = b"BZh9"
+BZ2_SCAN_SIZE = 1 << 22
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def compute_byte_ranges(path, number_of_ranges):
+    """
+    Partition the file on the given path into (roughly) equally sized byte ranges.
+    The ranges are not aligned to line boundaries: this is done
+    by the reader of each range (see 'iter_line_batches').
+    For gzip dumps, the ranges refer to the uncompressed data. Dumps without random access
+    (see 'supports_random_access') form a single range, such that they are decompressed only once.
+    Return: list of (start, end) tuples
+    """
+    size = get_dump_size(path)
+    number_of_ranges = max(1, number_of_ranges) if supports_random_access(path) else 1
+    range_size = -(-size // number_of_ranges)
+    ranges = list()
+    for i in range(number_of_ranges):
+        start = min(size, i * range_size)
+        end = min(size, (i + 1) * range_size)
+        ranges.append((start, end))
+    return ranges
+
+
+def iter_line_batches(path, start=0, end=None, buffer_size=None):
+    """
+    Iterate over all lines in the file that start within [start, end).
+    A line belongs to the range in which its first byte lies, so that
+    adjacent ranges neither skip nor duplicate lines.
+    The file is read in large blocks into reusable buffers (ahead of the consumer, see 'stream_io.iter_file_blocks'),
+    and the lines of each block are returned as one batch (without the trailing newline).
+    Compressed files are decompressed on the fly (see 'iter_bz2_line_batches' and 'iter_stream_line_batches').
+    Return: generator of lists of lines (bytes)
+    """
+    compression = get_compression(path)
+    buffer_size = buffer_size or get_block_size(READ_BUFFER_SIZE)
+    if compression == "bzip2":
+        yield from iter_bz2_line_batches(path, start, end)
+        return
+    if compression:
+        with open(path, "rb") as fp:
+            position, stream = open_compressed_at(path, fp, max(0, start - 1))
+            yield from iter_stream_line_batches(stream, position, start, end, buffer_size)
+        return
+    with open(path, "rb", buffering=0) as fp:
+        if end is None:
+            end = os.fstat(fp.fileno()).st_size
+        # snap both ends to the next line boundary: the line containing the byte
+        # before start is processed by the preceding range
+        end = align_to_line_start(fp, end)
+        position = align_to_line_start(fp, start)
+        carry = b""
+        for buffer, length in iter_file_blocks(fp, position, end, buffer_size):
+            view = memoryview(buffer)
+            last_newline = buffer.rfind(b"\n", 0, length)
+            if last_newline == -1:
+                carry += view[:length]
+                continue
+            lines = (carry + view[:last_newline]).split(b"\n")
+            carry = bytes(view[last_newline + 1 : length])
+            yield lines
+        # the file might not end with a newline
+        if carry:
+            yield [carry]
+
+
+def align_to_line_start(fp, offset):
+    """
+    Find the offset of the first line starting at or after the given offset.
+    Return: int
+    """
+    if offset <= 0:
+        return 0
+    fp.seek(offset - 1)
+    fp.readline()
+    return fp.tell()
+
+
+def fingerprint_file(path):
+    """
+    Compute a cheap content fingerprint of a (huge) file.
+    The fingerprint covers the file size and a fixed number of
+    windows sampled evenly over the file, so it can be computed
+    in milliseconds even for the full dump.
+    Return: str
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode("ascii"))
+    with open(path, "rb") as fp:
+        for i in range(FINGERPRINT_SAMPLES):
+            fp.seek(max(0, size - FINGERPRINT_SAMPLE_SIZE) * i // max(1, FINGERPRINT_SAMPLES - 1))
+            digest.update(fp.read(FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+#####################################################
+# COMPRESSED DUMPS                                  #
+#####################################################
+def get_compression(path):
+    """
+    Get the compression of the file on the given path, by its extension.
+    Return: "gzip", "bzip2", "zstd" (or None for uncompressed files)
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def get_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def get_dump_size(path):
+    """
+    Get the size of the dump that is partitioned into byte ranges (see 'compute_byte_ranges'):
+    the uncompressed size for gzip dumps, the file size otherwise.
+    Return: int
+    """
+    if get_compression(path) == "gzip":
+        return load_gzip_index(path)["size"]
+    return os.path.getsize(path)
+
+
+def supports_random_access(path):
+    """
+    Check whether a range of the dump can be read without decompressing the data before it:
+    true for uncompressed and bzip2 dumps, and for gzip dumps consisting of many members.
+    Return: bool
+    """
+    compression = get_compression(path)
+    if compression == "gzip":
+        return len(load_gzip_index(path)["members"]) > 1
+    return compression in (None, "bzip2")
+
+
+def open_output(path):
+    """
+    Open the file on the given path for writing, compressed depending on its extension.
+    Writing (and compressing) runs behind the caller (see 'stream_io.WriteBehind').
+    Return: WriteBehind
+    """
+    compression = get_compression(path)
+    if compression == "gzip":
+        return WriteBehind(gzip.open(path, "wb", compresslevel=GZIP_COMPRESSION_LEVEL))
+    if compression == "bzip2":
+        return WriteBehind(bz2.open(path, "wb"))
+    if compression == "zstd":
+        return WriteBehind(get_zstandard().ZstdCompressor().stream_writer(open(path, "wb")))
+    return WriteBehind(open(path, "wb"))
+
+
+def open_input(path):
+    """
+    Open the file on the given path for (sequential) reading, decompressed depending on its extension.
+    Return: file object
+    """
+    compression = get_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "bzip2":
+        return bz2.open(path, "rb")
+    if compression == "zstd":
+        reader = get_zstandard().ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return io.BufferedReader(reader, READ_BUFFER_SIZE)
+    return open(path, "rb")
+
+
+def open_compressed_at(path, fp, offset):
+    """
+    Open a stream of the uncompressed data of the compressed (gzip or zstd) file (opened as fp),
+    from a position not after the given offset: gzip files start at the gzip member containing the offset.
+    Return: (uncompressed position, stream)
+    """
+    if get_compression(path) == "zstd":
+        reader = get_zstandard().ZstdDecompressor().stream_reader(fp, read_across_frames=True, closefd=False)
+        return 0, io.BufferedReader(reader, READ_BUFFER_SIZE)
+    members = load_gzip_index(path)["members"]
+    compressed_offset, position = members[bisect_right([member[1] for member in members], offset) - 1]
+    fp.seek(compressed_offset)
+    return position, gzip.GzipFile(fileobj=fp)
+
+
+def iter_stream_line_batches(fp, position, start=0, end=None, buffer_size=READ_BUFFER_SIZE):
+    """
+    Iterate over all lines that start within [start, end) of a stream, as in 'iter_line_batches'.
+    The stream is read sequentially from the given position (not after start - 1),
+    and decompressed ahead of the consumer (see 'stream_io.iter_ahead').
+    Return: generator of lists of lines (bytes)
+    """
+    if start > 0:
+        # the line containing the byte before start is processed by the preceding range
+        while position < start - 1:
+            skipped = len(fp.read(min(buffer_size, start - 1 - position)))
+            if not skipped:
+                return
+            position += skipped
+        position += len(fp.readline())
+    carry = b""
+    for data in iter_ahead(read_stream_blocks(fp, position, end, buffer_size)):
+        last_newline = data.rfind(b"\n")
+        if last_newline == -1:
+            carry += data
+            continue
+        lines = (carry + data[:last_newline]).split(b"\n")
+        carry = data[last_newline + 1 :]
+        yield lines
+    # the last line might continue after end (or the stream might not end with a newline)
+    if carry:
+        yield [carry + fp.readline().rstrip(b"\n")]
+
+
+def read_stream_blocks(fp, position, end, buffer_size):
+    """
+    Read the stream from the given position up to end (or its end).
+    Return: generator of bytes
+    """
+    while end is None or position < end:
+        data = fp.read(buffer_size if end is None else min(buffer_size, end - position))
+        if not data:
+            break
+        position += len(data)
+        yield data
+
+
+def build_gzip_index(path):
+    """
+    Decompress the gzip file once, and collect the offsets (compressed, uncompressed) of its members,
+    from which the file can be decompressed. Files written by 'gzip' consist of a single member,
+    concatenated files (or files written by e.g. 'bgzip') of many.
+    Return: dict with uncompressed size and list of member offsets
+    """
+    members = [[0, 0]]
+    size = 0
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    with open(path, "rb") as fp:
+        data = fp.read(READ_BUFFER_SIZE)
+        while data:
+            size += len(decompressor.decompress(data))
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                if data:
+                    members.append([fp.tell() - len(data), size])
+                    continue
+            data = fp.read(READ_BUFFER_SIZE)
+    return {"size": size, "members": members}
+
+
+def load_gzip_index(path):
+    """
+    Load the index of the gzip file (see 'build_gzip_index'), which is built on first use
+    and stored under the fingerprint of the file.
+    Return: dict
+    """
+    index_path = PATH_TO_GZIP_INDEX.format(fingerprint_file(path))
+    if os.path.exists(index_path):
+        with open(index_path, "r") as fp:
+            return json.load(fp)
+    index = build_gzip_index(path)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path + ".tmp", "w") as fp:
+        json.dump(index, fp)
+    os.replace(index_path + ".tmp", index_path)
+    return index
+
+
+def get_bz2_patterns():
+    """
+    Get the byte patterns of the bzip2 markers for each bit offset (0-7) within the first byte.
+    Return: list of (is block marker, bit offset, full bytes, first byte, first mask, last byte, last mask)
+    """
+    patterns = list()
+    for magic in (BZ2_BLOCK_MAGIC, BZ2_END_MAGIC):
+        for shift in range(8):
+            length = (shift + 48 + 7) // 8
+            pattern = (magic << (8 * length - 48 - shift)).to_bytes(length, "big")
+            first_mask = 0xFF >> shift
+            last_mask = (0xFF << (8 * length - 48 - shift)) & 0xFF
+            full = pattern if shift == 0 else pattern[1:-1]
+            patterns.append((magic == BZ2_BLOCK_MAGIC, shift, full, pattern[0], first_mask, pattern[-1], last_mask))
+    return patterns
+
+
+BZ2_PATTERNS = get_bz2_patterns()
+
+
+def iter_bz2_markers(fp, start_bit):
+    """
+    Find the markers of blocks and stream ends in the bzip2 file, from the given bit offset.
+    As a marker can occur anywhere in the bit stream, matches within compressed data are possible (but rare).
+    Return: generator of (bit offset, is block marker), sorted by offset
+    """
+    offset = start_bit // 8
+    fp.seek(offset)
+    data = fp.read(BZ2_SCAN_SIZE)
+    last_bit = start_bit - 1
+    while len(data) > 6:
+        markers = list()
+        for is_block, shift, full, first, first_mask, last, last_mask in BZ2_PATTERNS:
+            index = data.find(full, 1 if shift else 0)
+            while index != -1:
+                if shift == 0:
+                    markers.append((8 * (offset + index), is_block))
+                elif index + 5 < len(data):
+                    if data[index - 1] & first_mask == first and data[index + 5] & last_mask == last:
+                        markers.append((8 * (offset + index - 1) + shift, is_block))
+                index = data.find(full, index + 1)
+        for bit, is_block in sorted(markers):
+            if bit > last_bit:
+                last_bit = bit
+                yield bit, is_block
+        # keep the last bytes, which might contain the beginning of a marker
+        chunk = fp.read(BZ2_SCAN_SIZE)
+        if not chunk:
+            break
+        offset += len(data) - 7
+        data = data[-7:] + chunk
+
+
+def decompress_bz2_block(fd, start_bit, end_bit):
+    """
+    Decompress the bzip2 block within the bit range [start_bit, end_bit) of the file,
+    by shifting it to a byte boundary, as the only block of a new stream.
+    Return: bytes (empty, if the block is incomplete)
+    """
+    first = start_bit // 8
+    shift = start_bit % 8
+    data = os.pread(fd, (end_bit + 7) // 8 - first + 1, first)
+    if shift:
+        length = len(data)
+        data = ((int.from_bytes(data, "big") << shift) & ((1 << (8 * length)) - 1)).to_bytes(length, "big")
+    decompressor = bz2.BZ2Decompressor()
+    blocks = [decompressor.decompress(BZ2_HEADER + data[: (end_bit - start_bit + 7) // 8])]
+    # the decompressor returns the data of a complete block in parts
+    while blocks[-1]:
+        blocks.append(decompressor.decompress(b""))
+    return b"".join(blocks)
+
+
+def iter_bz2_blocks(path, start=0):
+    """
+    Decompress the blocks of the bzip2 file, from the first block starting at or after the byte offset.
+    Markers within compressed data are skipped: a block ending at such a marker is incomplete
+    (and is extended to the next marker), a block starting at such a marker is invalid.
+    Return: generator of (start bit of the block, data)
+    """
+    with open(path, "rb") as fp:
+        block_start = None
+        for bit, is_block in iter_bz2_markers(fp, 8 * start):
+            if block_start is not None:
+                try:
+                    data = decompress_bz2_block(fp.fileno(), block_start, bit)
+                except OSError:
+                    data = None
+                if data == b"":
+                    continue
+                if data is not None:
+                    yield block_start, data
+            block_start = bit if is_block else None
+
+
+def iter_bz2_line_batches(path, start=0, end=None):
+    """
+    Iterate over the lines of the bzip2 file belonging to the blocks that start within the byte range [start, end).
+    A line belongs to the block containing the byte before its first byte (the first line to the first block),
+    so that adjacent ranges neither skip nor duplicate lines: the last line of a range is completed
+    from the following blocks.
+    Return: generator of lists of lines (bytes)
+    """
+    if end is None:
+        end = os.path.getsize(path)
+    # lines up to the first newline belong to the preceding range
+    skipping = start > 0
+    carry = b""
+    # blocks are decompressed ahead of the consumer
+    for block_start, data in iter_ahead(iter_bz2_blocks(path, start)):
+        if block_start >= 8 * end:
+            if skipping:
+                return
+            newline = data.find(b"\n")
+            if newline == -1:
+                carry += data
+                continue
+            yield [carry + data[:newline]]
+            return
+        if skipping:
+            newline = data.find(b"\n")
+            if newline == -1:
+                continue
+            data = data[newline + 1 :]
+            skipping = False
+        last_newline = data.rfind(b"\n")
+        if last_newline == -1:
+            carry += data
+            continue
+        lines = (carry + data[:last_newline]).split(b"\n")
+        carry = data[last_newline + 1 :]
+        yield lines
+    # the file might not end with a newline
+    if carry:
+        yield [carry]
+
+
+#####################################################
+# SHARDS                                            #
+#####################################################
+def get_shard_name(shard_id, extension=".nt"):
+    return "shard_" + str(shard_id).zfill(5) + extension
+
+
+def write_manifest(directory, shards):
+    """
+    Store the manifest of the shards in the given directory.
+    Each shard is given as a dict with name, number of lines, number of bytes and crc32 checksum.
+    The order of the shards in the manifest is the order of the data in the dump.
+    Return: None
+    """
+    tmp_path = os.path.join(directory, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump({"shards": shards}, fp, indent=1)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+
+
+def read_manifest(directory):
+    """
+    Load the shard entries from the manifest in the given directory.
+    Return: list of dicts
+    """
+    with open(os.path.join(directory, MANIFEST_NAME), "r") as fp:
+        return json.load(fp)["shards"]
+
+
+def get_shard_paths(directory):
+    """
+    Get the paths of all shards listed in the manifest, in order.
+    Return: list of str
+    """
+    return [os.path.join(directory, shard["name"]) for shard in read_manifest(directory)]
+
+
+def verify_shards(directory):
+    """
+    Check that the shards on disk match the line counts and checksums in the manifest.
+    For binary shards, the number of triples is checked instead of the number of lines.
+    For compressed shards, the uncompressed data is checked.
+    Return: list of names of corrupted shards
+    """
+    corrupted = list()
+    for shard in read_manifest(directory):
+        lines = 0
+        checksum = 0
+        path = os.path.join(directory, shard["name"])
+        with open_input(path) as fp:
+            block = fp.read(READ_BLOCK_SIZE)
+            while block:
+                lines += block.count(b"\n")
+                checksum = zlib.crc32(block, checksum)
+                block = fp.read(READ_BLOCK_SIZE)
+        if is_binary_path(path):
+            lines = count_triples(path)
+        if lines != shard["lines"] or "%08x" % checksum != shard["crc32"]:
+            corrupted.append(shard["name"])
+    return corrupted
+
+
+def compress_file(path, compression):
+    """
+    Compress the file on the given path with the given compression (gzip or zstd), and remove the original.
+    Return: path of the compressed file
+    """
+    compressed_path = path + COMPRESSION_EXTENSIONS[compression]
+    with open(path, "rb") as fp_in, open_output(compressed_path) as fp_out:
+        block = fp_in.read(READ_BLOCK_SIZE)
+        while block:
+            fp_out.write(block)
+            block = fp_in.read(READ_BLOCK_SIZE)
+    os.remove(path)
+    return compressed_path
+
+
+def concatenate_shards(directory, output_path):
+    """
+    Concatenate all shards (in manifest order) into a single file.
+    Compressed shards concatenate into a valid compressed file (with one gzip member or zstd frame per shard).
+    The data is copied within the kernel (copy_file_range/sendfile),
+    without passing through Python.
+    Return: None
+    """
+    with open(output_path, "wb") as fp_out:
+        for path in get_shard_paths(directory):
+            with open(path, "rb") as fp_in:
+                remaining = os.fstat(fp_in.fileno()).st_size
+                while remaining > 0:
+                    copied = copy_range(fp_in.fileno(), fp_out.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+
+
+def copy_range(fd_in, fd_out, count):
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(fd_in, fd_out, min(count, COPY_BLOCK_SIZE))
+        except OSError:
+            # e.g. copying across file systems on older kernels
+            pass
+    return os.sendfile(fd_out, fd_in, None, min(count, COPY_BLOCK_SIZE))
@@ -1,70 +1,183 @@
 """
-Extract identifier predicates and geo predicates.
-Such predicates (and corresponding facts) are removed from the dump.
+Extract the type of each predicate (e.g. ExternalId, GeoShape, GlobeCoordinate).
+Identifier predicates and geo predicates (and corresponding facts) are removed from the dump.
+
+Only a few thousand lines in the dump are propertyType triples, so the dump
+is scanned in large binary chunks for the propertyType marker, and only lines
+containing the marker are parsed. The scan runs in parallel over byte ranges of the dump.
+The resulting catalog is stored under a fingerprint of the dump,
+such that later runs on the same dump can skip this stage.
 """
 
-import pickle
+import argparse
+import json
+import os
 import sys
+import time
+from multiprocessing import Pool
+
+from dump_io import align_to_line_start, compute_byte_ranges, fingerprint_file, get_compression, iter_line_batches
+from metrics import configure, get_metrics
+from stream_io import add_io_arguments, configure_io_from_args, get_block_size, iter_file_blocks
 
 #####################################################
 # CONSTANTS											#
 #####################################################
-PATH_TO_EXT_ID_PREDICATES = "dicts/identifier_predicates.pickle"
-PATH_TO_GEO_PREDICATES = "dicts/geo_predicates.pickle"
+PATH_TO_PREDICATE_CATALOG = "dicts/predicate_types_{}.json"
+PROPERTY_TYPE_PREDICATE = b"<http://wikiba.se/ontology#propertyType>"
+PROPERTY_TYPE_PREFIX = b"<http://wikiba.se/ontology#"
+EXT_ID_TYPES = {"ExternalId"}
+GEO_TYPES = {"GeoShape", "GlobeCoordinate"}
+# the blocks are read ahead into a ring of buffers (see 'stream_io.iter_file_blocks')
+CHUNK_SIZE = 16 * 1024 * 1024
+
 
 #####################################################
 # FUNCTIONS											#
 #####################################################
-def extract_special_predicates(file, ext_id_predicates, geo_predicates):
+def extract_predicate_types(file, start, end):
+    """
+    Extract the types of all predicates defined within the byte range [start, end) of the dump.
+    Compressed dumps are decompressed line batch by line batch (see 'dump_io.iter_line_batches').
+    Return: dict (predicate -> type)
+    """
+    predicate_types = dict()
+    metrics = get_metrics("extract_special_predicates")
+    if get_compression(file):
+        for lines in iter_line_batches(file, start, end):
+            data = b"\n".join(lines)
+            scan_chunk(data, len(data), predicate_types)
+            if metrics:
+                metrics.add("lines_total", len(lines))
+                update_scan_metrics(metrics, len(data) + 1, predicate_types)
+        if metrics:
+            metrics.report(force=True)
+        return predicate_types
+    with open(file, "rb", buffering=0) as fp:
+        start = align_to_line_start(fp, start)
+        end = align_to_line_start(fp, end)
+        carry = b""
+        for buffer, length in iter_file_blocks(fp, start, end, get_block_size(CHUNK_SIZE)):
+            data = carry + memoryview(buffer)[:length]
+            last_newline = data.rfind(b"\n") + 1
+            carry = data[last_newline:]
+            scan_chunk(data, last_newline, predicate_types)
+            if metrics:
+                update_scan_metrics(metrics, length, predicate_types)
+        # the dump might not end with a newline
+        scan_chunk(carry, len(carry), predicate_types)
+    if metrics:
+        metrics.report(force=True)
+    return predicate_types
+
+
+def update_scan_metrics(metrics, size, predicate_types):
     """
-    Extract special (unnecessary) predicates from the wikidata dump.
+    Update the metrics of the worker after scanning size bytes of the dump: scanned bytes,
+    throughput, the number of predicates found, and the peak RSS; report them periodically.
+    Return: None
     """
-    with open(file, "r") as fp:
-        line = fp.readline()
-        while line:
-            currentLine = line
-            s, p, o = currentLine.split(" ", 2)
-            line = fp.readline()
-            # Remove " .\n", the line ending from o
-            if len(o) < 35:
-                continue
-            o = o[:-3]
-            # Extract external identifier predicates
-            if p == "<http://wikiba.se/ontology#propertyType>" and o == "<http://wikiba.se/ontology#ExternalId>":
-                ext_id_pred = s.rsplit("/", 1)[1].replace(">", "")
-                if not ext_id_pred in ext_id_predicates:
-                    ext_id_predicates.append(ext_id_pred)
-            # Extract geo predicates (for geo shapes)
-            if p == "<http://wikiba.se/ontology#propertyType>" and o == "<http://wikiba.se/ontology#GeoShape>":
-                geo_pred = s.rsplit("/", 1)[1].replace(">", "")
-                if not geo_pred in geo_predicates:
-                    geo_predicates.append(geo_pred)
-            # Extract geo predicates (for geo coordinates)
-            if p == "<http://wikiba.se/ontology#propertyType>" and o == "<http://wikiba.se/ontology#GlobeCoordinate>":
-                geo_pred = s.rsplit("/", 1)[1].replace(">", "")
-                if not geo_pred in geo_predicates:
-                    geo_predicates.append(geo_pred)
-
-
-def store_special_predicates(special_predicates, path):
+    metrics.add("bytes_total", size)
+    metrics.set("dict_entries", len(predicate_types), dict="predicate_types")
+    metrics.update_rates(time.time() - metrics.start_time)
+    metrics.report()
+
+
+def scan_chunk(data, length, predicate_types):
     """
-    Store the special predicates on the given path.
+    Parse the lines within data[:length] that contain the propertyType marker.
     Return: None
     """
-    with open(path, "wb") as output:
-        pickle.dump(special_predicates, output, protocol=pickle.HIGHEST_PROTOCOL)
+    index = data.find(PROPERTY_TYPE_PREDICATE, 0, length)
+    while index != -1:
+        line_start = data.rfind(b"\n", 0, index) + 1
+        line_end = data.find(b"\n", index, length)
+        if line_end == -1:
+            line_end = length
+        s, p, o = data[line_start:line_end].split(b" ", 2)
+        if p == PROPERTY_TYPE_PREDICATE and o.startswith(PROPERTY_TYPE_PREFIX):
+            predicate = s.rsplit(b"/", 1)[1][:-1].decode("utf-8")
+            predicate_types[predicate] = o[len(PROPERTY_TYPE_PREFIX) :].split(b">", 1)[0].decode("utf-8")
+        index = data.find(PROPERTY_TYPE_PREDICATE, line_end, length)
+
+
+def extract_special_predicates(file, workers):
+    """
+    Extract the types of all predicates in the dump, using the given number of workers.
+    Return: dict (predicate -> type)
+    """
+    byte_ranges = compute_byte_ranges(file, workers)
+    predicate_types = dict()
+    with Pool(workers) as pool:
+        for worker_types in pool.starmap(extract_predicate_types, [(file, s, e) for s, e in byte_ranges]):
+            predicate_types.update(worker_types)
+    return predicate_types
+
+
+def get_catalog_path(file):
+    """
+    Get the path of the predicate catalog for the dump on the given path.
+    Return: str
+    """
+    return PATH_TO_PREDICATE_CATALOG.format(fingerprint_file(file))
+
+
+def store_predicate_catalog(predicate_types, path):
+    """
+    Store the predicate catalog on the given path.
+    Return: None
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as output:
+        json.dump(predicate_types, output, sort_keys=True, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def load_special_predicates(file):
+    """
+    Load the catalog of the dump on the given path, and derive the sets of
+    identifier predicates and geo predicates from it.
+    Return: (set, set)
+    """
+    with open(get_catalog_path(file), "r") as catalog:
+        predicate_types = json.load(catalog)
+    ext_id_predicates = {p for p, t in predicate_types.items() if t in EXT_ID_TYPES}
+    geo_predicates = {p for p, t in predicate_types.items() if t in GEO_TYPES}
+    return ext_id_predicates, geo_predicates
 
 
 #####################################################
 # MAIN												#
 #####################################################
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: extract_identifier_predicates.py <wikidata_dump_path>")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wikidata_dump_path")
+    parser.add_argument("number_of_workers", type=int, nargs="?", default=os.cpu_count())
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="write metrics of the workers (e.g. bytes per second) periodically to DIR (see metrics.py)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="with --metrics, sample the stacks of the workers every SECONDS (CPU time) into DIR",
+    )
+    add_io_arguments(parser)
+    args = parser.parse_args()
+    if args.profile and not args.metrics:
+        parser.error("--profile requires --metrics")
+    if args.metrics:
+        configure(args.metrics, args.profile)
+    configure_io_from_args(args)
+    WIKIDATA_DUMP_PATH = args.wikidata_dump_path
+    workers = args.number_of_workers
+    start_time = time.time()
+    catalog_path = get_catalog_path(WIKIDATA_DUMP_PATH)
+    if os.path.exists(catalog_path):
+        print("Predicate catalog for this dump exists already: " + catalog_path)
         sys.exit()
-    WIKIDATA_DUMP_PATH = sys.argv[1]
-    ext_id_predicates = list()
-    geo_predicates = list()
-    extract_special_predicates(WIKIDATA_DUMP_PATH, ext_id_predicates, geo_predicates)
-    store_special_predicates(ext_id_predicates, PATH_TO_EXT_ID_PREDICATES)
-    store_special_predicates(geo_predicates, PATH_TO_GEO_PREDICATES)
+    predicate_types = extract_special_predicates(WIKIDATA_DUMP_PATH, workers)
+    store_predicate_catalog(predicate_types, catalog_path)
+    print("Time(extract_special_predicates): " + str(time.time() - start_time))
@@ -1,67 +1,144 @@
+import argparse
 import concurrent.futures
-import glob
+import itertools
 import json
-import multiprocessing as mp
 import os
-import pickle
 import re
 import sys
-import threading
 import time
-from multiprocessing import Process
-from threading import Thread
+import zlib
+
+from binary_triples import EXTENSION, TripleWriter
+from checkpoints import Checkpoint, get_stage_key
+from dump_io import (
+    COMPRESSION_EXTENSIONS,
+    MANIFEST_NAME,
+    concatenate_shards,
+    get_dump_size,
+    get_shard_name,
+    iter_line_batches,
+    open_output,
+    supports_random_access,
+    write_manifest,
+)
+from extract_special_predicates import get_catalog_path, load_special_predicates
+from literals import get_literal_text, get_primary_language, parse_literal
+from metrics import configure, get_metrics
+from resolve_qualifiers import parse_triple
+from sorted_dicts import SortedDict, merge_runs, write_run
+from stream_io import add_io_arguments, configure_io_from_args
 
 #####################################################
 # SETTINGS                                          #
 #####################################################
-FILES = glob.glob(os.getcwd() + "/tmp_dumps/wd*")
-PATH_TO_EXT_ID_PREDICATES = "dicts/identifier_predicates.pickle"
-PATH_TO_GEO_PREDICATES = "dicts/geo_predicates.pickle"
+PATH_TO_OUTPUT_DIR = "dumps/wikidata_clean"
 PATH_TO_OUTPUT_FILE = "dumps/wikidata_clean.nt"
+PATH_TO_DICTS_DIR = "dicts"
+PATH_TO_RUNS_DIR = "dicts/runs"
+PATH_TO_CHUNK_LOG = "dumps/wikidata_clean/chunks.jsonl"
 
 #####################################################
 # CONSTANTS                                         #
 #####################################################
-LABELS_PATTERN = re.compile('".*"@((?!en)[a-z][a-z])')
-ENGLISH_LABELS_PATTERN = re.compile('".*"@en')
-URI_PATTERN = re.compile("[A-z]*://[A-z.-/#]+.*")
+URI_PATTERN = re.compile(b"[A-z]*://[A-z.-/#]+.*")
 LABELS = {}
 DESCRIPTIONS = {}
-write_lock = threading.Lock()
-
-with open(PATH_TO_GEO_PREDICATES, "rb") as geo_file:
-    GEO_PREDS = pickle.load(geo_file)
+DEFAULT_CHUNK_SIZE = 1 << 30
+DEFAULT_MEMORY_BUDGET = 1 << 30
+# estimated memory per dict entry (in bytes)
+DICT_ENTRY_MEMORY = 300
+# size of the steps, in which chunks are processed when slow chunks are split
+SPLIT_STEP_SIZE = 1 << 26
+# name of the dict with the entities of the domain (and their neighbors), to which the other dicts are restricted
+DOMAIN_DICT_NAME = "domain_entities"
+# size of the range before a chunk, in which the last entity of the previous chunk is looked up
+PEEK_SIZE = 1 << 20
 
-with open(PATH_TO_EXT_ID_PREDICATES, "rb") as identifiers:
-    EXT_IDS = pickle.load(identifiers)
+# sets of identifier predicates and geo predicates, loaded from the predicate catalog of the dump
+EXT_IDS = set()
+GEO_PREDS = set()
 
 #####################################################
 # FUNCTIONS                                         #
 #####################################################
-def prune_triples(file, worker_id):
+def prune_triples(
+    file,
+    start,
+    end,
+    chunk_id,
+    filter_config,
+    binary=False,
+    compression=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    split_after=None,
+):
     """
     Stepwise filter out triples.
-    In this version, you can select (comment) whatever filters you like.
-    Note, that the runtime is significantly slower than the runtim
-    of 'prune_triples_all'.
-    Return: None
+    The worker streams the lines starting within the byte range [start, end) of the dump (a chunk),
+    and writes the remaining triples into the shard of the chunk.
+    Lines are processed as bytes: only literals that go into the dicts are decoded.
+    The filters to apply are selected in the filter config (see 'load_filter_config'), and compiled
+    into a single classifier, such that disabled filters do not add any runtime.
+    Labels, aliases and descriptions are extracted for all languages in the filter config in the same pass.
+    The dicts are stored as sorted runs, whenever they exceed the memory budget (in bytes), and at the end.
+    With binary, the shard is written as (normalized) binary triples (see 'binary_triples').
+    With compression (gzip or zstd), the n-triples shard is compressed; line count, size
+    and checksum in the manifest refer to the uncompressed data.
+    With split_after (seconds), the chunk is processed in steps, and processing stops after the first step
+    exceeding the time; the rest of the chunk is returned, to be split into smaller chunks.
+    With a domain in the filter config, only the triples of the domain entities are kept (see 'DomainFilter').
+    Return: dict with the manifest entry of the shard, number of dict runs, statistics and the rest of the chunk
     """
-    buf_triples_count = 0
-    buf_triples = ""
-    labels = {}
-    aliases = {}
-    descriptions = {}
-    wikipedia_mappings = {}
-    inverse_wikipedia_mappings = {}
-    with open(file, "r") as fp:
-        line = fp.readline()
-        while line:
-            currentLine = line
+    start_time = time.time()
+    buf_triples = []
+    extension = EXTENSION if binary else ".nt" + COMPRESSION_EXTENSIONS.get(compression, "")
+    shard = {"name": get_shard_name(chunk_id, extension), "lines": 0, "bytes": 0, "crc32": 0}
+    if binary:
+        output = TripleWriter(os.path.join(PATH_TO_OUTPUT_DIR, shard["name"]))
+    else:
+        output = open_output(os.path.join(PATH_TO_OUTPUT_DIR, shard["name"]))
+    languages = [language.encode("utf-8") for language in filter_config["languages"]]
+    dicts = create_dicts(languages)
+    labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    max_dict_entries = max(1, memory_budget // DICT_ENTRY_MEMORY)
+    runs = 0
+    metrics = get_metrics("filter")
+    filter_chain = FilterChain(filter_config, timed=metrics is not None)
+    classify = filter_chain.classify
+    domain = DomainFilter(filter_config, file, start) if is_domain_restricted(filter_config) else None
+    hits = filter_chain.hits
+    # metrics reported for the chunk so far
+    reported = dict()
+    processed_lines = 0
+    total_lines = 0
+    rest = None
+    steps = [(start, end)]
+    if split_after and supports_random_access(file):
+        steps = split_byte_range(start, end, -(-(end - start) // SPLIT_STEP_SIZE))
+    def iter_batches():
+        nonlocal rest
+        for step, (step_start, step_end) in enumerate(steps):
+            if step and time.time() - start_time > split_after:
+                rest = (step_start, end)
+                break
+            yield from iter_line_batches(file, step_start, step_end)
+        # the last entity of the chunk continues after its end
+        if domain:
+            yield from domain.iter_tail(file, rest[0] if rest else end)
+
+    for batch, lines in enumerate(iter_batches()):
+        if metrics:
+            # time the filters on a sample of the batches
+            sampled = batch % METRICS_SAMPLING_INTERVAL == 0
+            classify = filter_chain.classify_timed if sampled else filter_chain.classify
+        for currentLine in lines:
             # note that o is not only the object, but the object + " .", the line ending
-            s, p, o = currentLine.split(" ", 2)
-            line = fp.readline()
+            s, p, o = currentLine.split(b" ", 2)
+            # skip the lines of the last entity of the previous chunk, and buffer the lines per entity
+            if domain and domain.next_line(s, p, o, buf_triples):
+                continue
             """ 
-            Extract english labels (+aliases) and descriptions.
+            Extract labels (+aliases) and descriptions.
             This needs to be done before filtering predicates,
             to ensure that predicate labels are extracted.
             Further, wikipedia mappings need to be extracted before
@@ -72,124 +149,533 @@ def prune_triples(file, worker_id):
             # filter triples without a wikidata id as subject
             if filter_non_wikidata_id_subjects(s):
                 continue
-            # extract labels
-            extract_english_labels(s, p, o, labels)
-            # extract aliases
-            extract_english_aliases(s, p, o, aliases)
-            # extract descriptions
-            extract_english_descriptions(s, p, o, descriptions)
+            # parse literal once (language is empty for non-literals and literals without language tag)
+            value, language, datatype = parse_literal(o)
+            if language:
+                language = get_primary_language(language)
+                # extract labels
+                extract_labels(s, p, value, language, labels)
+                # extract aliases
+                extract_aliases(s, p, value, language, aliases)
+                # extract descriptions
+                extract_descriptions(s, p, value, language, descriptions)
 
             """ 
             Prune triples
             """
-            if filter_predicates_as_subjects(s):
-                continue
-            if filter_schema_predicates(p):
-                continue
-            if filter_values(s, o):
-                continue
-            if filter_labels(o):
-                continue
-            if filter_references(s, o):
-                continue
-            if filter_uri_objects(o):
-                continue
-            if filter_non_english_labels(o):
-                continue
-            if filter_external_id_predicates(p):
-                continue
-            if filter_unknown_values(s, o):
-                continue
-            if filter_geo_predicates(p):
-                continue
-            if filter_other_objects(o):
+            pruned_by = classify(s, p, o, language)
+            if pruned_by != -1:
+                hits[pruned_by] += 1
                 continue
             # if triple was not filtered out, include it into output-buffer
-            buf_triples_count += 1
-            buf_triples += currentLine
-            # store triples, if buffer exceeded
-            if buf_triples_count > 1000000:
-                write_lock.acquire()
-                try:
-                    with open(PATH_TO_OUTPUT_FILE, "a") as output:
-                        output.write(buf_triples)
-                except Exception as e:
-                    print(e)
-                finally:
-                    write_lock.release()
-                    buf_triples_count = 0
-                    buf_triples = ""
-        # store remaining triples in buffer
-        write_lock.acquire()
-        try:
-            with open(PATH_TO_OUTPUT_FILE, "a") as output:
-                output.write(buf_triples)
-        except Exception as e:
-            print(e)
-        finally:
-            write_lock.release()
-
-        # store labels dict for worker
-        for k in labels:
-            labels[k] = list(labels[k])
-        with open("dicts/labels_" + str(worker_id) + ".json", "w") as outfile:
-            outfile.write(json.dumps(labels, separators=(",", ":")))
-        # store aliases dict for worker
-        for k in aliases:
-            aliases[k] = list(aliases[k])
-        with open("dicts/aliases_" + str(worker_id) + ".json", "w") as outfile:
-            outfile.write(json.dumps(aliases, separators=(",", ":")))
-        # store description dict for worker
-        with open("dicts/descriptions_" + str(worker_id) + ".json", "w") as outfile:
-            outfile.write(json.dumps(descriptions, separators=(",", ":")))
-        # store wikipedia_mappings dict for worker
-        with open("dicts/wikipedia_mappings_" + str(worker_id) + ".json", "w") as outfile:
-            outfile.write(json.dumps(wikipedia_mappings, separators=(",", ":")))
-        # store inverse_wikipedia_mappings dict for worker
-        with open("dicts/inverse_wikipedia_mappings_" + str(worker_id) + ".json", "w") as outfile:
-            outfile.write(json.dumps(inverse_wikipedia_mappings, separators=(",", ":")))
+            if domain:
+                domain.lines.append(currentLine)
+            else:
+                buf_triples.append(currentLine)
+        if metrics:
+            update_filter_metrics(metrics, filter_chain, dicts, lines, sampled, reported)
+        # move the filters pruning most triples to the front
+        processed_lines += len(lines)
+        total_lines += len(lines)
+        if processed_lines >= ADAPTIVE_ORDERING_INTERVAL:
+            processed_lines = 0
+            filter_chain.adapt()
+            classify = filter_chain.classify
+            hits = filter_chain.hits
+        # store triples, if buffer exceeded
+        if len(buf_triples) > 1000000:
+            write_shard_buffer(output, buf_triples, shard)
+            buf_triples = []
+        # store dicts as sorted runs, if memory budget exceeded
+        if count_dict_entries(dicts) + (len(domain.entities) if domain else 0) >= max_dict_entries:
+            write_dict_runs(dicts, languages, chunk_id, runs)
+            if domain:
+                domain.write_run(chunk_id, runs)
+            runs += 1
+            dicts = create_dicts(languages)
+            labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    # store remaining triples in buffer
+    if domain:
+        domain.flush(buf_triples)
+    write_shard_buffer(output, buf_triples, shard)
+    output.close()
+    if binary:
+        shard["bytes"] = output.size
+        shard["crc32"] = output.checksum
+    shard["crc32"] = "%08x" % shard["crc32"]
+    # store remaining dicts as sorted runs
+    write_dict_runs(dicts, languages, chunk_id, runs)
+    if domain:
+        domain.write_run(chunk_id, runs)
+    runs += 1
+    if metrics:
+        metrics.add("chunks_total", 1)
+        metrics.report(force=True)
+    return {
+        "chunk": chunk_id,
+        "start": start,
+        "end": rest[0] if rest else end,
+        "shard": shard,
+        "runs": runs,
+        "lines": total_lines,
+        "seconds": round(time.time() - start_time, 3),
+        "hits": filter_chain.get_hits(),
+        "rest": rest,
+    }
+
+
+def update_filter_metrics(metrics, filter_chain, dicts, lines, sampled, reported):
+    """
+    Update the metrics of the worker after a batch of lines: processed lines and bytes, throughput,
+    pruned triples and (estimated) time per filter, and the sizes of the dicts; report them periodically.
+    The time per filter is measured on the sampled batches only, and extrapolated to all lines.
+    Return: None
+    """
+    metrics.add("lines_total", len(lines))
+    metrics.add("bytes_total", sum(map(len, lines)) + len(lines))
+    if sampled:
+        metrics.add("sampled_lines_total", len(lines))
+    # the filter chain counts per chunk, the metrics per worker
+    for name, count in filter_chain.get_hits().items():
+        metrics.add("filter_hits_total", count - reported.get(("hits", name), 0), filter=name)
+        reported[("hits", name)] = count
+    scale = metrics.get("lines_total") / max(1, metrics.get("sampled_lines_total"))
+    for name, seconds in filter_chain.get_times().items():
+        metrics.add("filter_sampled_seconds_total", seconds - reported.get(("seconds", name), 0.0), filter=name)
+        reported[("seconds", name)] = seconds
+        estimate = metrics.get("filter_sampled_seconds_total", filter=name) * scale
+        metrics.set("filter_seconds", round(estimate, 3), filter=name)
+    labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    for dict_type, language_dicts in (("labels", labels), ("aliases", aliases), ("descriptions", descriptions)):
+        metrics.set("dict_entries", sum(len(dictionary) for dictionary in language_dicts.values()), dict=dict_type)
+    metrics.set("dict_entries", len(wikipedia_mappings), dict="wikipedia_mappings")
+    metrics.set("dict_entries", len(inverse_wikipedia_mappings), dict="inverse_wikipedia_mappings")
+    metrics.update_rates(time.time() - metrics.start_time)
+    metrics.report()
+
+
+def create_dicts(languages):
+    """
+    Create the (empty) dicts of a worker: labels, aliases and descriptions (per language),
+    wikipedia mappings and inverse wikipedia mappings.
+    Return: tuple of dicts
+    """
+    labels = {language: {} for language in languages}
+    aliases = {language: {} for language in languages}
+    descriptions = {language: {} for language in languages}
+    return labels, aliases, descriptions, {}, {}
+
+
+def count_dict_entries(dicts):
+    labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    entries = len(wikipedia_mappings) + len(inverse_wikipedia_mappings)
+    for language_dicts in (labels, aliases, descriptions):
+        entries += sum(len(dictionary) for dictionary in language_dicts.values())
+    return entries
+
+
+def write_dict_runs(dicts, languages, chunk_id, run):
+    """
+    Store the dicts of the chunk as sorted runs (see 'sorted_dicts.write_run').
+    Return: None
+    """
+    labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    for language in languages:
+        write_run(get_run_path(get_dict_name("labels", language), chunk_id, run), labels[language])
+        write_run(get_run_path(get_dict_name("aliases", language), chunk_id, run), aliases[language])
+        write_run(get_run_path(get_dict_name("descriptions", language), chunk_id, run), descriptions[language])
+    write_run(get_run_path("wikipedia_mappings", chunk_id, run), wikipedia_mappings)
+    write_run(get_run_path("inverse_wikipedia_mappings", chunk_id, run), inverse_wikipedia_mappings)
+
+
+def get_run_path(dict_name, chunk_id, run):
+    return os.path.join(PATH_TO_RUNS_DIR, dict_name + "_" + str(chunk_id).zfill(5) + "_" + str(run).zfill(3) + ".tsv")
+
+
+def split_byte_range(start, end, parts):
+    """
+    Split the byte range [start, end) into the given number of (roughly) equally sized ranges.
+    Return: list of (start, end) tuples
+    """
+    parts = max(1, min(parts, end - start))
+    return [(start + (end - start) * i // parts, start + (end - start) * (i + 1) // parts) for i in range(parts)]
+
+
+def get_chunks(file, workers, chunk_size, done=()):
+    """
+    Cut the dump into chunks of (roughly) the given size, at least one per worker.
+    Byte ranges that are done already (e.g. committed by an interrupted run) are left out.
+    Dumps without random access (see 'dump_io.supports_random_access', e.g. a gzip dump of a single member)
+    form a single chunk, since each chunk would decompress the dump from its beginning.
+    Return: list of (start, end) tuples
+    """
+    size = get_dump_size(file)
+    if supports_random_access(file):
+        chunk_size = min(chunk_size, -(-size // workers))
+    else:
+        chunk_size = size
+    chunk_size = max(1, chunk_size)
+    chunks = list()
+    position = 0
+    for start, end in sorted(done) + [(size, size)]:
+        if position < start:
+            chunks += split_byte_range(position, start, -(-(start - position) // chunk_size))
+        position = max(position, end)
+    return chunks
+
+
+def remove_stale_files(results):
+    """
+    Remove shards and dict runs that do not belong to any of the (committed) results,
+    e.g. of chunks interrupted by a crash.
+    Return: None
+    """
+    shard_names = {result["shard"]["name"] for result in results}
+    for name in os.listdir(PATH_TO_OUTPUT_DIR):
+        if name.startswith("shard_") and not name in shard_names:
+            os.remove(os.path.join(PATH_TO_OUTPUT_DIR, name))
+    # runs are identified by chunk ID and run number (see 'get_run_path')
+    run_ids = set()
+    for result in results:
+        run_ids.update((str(result["chunk"]).zfill(5), str(run).zfill(3) + ".tsv") for run in range(result["runs"]))
+    for name in os.listdir(PATH_TO_RUNS_DIR):
+        if not tuple(name.rsplit("_", 2)[1:]) in run_ids:
+            os.remove(os.path.join(PATH_TO_RUNS_DIR, name))
+
+
+def init_worker(ext_id_predicates, geo_predicates):
+    """
+    Initialize a worker process with the identifier predicates and geo predicates of the dump.
+    Return: None
+    """
+    EXT_IDS.update(ext_id_predicates)
+    GEO_PREDS.update(geo_predicates)
+
+
+def prune_chunks(
+    file, workers, filter_config, binary, compression, chunk_size, memory_budget, split_after, checkpoint
+):
+    """
+    Filter the dump with a pool of workers: the dump is cut into chunks (see 'get_chunks'),
+    which are assigned to the workers as they become idle. With split_after (seconds), the rest of a chunk
+    taking longer is split into smaller chunks (one per worker). Per chunk, a line with its range,
+    number of lines and time is appended to the chunk log.
+    Each processed chunk is committed to the checkpoint, and chunks committed by an interrupted run are skipped.
+    Return: list of results (see 'prune_triples'), sorted by the start of the chunks (the order of the dump)
+    """
+    results = get_committed_chunks(checkpoint)
+    remove_stale_files(results)
+    chunk_ids = itertools.count(max([result["chunk"] + 1 for result in results], default=0))
+    committed_ranges = [(result["start"], result["end"]) for result in results]
+    with open(PATH_TO_CHUNK_LOG, "a" if results else "w") as log, concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=init_worker, initargs=(EXT_IDS, GEO_PREDS)
+    ) as executor:
+        futures = set()
+
+        def submit(start, end):
+            args = (file, start, end, next(chunk_ids), filter_config, binary, compression, memory_budget, split_after)
+            futures.add(executor.submit(prune_triples, *args))
+
+        for start, end in get_chunks(file, workers, chunk_size, committed_ranges):
+            submit(start, end)
+        while futures:
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                commit_chunk(checkpoint, log, file, result)
+                if result["rest"]:
+                    for start, end in split_byte_range(*result["rest"], workers):
+                        submit(start, end)
+    return sorted(results, key=lambda result: result["start"])
+
+
+def get_committed_chunks(checkpoint):
+    """
+    Get the results of the chunks committed to the checkpoint (see 'commit_chunk').
+    Return: list of results (see 'prune_triples')
+    """
+    return [checkpoint.get(step) for step in checkpoint.state["steps"] if step.startswith("chunk_")]
+
+
+def commit_chunk(checkpoint, log, file, result):
+    """
+    Commit the processed chunk to the checkpoint, and report it in the chunk log.
+    Return: None
+    """
+    checkpoint.commit("chunk_" + str(result["chunk"]).zfill(5), result)
+    log.write(json.dumps(result) + "\n")
+    log.flush()
+    byte_range = "bytes " + str(result["start"]) + "-" + str(result["end"])
+    statistics = str(result["lines"]) + " lines in " + str(result["seconds"]) + "s"
+    print(file + ": chunk " + str(result["chunk"]) + " (" + byte_range + "): " + statistics)
+
+
+def get_filter_stage_key(file, filter_config, binary, compression):
+    """
+    Get the key of the filter stage (see 'checkpoints.get_stage_key'): the dump, its predicate catalog,
+    and the parameters affecting the shards and dicts.
+    Return: str
+    """
+    return get_stage_key(
+        [file, get_catalog_path(file)], {"filter_config": filter_config, "binary": binary, "compress": compression}
+    )
+
+
+def get_dict_names(languages):
+    dict_names = ["wikipedia_mappings", "inverse_wikipedia_mappings"]
+    for language in languages:
+        dict_names += [get_dict_name(dict_type, language) for dict_type in ["labels", "aliases", "descriptions"]]
+    return dict_names
+
+
+def get_output_paths(dict_names, json_dicts, domain=False):
+    """
+    Get the paths of the outputs of the filter stage: the manifest of the shards and the merged dicts.
+    Return: list of str
+    """
+    output_paths = [os.path.join(PATH_TO_OUTPUT_DIR, MANIFEST_NAME)]
+    if domain:
+        dict_names = [DOMAIN_DICT_NAME] + dict_names
+    output_paths += [get_dict_path(dict_name) + ".tsv" for dict_name in dict_names]
+    if json_dicts:
+        output_paths += [get_dict_path(dict_name) + ".json" for dict_name in dict_names]
+    return output_paths
+
+
+def get_dict_path(dict_name):
+    """
+    Get the path of the merged dict with the given name (without extension).
+    Return: str
+    """
+    if dict_name.endswith("wikipedia_mappings") or dict_name == DOMAIN_DICT_NAME:
+        return os.path.join(PATH_TO_DICTS_DIR, dict_name)
+    return os.path.join(PATH_TO_DICTS_DIR, dict_name + "_dict")
+
+
+def merge_dict(dict_name, chunks, json_dicts, domain=False):
+    """
+    Merge the runs of all chunks for the dict with the given name.
+    The chunks are given as (chunk ID, number of runs), in the order of the dump.
+    Labels and aliases of all chunks are united, for other dicts the value of the last chunk (in the dump) is kept.
+    With domain, only the entries of the entities in the (merged) domain dict are kept.
+    Return: None
+    """
+    path = get_dict_path(dict_name)
+    run_paths = [get_run_path(dict_name, chunk_id, run) for chunk_id, runs in chunks for run in range(runs)]
+    union = dict_name.startswith("labels") or dict_name.startswith("aliases") or dict_name == DOMAIN_DICT_NAME
+    json_path = path + ".json" if json_dicts else None
+    if not domain:
+        merge_runs(run_paths, path + ".tsv", union, json_path=json_path)
+        return
+    domain_entities = SortedDict(get_dict_path(DOMAIN_DICT_NAME) + ".tsv")
+    if dict_name == "inverse_wikipedia_mappings":
+        keep = lambda key, value: value in domain_entities
+    else:
+        keep = lambda key, value: key in domain_entities
+    merge_runs(run_paths, path + ".tsv", union, json_path=json_path, keep=keep)
+    domain_entities.close()
+
+
+def write_shard_buffer(output, buf_triples, shard):
+    """
+    Write the buffered triples into the shard, and update line count and checksum of the shard.
+    For binary shards, size and checksum are kept by the writer.
+    Return: None
+    """
+    if not buf_triples:
+        return
+    if isinstance(output, TripleWriter):
+        output.write([parse_triple(line) for line in buf_triples])
+        shard["lines"] += len(buf_triples)
+        return
+    buf_triples.append(b"")
+    data = b"\n".join(buf_triples)
+    output.write(data)
+    shard["lines"] += len(buf_triples) - 1
+    shard["bytes"] += len(data)
+    shard["crc32"] = zlib.crc32(data, shard["crc32"])
+
+
+def is_domain_restricted(filter_config):
+    return bool(filter_config["domain_classes"] or filter_config["domain_entities"])
+
+
+def load_entity_ids(path):
+    """
+    Load the entity ids in the file (one per line).
+    Return: list of str
+    """
+    with open(path, "r") as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+def get_previous_entity(file, start):
+    """
+    Get the entity of the last line (belonging to an entity) before the given position.
+    Return: bytes (None if there is no such line)
+    """
+    window = PEEK_SIZE
+    while True:
+        entity = None
+        for lines in iter_line_batches(file, max(0, start - window), start):
+            for line in lines:
+                s, p, o = line.split(b" ", 2)
+                entity = get_line_entity(s, p, o) or entity
+        if entity or window >= start:
+            return entity
+        window *= 4
+
+
+class DomainFilter:
+    """
+    Restricts the triples of a chunk to the entities of a domain: the seed entities, and the instances (P31)
+    of the seed classes. The lines kept by the filters are buffered per entity, until the lines of the entity
+    (its statement nodes and sitelinks, and the reference and value nodes following them) end,
+    and only written if the entity belongs to the domain.
+    Each entity is processed by the chunk in which its lines start: a chunk skips the lines of the last entity
+    of the previous chunk, and continues after its end until its own last entity ends (see 'iter_tail').
+    The entities of the domain (and with neighborhood, the entities referenced by their triples) are stored
+    as a dict, to which the other dicts are restricted when they are merged (see 'merge_dict').
+    """
+
+    def __init__(self, config, file, start):
+        self.classes = {entity.encode("utf-8") for entity in config["domain_classes"]}
+        self.seeds = {entity.encode("utf-8") for entity in config["domain_entities"]}
+        self.neighborhood = config["domain_neighborhood"]
+        self.previous = get_previous_entity(file, start) if start else None
+        self.skipping = self.previous is not None
+        self.entity = None
+        self.prefixes = tuple()
+        self.in_domain = False
+        self.lines = list()
+        # entities of the domain and their neighbors (entity id -> roles)
+        self.entities = dict()
+
+    def get_entity(self, s, p, o):
+        # fast path: subject is the current entity or one of its statement nodes
+        if s.startswith(self.prefixes):
+            return self.entity
+        return get_line_entity(s, p, o)
+
+    def next_line(self, s, p, o, buf_triples):
+        """
+        Start the lines of a new entity (writing the buffered lines of the last entity to buf_triples, if
+        it belongs to the domain), and check whether the line makes its entity an instance of a seed class.
+        Return: True if the line belongs to the last entity of the previous chunk (i.e. is skipped)
+        """
+        entity = self.get_entity(s, p, o)
+        if self.skipping:
+            if not entity or entity == self.previous:
+                return True
+            self.skipping = False
+        if entity and entity != self.entity:
+            self.flush(buf_triples)
+            self.entity = entity
+            lower_entity = entity[:1].lower() + entity[1:]
+            self.prefixes = (ENTITY_PREFIX + entity + b">", STATEMENT_PREFIX + entity + b"-")
+            self.prefixes += (STATEMENT_PREFIX + lower_entity + b"-",)
+            self.in_domain = entity in self.seeds
+        if p == TYPE_PREDICATE and not self.in_domain:
+            self.in_domain = get_entity(o) in self.classes
+        return False
+
+    def flush(self, buf_triples):
+        """
+        Write the buffered lines of the current entity to buf_triples, if it belongs to the domain.
+        Return: None
+        """
+        if self.in_domain:
+            buf_triples += self.lines
+            self.entities.setdefault(self.entity.decode("utf-8"), set()).add("domain")
+            if self.neighborhood:
+                for line in self.lines:
+                    neighbor = get_entity(line.split(b" ", 2)[2])
+                    if neighbor and neighbor != self.entity:
+                        self.entities.setdefault(neighbor.decode("utf-8"), set()).add("neighbor")
+        self.in_domain = False
+        self.lines = list()
+
+    def iter_tail(self, file, position):
+        """
+        Iterate over the lines after the chunk (from the given position) that belong to its last entity.
+        Return: generator of lists of lines (bytes)
+        """
+        if self.skipping:
+            return
+        for lines in iter_line_batches(file, position, get_dump_size(file)):
+            for i, line in enumerate(lines):
+                s, p, o = line.split(b" ", 2)
+                entity = self.get_entity(s, p, o)
+                if entity and entity != self.entity:
+                    yield lines[:i]
+                    return
+            yield lines
+
+    def write_run(self, chunk_id, run):
+        write_run(get_run_path(DOMAIN_DICT_NAME, chunk_id, run), self.entities)
+        self.entities = dict()
 
 
 #####################################################
 # Dict Extraction                                   #
 #####################################################
-def extract_english_labels(s, p, o, labels):
-    if re.match(ENGLISH_LABELS_PATTERN, o):
-        if p == "<http://schema.org/name>" or p.endswith("altLabel"):
-            s = s.rsplit("/", 1)[1][:-1]
-            o = o.replace('"', "").split("@")[0]
-            if labels.get(s):
-                labels[s].add(o)
+def get_dict_name(dict_type, language):
+    """
+    Get the name of the dict of the given type (labels, aliases or descriptions) for the language.
+    English dicts keep their original names (e.g. 'labels'), others get a suffix (e.g. 'labels_de').
+    Return: str
+    """
+    if isinstance(language, bytes):
+        language = language.decode("utf-8")
+    if language == "en":
+        return dict_type
+    return dict_type + "_" + language
+
+
+def get_entity_id(s):
+    return s.rsplit(b"/", 1)[1][:-1].decode("utf-8")
+
+
+def extract_labels(s, p, value, language, labels):
+    if language in labels:
+        if p == b"<http://schema.org/name>" or p.endswith(b"altLabel"):
+            s = get_entity_id(s)
+            o = get_literal_text(value)
+            language_labels = labels[language]
+            if language_labels.get(s):
+                language_labels[s].add(o)
             else:
-                labels[s] = set()
-                labels[s].add(o)
+                language_labels[s] = set()
+                language_labels[s].add(o)
 
 
-def extract_english_aliases(s, p, o, aliases):
+def extract_aliases(s, p, value, language, aliases):
     # this method needs to be placed after the filter_non_wikidata_subjects function
-    if "abel" in p and re.match(ENGLISH_LABELS_PATTERN, o):
-        s = s.rsplit("/", 1)[1][:-1]
-        o = o.replace('"', "").split("@")[0]
-        if aliases.get(s):
-            aliases[s].add(o)
+    if language in aliases and p.find(b"abel") != -1:
+        s = get_entity_id(s)
+        o = get_literal_text(value)
+        language_aliases = aliases[language]
+        if language_aliases.get(s):
+            language_aliases[s].add(o)
         else:
-            aliases[s] = set()
-            aliases[s].add(o)
+            language_aliases[s] = set()
+            language_aliases[s].add(o)
 
 
-def extract_english_descriptions(s, p, o, descriptions):
-    if p == "<http://schema.org/description>" and re.match(ENGLISH_LABELS_PATTERN, o):
-        s = s.rsplit("/", 1)[1][:-1]
-        o = o.replace('"', "").split("@")[0]
-        descriptions[s] = o
+def extract_descriptions(s, p, value, language, descriptions):
+    if language in descriptions and p == b"<http://schema.org/description>":
+        s = get_entity_id(s)
+        o = get_literal_text(value)
+        descriptions[language][s] = o
 
 
 def extract_wikipedia_mappings(s, p, o, wikipedia, inverse_wikipedia_mappings):
-    if p != "<http://schema.org/about>":
+    if p != b"<http://schema.org/about>":
         return
-    if s.startswith("<https://en.wikipedia.org/wiki/") and o.startswith("<http://www.wikidata.org/entity/"):
-        wikipedia_name = s.replace("<https://en.wikipedia.org/wiki/", "")[:-1]
-        wikidata_id = o.rsplit("/", 1)[1][:-4]
+    if s.startswith(b"<https://en.wikipedia.org/wiki/") and o.startswith(b"<http://www.wikidata.org/entity/"):
+        wikipedia_name = s[len(b"<https://en.wikipedia.org/wiki/") : -1].decode("utf-8")
+        wikidata_id = o.rsplit(b"/", 1)[1][:-3].decode("utf-8")
         wikipedia[wikidata_id] = wikipedia_name
         inverse_wikipedia_mappings[wikipedia_name] = wikidata_id
 
@@ -198,193 +684,377 @@ def extract_wikipedia_mappings(s, p, o, wikipedia, inverse_wikipedia_mappings):
 # Filters                                                #
 # more fine-grained than required for easier adjustment  #
 ##########################################################
+# Note: subjects and predicates are IRIs, which cannot contain "<" in n-triples.
+# Hence, a subject or predicate contains one of the IRIs below if and only if it starts with it.
 def filter_non_wikidata_subjects(s):
-    if not "<http://www.wikidata.org/entity/" in s:
+    if not s.startswith(b"<http://www.wikidata.org/entity/"):
         return True
     return False
 
 
 def filter_non_wikidata_id_subjects(s):
-    if "<http://www.wikidata.org/entity/" in s:
-        return False
-    if "<http://www.wikidata.org/entity/statement/" in s:
+    if s.startswith(b"<http://www.wikidata.org/entity/"):
         return False
     return True
 
 
-def filter_schema_predicates(p):
-    if "<http://www.w3.org" in p:
-        return True
-    if "<http://wikiba.se" in p:
-        return True
-    if "<http://schema.org" in p:
-        return True
-    return False
+# The filters applied to the triples (after the dict extraction).
+# Each filter is given as a condition on the subject s, the predicate p and
+# the object o (+ " .", the line ending) of a triple, which holds if the triple should be pruned.
+# The primary subtag of the language of o (empty if o has no language tag) is given as language.
+# Conditions can use the terms in FILTER_TERMS, which are computed at most once per triple.
+# The filters are selected via a filter config (see 'load_filter_config'), and the selected
+# conditions are compiled into a single function (see 'FilterChain').
+FILTERS = {
+    "predicates_as_subjects": "s.startswith(PREDICATE_SUBJECT_PREFIXES)",
+    "schema_predicates": "p.startswith(SCHEMA_PREDICATE_PREFIXES)",
+    "values": 'b"<http://www.wikidata.org/value" in o',
+    "labels": "language and not language in LANGUAGES",
+    "references": 'b"<http://www.wikidata.org/reference" in o',
+    "uri_objects": 'not o.startswith(b"<http://www.wikidata.org") and (o.startswith(b"<http") or URI_PATTERN.match(o))',
+    "external_id_predicates": "p_id in EXT_IDS",
+    "unknown_values": 'b"_:genid" in o',
+    "geo_predicates": "p_id in GEO_PREDS",
+    "other_objects": (
+        'not o.startswith(b\'"\')'
+        ' and not b"<http://www.wikidata.org/entity/Q" in o'
+        ' and not b"<http://www.wikidata.org/entity/statement/Q" in o'
+    ),
+    # additional filters (not active by default)
+    "qualifiers": 'p.startswith(b"<http://www.wikidata.org/prop/qualifier/")',
+    "blocked_entities": "s_entity in BLOCKED_ENTITIES or o_entity in BLOCKED_ENTITIES",
+}
+FILTER_TERMS = {
+    "p_id": 'p.rsplit(b"/", 1)[1][:-1]',
+    "s_entity": "get_entity(s)",
+    "o_entity": "get_entity(o)",
+}
+DEFAULT_FILTERS = [
+    "predicates_as_subjects",
+    "schema_predicates",
+    "values",
+    "labels",
+    "references",
+    "uri_objects",
+    "external_id_predicates",
+    "unknown_values",
+    "geo_predicates",
+    "other_objects",
+]
+PREDICATE_SUBJECT_PREFIXES = (
+    b"<http://www.wikidata.org/entity/P",
+    b"<http://www.wikidata.org/entity/p",
+    b"<http://www.wikidata.org/entity/statement/P",
+    b"<http://www.wikidata.org/entity/statement/p",
+)
+SCHEMA_PREDICATE_PREFIXES = (b"<http://www.w3.org", b"<http://wikiba.se", b"<http://schema.org")
+ENTITY_PREFIX = b"<http://www.wikidata.org/entity/"
+STATEMENT_PREFIX = b"<http://www.wikidata.org/entity/statement/"
+SCHEMA_ABOUT = b"<http://schema.org/about>"
+TYPE_PREDICATE = b"<http://www.wikidata.org/prop/direct/P31>"
+# number of triples after which the filters are reordered by their number of pruned triples
+ADAPTIVE_ORDERING_INTERVAL = 100000
+# with metrics, the time per filter is measured on every n-th batch of lines
+METRICS_SAMPLING_INTERVAL = 8
 
 
-def filter_external_id_predicates(p):
-    if p.rsplit("/", 1)[1][:-1] in EXT_IDS:
-        return True
-    return False
-
-
-def filter_uri_objects(o):
-    if o.startswith("<http://www.wikidata.org"):
-        return False
-    if o.startswith("<http"):
-        return True
-    if re.match(URI_PATTERN, o):
-        return True
-    return False
-
-
-def filter_non_english_labels(o):
-    if re.match(ENGLISH_LABELS_PATTERN, o):
-        return False
-    if re.match(LABELS_PATTERN, o):
-        return True
-    return False
-
-
-def filter_predicates_as_subjects(s):
-    if "<http://www.wikidata.org/entity/P" in s:
-        return True
-    if "<http://www.wikidata.org/entity/p" in s:
-        return True
-    if "<http://www.wikidata.org/entity/statement/P" in s:
-        return True
-    if "<http://www.wikidata.org/entity/statement/p" in s:
-        return True
-    return False
-
+def get_entity(term):
+    """
+    Get the id of the wikidata entity the given term refers to.
+    Statement nodes (e.g. 'q42-...') refer to the entity they belong to ('Q42').
+    Return: bytes (empty for other terms)
+    """
+    if term.startswith(STATEMENT_PREFIX):
+        entity = term[len(STATEMENT_PREFIX) :].split(b"-", 1)[0]
+        return entity[:1].upper() + entity[1:]
+    if term.startswith(ENTITY_PREFIX):
+        return term[len(ENTITY_PREFIX) :].split(b">", 1)[0]
+    return b""
 
-def filter_values(s, o):
-    if "<http://www.wikidata.org/value" in o:
-        return True
-    return False
 
+def get_line_entity(s, p, o):
+    """
+    Get the entity the line belongs to: the entity of its subject (see 'get_entity'),
+    or for sitelinks, the entity they are about.
+    Return: bytes (empty for other lines, e.g. of reference and value nodes)
+    """
+    entity = get_entity(s)
+    if not entity and p == SCHEMA_ABOUT:
+        return get_entity(o)
+    return entity
 
-def filter_references(s, o):
-    if "<http://www.wikidata.org/reference" in o:
-        return True
-    return False
 
+def load_filter_config(path=None):
+    """
+    Load the filter config from the given path (JSON).
+    The config can contain:
+        "filters": list of the names of the filters to apply (see FILTERS), default: DEFAULT_FILTERS
+        "blocked_entities": list of entity ids pruned by the "blocked_entities" filter
+        "adaptive_ordering": whether filters are reordered by their number of pruned triples, default: true
+        "languages": list of languages for which labels, aliases and descriptions are extracted,
+                     and literals are kept in the dump, default: ["en"]
+        "domain_classes": list of class ids, whose instances (P31) are kept, with the "domain_entities"
+        "domain_entities": list of entity ids that are kept; with classes or entities, all other entities are pruned
+                           (see 'DomainFilter'), default: no domain
+        "domain_neighborhood": whether the dicts also contain the entities referenced by the domain, default: false
+    Return: dict
+    """
+    config = dict()
+    if path:
+        with open(path, "r") as fp:
+            config = json.load(fp)
+    config.setdefault("filters", list(DEFAULT_FILTERS))
+    config.setdefault("blocked_entities", list())
+    config.setdefault("adaptive_ordering", True)
+    config.setdefault("languages", ["en"])
+    config.setdefault("domain_classes", list())
+    config.setdefault("domain_entities", list())
+    config.setdefault("domain_neighborhood", False)
+    unknown_filters = [name for name in config["filters"] if not name in FILTERS]
+    if unknown_filters:
+        raise ValueError("Unknown filters in filter config: " + ", ".join(unknown_filters))
+    return config
 
-def filter_unknown_values(s, o):
-    if "_:genid" in o:
-        return True
-    return False
 
+class FilterChain:
+    """
+    Compiles the selected filters into a single classifier.
+    The classifier computes the required terms (e.g. the predicate id) once per triple,
+    evaluates the conditions of the filters in order, and returns the index of the first
+    filter that prunes the triple (or -1 if the triple is kept).
+    With adaptive ordering, the filters pruning most triples are moved to the front.
+    With timed, a second classifier is compiled, which additionally accumulates the time spent
+    in the condition of each filter (used for sampled batches, if metrics are enabled).
+    """
 
-def filter_geo_predicates(p):
-    if p.rsplit("/", 1)[1][:-1] in GEO_PREDS:
-        return True
-    return False
+    def __init__(self, config, timed=False):
+        self.filters = list(config["filters"])
+        self.adaptive_ordering = config["adaptive_ordering"]
+        self.timed = timed
+        self.hits = [0] * len(self.filters)
+        self.times = [0.0] * len(self.filters)
+        self.namespace = {
+            "PREDICATE_SUBJECT_PREFIXES": PREDICATE_SUBJECT_PREFIXES,
+            "SCHEMA_PREDICATE_PREFIXES": SCHEMA_PREDICATE_PREFIXES,
+            "LANGUAGES": {language.encode("utf-8") for language in config["languages"]},
+            "URI_PATTERN": URI_PATTERN,
+            "EXT_IDS": EXT_IDS,
+            "GEO_PREDS": GEO_PREDS,
+            "BLOCKED_ENTITIES": {entity.encode("utf-8") for entity in config["blocked_entities"]},
+            "get_entity": get_entity,
+            "perf_counter": time.perf_counter,
+        }
+        self.classify = self.compile()
+        self.classify_timed = self.compile(timed=True) if timed else None
 
+    def compile(self, timed=False):
+        conditions = [FILTERS[name] for name in self.filters]
+        source = ["def classify(s, p, o, language):"]
+        for term, expression in FILTER_TERMS.items():
+            if any(re.search(r"\b" + term + r"\b", condition) for condition in conditions):
+                source.append("    " + term + " = " + expression)
+        for index, condition in enumerate(conditions):
+            if timed:
+                source.append("    start = perf_counter()")
+                source.append("    if " + condition + ":")
+                source.append("        TIMES[" + str(index) + "] += perf_counter() - start")
+                source.append("        return " + str(index))
+                source.append("    TIMES[" + str(index) + "] += perf_counter() - start")
+            else:
+                source.append("    if " + condition + ":")
+                source.append("        return " + str(index))
+        source.append("    return -1")
+        self.namespace["TIMES"] = self.times
+        exec("\n".join(source), self.namespace)
+        return self.namespace["classify"]
 
-def filter_other_objects(o):
-    if (
-        not o[0] == '"'
-        and not "<http://www.wikidata.org/entity/Q" in o
-        and not "<http://www.wikidata.org/entity/statement/Q" in o
-    ):
-        return True
-    return False
+    def adapt(self):
+        """
+        Reorder the filters by their number of pruned triples (descending), and recompile.
+        The result of the chain does not depend on the order of the filters.
+        Return: None
+        """
+        if not self.adaptive_ordering:
+            return
+        order = sorted(range(len(self.filters)), key=lambda index: -self.hits[index])
+        if order == sorted(order):
+            return
+        self.filters = [self.filters[index] for index in order]
+        self.hits = [self.hits[index] for index in order]
+        self.times = [self.times[index] for index in order]
+        self.classify = self.compile()
+        if self.timed:
+            self.classify_timed = self.compile(timed=True)
 
+    def get_hits(self):
+        return dict(zip(self.filters, self.hits))
 
-def filter_labels(o):
-    if re.match(LABELS_PATTERN, o):
-        return True
-    return False
+    def get_times(self):
+        return dict(zip(self.filters, self.times))
 
 
 #####################################################
 # MAIN                                              #
 #####################################################
 if __name__ == "__main__":
-    workers = len(FILES)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wikidata_dump_path")
+    parser.add_argument("number_of_workers", type=int)
+    parser.add_argument(
+        "--filter-config",
+        help="path to a JSON file selecting the filters to apply (by default, all filters except the additional ones)",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        help="languages for which labels, aliases and descriptions are extracted (overrides the filter config)",
+    )
+    parser.add_argument(
+        "--domain-classes",
+        nargs="+",
+        metavar="CLASS",
+        help="keep only the instances (P31) of the given classes (and the --domain-entities), overrides the config",
+    )
+    parser.add_argument(
+        "--domain-entities",
+        metavar="PATH",
+        help="keep only the entities listed in the file (one id per line), and the instances of the --domain-classes",
+    )
+    parser.add_argument(
+        "--domain-neighborhood",
+        action="store_true",
+        help="additionally keep the labels (and other dict entries) of the entities referenced by the domain",
+    )
+    parser.add_argument(
+        "--json-dicts",
+        action="store_true",
+        help="additionally store the merged dicts as JSON objects (e.g. dicts/labels_dict.json)",
+    )
+    parser.add_argument(
+        "--concatenate",
+        action="store_true",
+        help="concatenate the output shards into " + PATH_TO_OUTPUT_FILE,
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the output shards as (normalized) binary triples, which are read by resolve_qualifiers.py",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="compress the (n-triples) output shards; zstd requires the zstandard package",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE >> 20,
+        help="size (in MB) of the chunks of the dump, which are assigned to idle workers",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) per worker for the dicts, before they are stored as sorted runs",
+    )
+    parser.add_argument(
+        "--split-slow-chunks",
+        type=float,
+        metavar="SECONDS",
+        help="split the rest of chunks taking longer than the given time into smaller chunks for idle workers",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the checkpoint of a previous run, and filter the whole dump again",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="write metrics of the workers (e.g. hits and time per filter) periodically to DIR (see metrics.py)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="with --metrics, sample the stacks of the workers every SECONDS (CPU time) into DIR",
+    )
+    add_io_arguments(parser)
+    args = parser.parse_args()
+    if args.profile and not args.metrics:
+        parser.error("--profile requires --metrics")
+    if args.binary and args.concatenate:
+        parser.error("--concatenate requires n-triples shards")
+    if args.binary and args.compress:
+        parser.error("--compress requires n-triples shards (binary shards are compressed already)")
+    WIKIDATA_DUMP_PATH = args.wikidata_dump_path
+    workers = args.number_of_workers
+    if args.metrics:
+        configure(args.metrics, args.profile)
+    configure_io_from_args(args)
+    ext_id_predicates, geo_predicates = load_special_predicates(WIKIDATA_DUMP_PATH)
+    EXT_IDS.update(p.encode("utf-8") for p in ext_id_predicates)
+    GEO_PREDS.update(p.encode("utf-8") for p in geo_predicates)
+    filter_config = load_filter_config(args.filter_config)
+    if args.languages:
+        filter_config["languages"] = args.languages
+    if args.domain_classes:
+        filter_config["domain_classes"] = args.domain_classes
+    if args.domain_entities:
+        filter_config["domain_entities"] = load_entity_ids(args.domain_entities)
+    if args.domain_neighborhood:
+        filter_config["domain_neighborhood"] = True
+    domain = is_domain_restricted(filter_config)
+    dict_names = get_dict_names(filter_config["languages"])
+    output_paths = get_output_paths(dict_names, args.json_dicts, domain)
+    if args.concatenate:
+        output_paths.append(PATH_TO_OUTPUT_FILE + COMPRESSION_EXTENSIONS.get(args.compress, ""))
+    #############################################################
+    # Continue from the checkpoint of an interrupted run        #
+    #############################################################
+    stage_key = get_filter_stage_key(WIKIDATA_DUMP_PATH, filter_config, args.binary, args.compress)
+    checkpoint = Checkpoint("filter_wikidata", stage_key, restart=args.restart)
+    if checkpoint.is_finished(output_paths):
+        print("Dump was filtered already with the same inputs, skipping filter_wikidata.py (see --restart)")
+        sys.exit()
     start_time = time.time()
-    processes = []
+    os.makedirs(PATH_TO_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(PATH_TO_RUNS_DIR, exist_ok=True)
     #############################################################
-    # Start processes for different partitions of the dump      #
+    # Process the chunks of the dump with a pool of workers     #
     #############################################################
-    for i in range(workers):
-        print(FILES[i])
-        p = Process(
-            target=prune_triples,
-            args=(
-                FILES[i],
-                i,
-            ),
-        )
-        processes.append(p)
-        p.start()
-    #########################
-    # Join all threads      #
-    #########################
-    for i in range(workers):
-        processes[i].join()
+    results = prune_chunks(
+        WIKIDATA_DUMP_PATH,
+        workers,
+        filter_config,
+        args.binary,
+        args.compress,
+        args.chunk_size << 20,
+        args.memory_budget << 20,
+        args.split_slow_chunks,
+        checkpoint,
+    )
+    write_manifest(PATH_TO_OUTPUT_DIR, [result["shard"] for result in results])
+    if args.concatenate:
+        concatenate_shards(PATH_TO_OUTPUT_DIR, PATH_TO_OUTPUT_FILE + COMPRESSION_EXTENSIONS.get(args.compress, ""))
     end = time.time()
     ###############################################
     # Merge extracted dicts from all workers      #
     ###############################################
-    labels = {}
-    aliases = {}
-    descriptions = {}
-    wikipedia_mappings = {}
-    inverse_wikipedia_mappings = {}
-    for i in range(workers):
-        # load label dict for worker
-        with open("dicts/labels_" + str(i) + ".json", "r") as file:
-            tmp_labels = json.load(file)
-            for k in tmp_labels:
-                if labels.get(k):
-                    labels[k] += tmp_labels[k]
-                else:
-                    labels[k] = tmp_labels[k]
-        # load aliases dict for worker
-        with open("dicts/aliases_" + str(i) + ".json", "r") as file:
-            tmp_aliases = json.load(file)
-            for k in tmp_aliases:
-                if aliases.get(k):
-                    aliases[k] += tmp_aliases[k]
-                else:
-                    aliases[k] = tmp_aliases[k]
-        # load description dict for worker
-        with open("dicts/descriptions_" + str(i) + ".json", "r") as file:
-            tmp_description = json.load(file)
-            descriptions.update(tmp_description)
-        # load label dict for worker
-        with open("dicts/wikipedia_mappings_" + str(i) + ".json", "r") as file:
-            tmp_wikipedia_mappings = json.load(file)
-            wikipedia_mappings.update(tmp_wikipedia_mappings)
-        # load description dict for worker
-        with open("dicts/inverse_wikipedia_mappings_" + str(i) + ".json", "r") as file:
-            tmp_inverse_wikipedia_mappings = json.load(file)
-            inverse_wikipedia_mappings.update(tmp_inverse_wikipedia_mappings)
-        # remove worker-dicts
-        os.remove("dicts/labels_" + str(i) + ".json")
-        os.remove("dicts/aliases_" + str(i) + ".json")
-        os.remove("dicts/descriptions_" + str(i) + ".json")
-        os.remove("dicts/wikipedia_mappings_" + str(i) + ".json")
-        os.remove("dicts/inverse_wikipedia_mappings_" + str(i) + ".json")
-    #########################
-    # Store all dicts       #
-    #########################
-    # store labels dict
-    with open("dicts/labels_dict.json", "w") as outfile:
-        outfile.write(json.dumps(labels, separators=(",", ":")))
-    # store aliases dict
-    with open("dicts/aliases_dict.json", "w") as outfile:
-        outfile.write(json.dumps(aliases, separators=(",", ":")))
-    # store description dict
-    with open("dicts/descriptions_dict.json", "w") as outfile:
-        outfile.write(json.dumps(descriptions, separators=(",", ":")))
-    # store wikipedia_mappings dict
-    with open("dicts/wikipedia_mappings.json", "w") as outfile:
-        outfile.write(json.dumps(wikipedia_mappings, separators=(",", ":")))
-    # store inverse_wikipedia_mappings dict
-    with open("dicts/inverse_wikipedia_mappings.json", "w") as outfile:
-        outfile.write(json.dumps(inverse_wikipedia_mappings, separators=(",", ":")))
+    chunks = [(result["chunk"], result["runs"]) for result in results]
+    # the other dicts are restricted to the entities in the domain dict
+    if domain and not checkpoint.is_done("merge_" + DOMAIN_DICT_NAME):
+        merge_dict(DOMAIN_DICT_NAME, chunks, args.json_dicts)
+        checkpoint.commit("merge_" + DOMAIN_DICT_NAME)
+    dict_names = [dict_name for dict_name in dict_names if not checkpoint.is_done("merge_" + dict_name)]
+    with concurrent.futures.ProcessPoolExecutor(max(1, min(workers, len(dict_names)))) as executor:
+        futures = {
+            executor.submit(merge_dict, dict_name, chunks, args.json_dicts, domain): dict_name
+            for dict_name in dict_names
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            checkpoint.commit("merge_" + futures[future])
+    checkpoint.finish(output_paths)
 
     print("Time(filter_wikidata): " + str(end - start_time))
@@ -0,0 +1,351 @@
+"""
+Generate a synthetic n-triples dump shaped like the Wikidata dump, e.g. as test data or for benchmarks
+(see 'benchmark').
+The dump starts with the property entities (with their propertyType triples), followed by the item entities,
+each as a contiguous block: labels, aliases and descriptions in several languages (with region subtags),
+Wikipedia links (schema.org/about), direct claims, and statement nodes with their ps:/pq: triples,
+references, value nodes, external identifiers, coordinates, unknown values (_:genid) and long literals.
+The output is deterministic for a given seed and parameters. With skew, both the number of statements per entity
+(heavy-tailed) and the popularity of properties and objects (Zipf distributed) are skewed; 0 makes them uniform.
+The dump is compressed depending on the extension of the output path (.gz, .bz2).
+With hubs, the first entities get a fixed (large) number of statements, with objects drawn from all entities.
+Presets (see PRESETS) select the parameters of special shapes, e.g. "hub": 10 hub entities with 5000 statements each
+(on which duplicate pruning was quadratic in the degree of the subject).
+"""
+
+import argparse
+import itertools
+import random
+import time
+from bisect import bisect
+
+from dump_io import open_output
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+ENTITY = "http://www.wikidata.org/entity/"
+PROP = "http://www.wikidata.org/prop/"
+WIKIBASE = "http://wikiba.se/ontology#"
+SCHEMA = "http://schema.org/"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+RDF_TYPE = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+RDFS_LABEL = "<http://www.w3.org/2000/01/rdf-schema#label>"
+SKOS_PREF_LABEL = "<http://www.w3.org/2004/02/skos/core#prefLabel>"
+SKOS_ALT_LABEL = "<http://www.w3.org/2004/02/skos/core#altLabel>"
+WAS_DERIVED_FROM = "<http://www.w3.org/ns/prov#wasDerivedFrom>"
+WKT_LITERAL = "<http://www.opengis.net/ont/geosparql#wktLiteral>"
+# property types with their share among the properties (P31 is always an item property)
+PROPERTY_TYPES = {
+    "WikibaseItem": 30,
+    "ExternalId": 40,
+    "String": 6,
+    "Time": 5,
+    "Quantity": 5,
+    "Monolingualtext": 3,
+    "Url": 3,
+    "CommonsMedia": 3,
+    "GlobeCoordinate": 2,
+    "GeoShape": 1,
+    "WikibaseProperty": 2,
+}
+DEFAULT_LANGUAGES = ["en", "de", "fr", "es", "it", "ja", "ru", "en-gb", "de-ch", "pt-br"]
+WIKIPEDIA_LANGUAGES = ["en", "de", "fr", "es"]
+WORDS = ["river", "city", "ümlaut", "Straße", "human", "film", "album", "東京", "Москва", "band", "galaxy"]
+MAX_STATEMENTS = 5000
+WRITE_BATCH_SIZE = 100000
+# parameters of generate_dump for special shapes of the dump
+PRESETS = {
+    "hub": {"entities": 2000, "skew": 0.0, "hubs": 10, "hub_statements": 5000},
+}
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def get_zipf_weights(number, skew):
+    """
+    Compute the cumulative weights of the ranks 1..number, Zipf distributed with the given exponent.
+    Return: list of float
+    """
+    return list(itertools.accumulate(1 / rank**skew for rank in range(1, number + 1)))
+
+
+def draw_rank(rng, cumulative_weights):
+    """
+    Draw a rank (starting at 1) from the cumulative weights.
+    Return: int
+    """
+    return bisect(cumulative_weights, rng.random() * cumulative_weights[-1]) + 1
+
+
+def draw_statement_count(rng, statements, skew):
+    """
+    Draw the number of statements of an entity: Pareto distributed with the given mean (skew 0: always the mean).
+    Return: int
+    """
+    if not skew:
+        return statements
+    alpha = 1 + 1 / skew
+    return min(MAX_STATEMENTS, max(1, int(statements * (alpha - 1) / alpha * rng.paretovariate(alpha))))
+
+
+def get_guid(rng):
+    guid = "%032X" % rng.getrandbits(128)
+    return "-".join([guid[:8], guid[8:12], guid[12:16], guid[16:20], guid[20:]])
+
+
+def get_text(rng, entity_id, length=3):
+    return " ".join([entity_id] + [rng.choice(WORDS) for _ in range(length)])
+
+
+def get_property_types(rng, properties):
+    """
+    Assign a type to each property (P1..Pn).
+    Return: dict (property number -> type)
+    """
+    names = list(PROPERTY_TYPES)
+    weights = list(PROPERTY_TYPES.values())
+    property_types = {number: rng.choices(names, weights)[0] for number in range(1, properties + 1)}
+    property_types[31] = "WikibaseItem"
+    return property_types
+
+
+def generate_property(rng, number, property_type, languages):
+    """
+    Generate the triples of a property entity.
+    Return: list of lines
+    """
+    s = "<" + ENTITY + "P" + str(number) + ">"
+    lines = [
+        s + " " + RDF_TYPE + " <" + WIKIBASE + "Property> .",
+        s + " <" + WIKIBASE + "propertyType> <" + WIKIBASE + property_type + "> .",
+        s + " <" + WIKIBASE + "directClaim> <" + PROP + "direct/P" + str(number) + "> .",
+        s + " <" + WIKIBASE + "claim> <" + PROP + "P" + str(number) + "> .",
+    ]
+    for language in languages[:3]:
+        label = '"property ' + str(number) + " " + rng.choice(WORDS) + '"@' + language
+        lines.append(s + " " + RDFS_LABEL + " " + label + " .")
+        lines.append(s + " <" + SCHEMA + "name> " + label + " .")
+    return lines
+
+
+def generate_value(rng, property_type, entity_id, object_id, long_literals):
+    """
+    Generate the (direct) value of a statement with a property of the given type,
+    and the triples of its value node (for times, quantities and coordinates).
+    Return: (value, value node triples)
+    """
+    if property_type in ("WikibaseItem", "WikibaseProperty"):
+        prefix = "Q" if property_type == "WikibaseItem" else "P"
+        return "<" + ENTITY + prefix + str(object_id) + ">", []
+    value_node = "<http://www.wikidata.org/value/" + "%032x" % rng.getrandbits(128) + ">"
+    if property_type == "Time":
+        value = '"+' + str(rng.randint(1000, 2025)) + '-01-01T00:00:00Z"^^<' + XSD + "dateTime>"
+        return value, [(value_node, "<" + WIKIBASE + "timeValue>", value)]
+    if property_type == "Quantity":
+        value = '"+' + str(rng.randint(0, 10**9)) + '"^^<' + XSD + "decimal>"
+        return value, [(value_node, "<" + WIKIBASE + "quantityAmount>", value)]
+    if property_type == "GlobeCoordinate":
+        point = "%.4f %.4f" % (rng.uniform(-180, 180), rng.uniform(-90, 90))
+        value = '"Point(' + point + ')"^^' + WKT_LITERAL
+        latitude = '"' + point.split()[1] + '"^^<' + XSD + "double>"
+        return value, [(value_node, "<" + WIKIBASE + "geoLatitude>", latitude)]
+    if property_type == "GeoShape":
+        return "<http://commons.wikimedia.org/data/main/Data:" + entity_id + ".map>", []
+    if property_type == "ExternalId":
+        return '"' + str(rng.getrandbits(32)) + '"', []
+    if property_type == "Url":
+        return "<https://example.org/" + entity_id + "/" + str(rng.getrandbits(16)) + ">", []
+    if property_type == "CommonsMedia":
+        return "<http://commons.wikimedia.org/wiki/Special:FilePath/" + entity_id + ".jpg>", []
+    if property_type == "Monolingualtext":
+        return '"' + get_text(rng, entity_id) + '"@' + rng.choice(["en", "de", "fr"]), []
+    # strings, some of them long (with escaped quotes and commas)
+    if rng.random() < long_literals:
+        return '"' + ', \\"'.join(get_text(rng, entity_id, 8) for _ in range(rng.randint(10, 40))) + '"', []
+    return '"' + get_text(rng, entity_id) + '"', []
+
+
+def generate_entity(rng, number, settings):
+    """
+    Generate the triples of an item entity (Q<number>) and its statement nodes.
+    Return: list of lines
+    """
+    entity_id = "Q" + str(number)
+    s = "<" + ENTITY + entity_id + ">"
+    lines = [s + " " + RDF_TYPE + " <" + WIKIBASE + "Item> ."]
+    # sitelinks
+    for language in rng.sample(WIKIPEDIA_LANGUAGES, rng.randint(0, len(WIKIPEDIA_LANGUAGES))):
+        article = "<https://" + language + ".wikipedia.org/wiki/" + get_text(rng, entity_id, 1).replace(" ", "_") + ">"
+        lines.append(article + " <" + SCHEMA + "about> " + s + " .")
+        lines.append(article + " <" + SCHEMA + "inLanguage> " + '"' + language + '" .')
+        lines.append(article + " <" + SCHEMA + "isPartOf> <https://" + language + ".wikipedia.org/> .")
+    # labels, aliases and descriptions
+    languages = settings["languages"]
+    for language in rng.sample(languages, rng.randint(1, len(languages))):
+        label = '"' + get_text(rng, entity_id, 2).replace(" ", ", ", 1) + '"@' + language
+        lines.append(s + " " + RDFS_LABEL + " " + label + " .")
+        lines.append(s + " " + SKOS_PREF_LABEL + " " + label + " .")
+        lines.append(s + " <" + SCHEMA + "name> " + label + " .")
+        for _ in range(rng.randint(0, 2)):
+            lines.append(s + " " + SKOS_ALT_LABEL + ' "' + get_text(rng, entity_id, 1) + '"@' + language + " .")
+        description = '"' + get_text(rng, entity_id, 4) + ' \\"quoted\\"' + '"@' + language
+        lines.append(s + " <" + SCHEMA + "description> " + description + " .")
+    lines.append(s + " <" + SCHEMA + "version> " + '"' + str(rng.getrandbits(30)) + '"^^<' + XSD + "integer> .")
+    # statements, with their statement nodes after the direct claims of the entity
+    statement_lines = []
+    # each entity is an instance of some class (P31), the popular entities serve as classes
+    if number <= settings["hubs"]:
+        statement_count = settings["hub_statements"]
+    else:
+        statement_count = draw_statement_count(rng, settings["statements"], settings["skew"])
+    property_numbers = [31] + [draw_rank(rng, settings["property_weights"]) for _ in range(statement_count - 1)]
+    for property_number in property_numbers:
+        property_type = settings["property_types"][property_number]
+        p = "P" + str(property_number)
+        object_id = draw_rank(rng, settings["entity_weights"])
+        if property_type == "WikibaseProperty":
+            object_id = draw_rank(rng, settings["property_weights"])
+        if rng.random() < settings["unknown_values"]:
+            value, value_triples = "_:genid" + "%032x" % rng.getrandbits(128), []
+        else:
+            value, value_triples = generate_value(rng, property_type, entity_id, object_id, settings["long_literals"])
+        statement = "<" + ENTITY + "statement/" + entity_id + "-" + get_guid(rng) + ">"
+        lines.append(s + " <" + PROP + "direct/" + p + "> " + value + " .")
+        if property_type == "ExternalId" and value.startswith('"'):
+            normalized = "<https://example.org/id/" + p + "/" + value.strip('"') + ">"
+            lines.append(s + " <" + PROP + "direct-normalized/" + p + "> " + normalized + " .")
+        lines.append(s + " <" + PROP + p + "> " + statement + " .")
+        statement_lines.append(statement + " " + RDF_TYPE + " <" + WIKIBASE + "Statement> .")
+        statement_lines.append(statement + " <" + PROP + "statement/" + p + "> " + value + " .")
+        statement_lines.append(statement + " <" + WIKIBASE + "rank> <" + WIKIBASE + "NormalRank> .")
+        for value_node, predicate, node_value in value_triples:
+            statement_lines.append(statement + " <" + PROP + "statement/value/" + p + "> " + value_node + " .")
+            statement_lines.append(value_node + " " + predicate + " " + node_value + " .")
+        while rng.random() < settings["qualifiers"]:
+            qualifier_number = draw_rank(rng, settings["property_weights"])
+            qualifier_type = settings["property_types"][qualifier_number]
+            qualifier_object = draw_rank(rng, settings["entity_weights"])
+            qualifier_value = generate_value(rng, qualifier_type, entity_id, qualifier_object, 0)[0]
+            qualifier = "<" + PROP + "qualifier/P" + str(qualifier_number) + ">"
+            statement_lines.append(statement + " " + qualifier + " " + qualifier_value + " .")
+        if rng.random() < 0.5:
+            reference = "<http://www.wikidata.org/reference/" + "%040x" % rng.getrandbits(160) + ">"
+            statement_lines.append(statement + " " + WAS_DERIVED_FROM + " " + reference + " .")
+            source = "<" + ENTITY + "Q" + str(draw_rank(rng, settings["entity_weights"])) + ">"
+            statement_lines.append(reference + " <" + PROP + "reference/P248> " + source + " .")
+    return lines + statement_lines
+
+
+def generate_dump(
+    path,
+    entities,
+    properties=200,
+    seed=0,
+    skew=1.0,
+    statements=8,
+    languages=DEFAULT_LANGUAGES,
+    qualifiers=0.3,
+    unknown_values=0.01,
+    long_literals=0.01,
+    hubs=0,
+    hub_statements=MAX_STATEMENTS,
+):
+    """
+    Generate a synthetic dump with the given number of item entities and properties.
+    statements is the mean number of statements per entity, qualifiers the probability of (another) qualifier
+    per statement, unknown_values and long_literals the share of statements with such values.
+    The first hubs entities have hub_statements statements each.
+    Return: int (number of triples)
+    """
+    rng = random.Random(seed)
+    property_types = get_property_types(rng, properties)
+    settings = {
+        "languages": list(languages),
+        "statements": statements,
+        "skew": skew,
+        "qualifiers": qualifiers,
+        "unknown_values": unknown_values,
+        "long_literals": long_literals,
+        "hubs": hubs,
+        "hub_statements": hub_statements,
+        "property_types": property_types,
+        "property_weights": get_zipf_weights(properties, skew),
+        "entity_weights": get_zipf_weights(entities, skew),
+    }
+    triples = 0
+    buffer = []
+    with open_output(path) as output:
+        entity_blocks = itertools.chain(
+            (generate_property(rng, number, property_types[number], languages) for number in property_types),
+            (generate_entity(rng, number, settings) for number in range(1, entities + 1)),
+        )
+        for lines in entity_blocks:
+            buffer.extend(lines)
+            if len(buffer) >= WRITE_BATCH_SIZE:
+                output.write(("\n".join(buffer) + "\n").encode("utf-8"))
+                triples += len(buffer)
+                buffer = []
+        output.write(("\n".join(buffer) + "\n").encode("utf-8") if buffer else b"")
+        triples += len(buffer)
+    return triples
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", help="path of the dump (compressed with the extension .gz or .bz2)")
+    parser.add_argument("entities", type=int, nargs="?", help="number of item entities (required without preset)")
+    parser.add_argument("--properties", type=int, default=200, help="number of properties (at least 31)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=1.0,
+        help="skew of the statements per entity and of the popularity of properties and objects (0: uniform)",
+    )
+    parser.add_argument("--statements", type=int, default=8, help="mean number of statements per entity")
+    parser.add_argument("--languages", nargs="+", default=DEFAULT_LANGUAGES)
+    parser.add_argument("--qualifiers", type=float, default=0.3, help="probability of (another) qualifier")
+    parser.add_argument("--unknown-values", type=float, default=0.01, help="share of statements with unknown values")
+    parser.add_argument("--long-literals", type=float, default=0.01, help="share of string values that are long")
+    parser.add_argument("--hubs", type=int, default=0, help="number of hub entities (the first entities)")
+    parser.add_argument(
+        "--hub-statements",
+        type=int,
+        default=MAX_STATEMENTS,
+        help="number of statements of each hub entity",
+    )
+    parser.add_argument(
+        "--preset",
+        choices=sorted(PRESETS),
+        help="generate a dump of a special shape (overrides the number of entities and the corresponding options)",
+    )
+    args = parser.parse_args()
+    if args.preset:
+        for name, value in PRESETS[args.preset].items():
+            setattr(args, name, value)
+    if args.entities is None:
+        parser.error("the number of entities is required without --preset")
+    if args.properties < 31:
+        parser.error("--properties must be at least 31 (P31 is the type predicate)")
+    start_time = time.time()
+    triples = generate_dump(
+        args.output_path,
+        args.entities,
+        args.properties,
+        args.seed,
+        args.skew,
+        args.statements,
+        args.languages,
+        args.qualifiers,
+        args.unknown_values,
+        args.long_literals,
+        args.hubs,
+        args.hub_statements,
+    )
+    print(args.output_path + ": " + str(triples) + " triples")
+    print("Time(generate_dump): " + str(time.time() - start_time))
@@ -0,0 +1,530 @@
+"""
+Memory-mapped graph store over the cleaned KG (the output of resolve_qualifiers.py).
+Terms (entities, fact-specific predicates, literals) are mapped to integer IDs, by their rank in byte order.
+The objects of P31 facts (and qualifiers) are type nodes with a counter (e.g. 'Q5-12'), which are stored
+as their class ('Q5'), such that the instances of a class are its incoming edges.
+The facts are stored as compressed sparse rows (CSR): per term, the offset of its edges,
+once sorted by subject (outgoing edges) and once sorted by object (incoming edges).
+
+Files (in native byte order, see 'meta.json'):
+    terms.offsets, terms.data:                          ID <-> string table (sorted strings)
+    out.offsets, out.predicates, out.neighbors:         edges (predicate, object) per subject
+    in.offsets, in.predicates, in.neighbors:            edges (predicate, subject) per object
+
+All files are memory-mapped read-only, so processes share a single page-cached copy,
+and opening the store takes no time. Labels and Wikipedia mappings are looked up
+in the sorted dicts of filter_wikidata.py (see 'sorted_dicts.SortedDict').
+"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+from checkpoints import Checkpoint, get_stage_key
+from columnar import is_columnar_path, iter_rows
+from resolve_qualifiers import PATH_TO_OUTPUT_FILE, iter_intermediate_batches
+from sorted_dicts import SortedDict, iter_merged_keys, write_key_run
+from statement_index import DEFAULT_MEMORY_BUDGET
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+PATH_TO_GRAPH_DIR = "dumps/wikidata_clean_graph"
+PATH_TO_LABELS = "dicts/labels_dict.tsv"
+PATH_TO_WIKIPEDIA_MAPPINGS = "dicts/wikipedia_mappings.tsv"
+META_NAME = "meta.json"
+WRITE_BLOCK_SIZE = 1 << 20
+# estimated memory per term (in bytes), in the set of distinct terms and in the cache of term IDs
+TERM_MEMORY = 150
+# prefix of the fact-specific predicates of P31, whose objects are type nodes
+TYPE_PREDICATE_PREFIX = b"P31-"
+# unsorted edges (subject, predicate and object ID per edge), from which the CSR files are built
+EDGES_NAME = "edges.ids"
+# the edges are counted per block of 2^KEY_BLOCK_BITS terms, from which the key ranges of the buckets are formed
+KEY_BLOCK_BITS = 12
+# edges distributed into the buckets at once
+EDGE_BLOCK_SIZE = 1 << 18
+# maximum number of buckets (bounds the number of open files)
+MAX_BUCKETS = 256
+# memory per key of a bucket (in bytes): its offset and its position while sorting
+KEY_MEMORY = 16
+# IDs per edge held by a bucket while sorting: the edge (3 IDs), and its predicate and other term sorted (2 IDs)
+BUCKET_IDS = 5
+STORE_FILES = ["terms.offsets", "terms.data"] + [
+    direction + "." + name for direction in ["out", "in"] for name in ["offsets", "predicates", "neighbors"]
+]
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def iter_output_batches(path):
+    """
+    Iterate over the triples of the output of resolve_qualifiers.py (CSV or columnar export).
+    Return: generator of lists of (s, p, o)
+    """
+    if is_columnar_path(path):
+        yield from iter_rows(path)
+    else:
+        yield from iter_intermediate_batches(path)
+
+
+def iter_edge_batches(path):
+    """
+    Iterate over the triples of the output as edges of the graph: objects of P31 facts (and qualifiers)
+    are reduced from their type node (e.g. 'Q5-12') to their class ('Q5').
+    Return: generator of lists of (s, p, o)
+    """
+    for triples in iter_output_batches(path):
+        yield [(s, p, o.rsplit(b"-", 1)[0] if p.startswith(TYPE_PREDICATE_PREFIX) else o) for s, p, o in triples]
+
+
+def write_array(path, values):
+    with open(path, "wb") as fp:
+        for i in range(0, len(values), WRITE_BLOCK_SIZE):
+            values[i : i + WRITE_BLOCK_SIZE].tofile(fp)
+
+
+def write_strings(directory, name, strings):
+    """
+    Store the strings (streamed) as offsets and concatenated data.
+    Return: number of strings
+    """
+    number_of_strings = 0
+    position = 0
+    offsets = array("Q", [0])
+    path = os.path.join(directory, name)
+    with open(path + ".data", "wb", buffering=WRITE_BLOCK_SIZE) as fp, open(path + ".offsets", "wb") as fp_offsets:
+        for string in strings:
+            fp.write(string)
+            position += len(string)
+            offsets.append(position)
+            number_of_strings += 1
+            if len(offsets) >= WRITE_BLOCK_SIZE:
+                offsets.tofile(fp_offsets)
+                offsets = array("Q")
+        offsets.tofile(fp_offsets)
+    return number_of_strings
+
+
+def read_array(path, typecode):
+    values = array(typecode)
+    with open(path, "rb") as fp:
+        values.fromfile(fp, os.fstat(fp.fileno()).st_size // values.itemsize)
+    return values
+
+
+def iter_array_blocks(path, typecode, block_size):
+    """
+    Read the array stored in the file in blocks of (at most) block_size values.
+    Return: generator of arrays
+    """
+    with open(path, "rb") as fp:
+        while True:
+            block = array(typecode)
+            try:
+                block.fromfile(fp, block_size)
+            except EOFError:
+                pass
+            if not block:
+                return
+            yield block
+
+
+def get_sort_memory(number_of_terms, number_of_edges):
+    """
+    Get the memory required to sort all edges into CSR at once (see 'sort_edges').
+    Return: int (bytes)
+    """
+    typecode = "I" if number_of_terms < 1 << 32 else "Q"
+    return number_of_edges * BUCKET_IDS * array(typecode).itemsize + number_of_terms * KEY_MEMORY
+
+
+def get_key_ranges(histogram, number_of_terms, memory_budget, edge_memory):
+    """
+    Split the term IDs into consecutive ranges, such that the edges of the keys in each range (given the number
+    of edges per block of keys) can be sorted within the memory budget (a single block may exceed it).
+    Return: list of (first key, end key)
+    """
+    ranges = list()
+    start = 0
+    memory = 0
+    for block, edges in enumerate(histogram):
+        block_memory = edges * edge_memory + (1 << KEY_BLOCK_BITS) * KEY_MEMORY
+        if memory and memory + block_memory > memory_budget:
+            ranges.append((start, block << KEY_BLOCK_BITS))
+            start = block << KEY_BLOCK_BITS
+            memory = 0
+        memory += block_memory
+    ranges.append((start, number_of_terms))
+    return ranges
+
+
+def write_buckets(edges_path, bucket_paths, key_ranges, key_index, typecode):
+    """
+    Distribute the edges into a bucket file per key range, keeping their order.
+    Return: None
+    """
+    starts = [start for start, _ in key_ranges]
+    files = [open(path, "wb") for path in bucket_paths]
+    try:
+        for block in iter_array_blocks(edges_path, typecode, 3 * EDGE_BLOCK_SIZE):
+            buckets = [array(typecode) for _ in files]
+            for i in range(0, len(block), 3):
+                buckets[bisect_right(starts, block[i + key_index]) - 1].extend(block[i : i + 3])
+            for fp, bucket in zip(files, buckets):
+                bucket.tofile(fp)
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def sort_edges(edges, key_index, first_key, number_of_keys, typecode):
+    """
+    Sort the edges (subject, predicate and object ID per edge) by their key (subject with key_index 0,
+    object with key_index 2) into compressed sparse rows of the given range of keys.
+    Edges of the same key keep their order in the dump (counting sort).
+    Return: (offsets relative to the first edge, predicates, the other terms of the edges)
+    """
+    value_index = 2 - key_index
+    offsets = array("Q", bytes(8 * (number_of_keys + 1)))
+    for i in range(key_index, len(edges), 3):
+        offsets[edges[i] - first_key + 1] += 1
+    for i in range(number_of_keys):
+        offsets[i + 1] += offsets[i]
+    positions = offsets[:-1]
+    sorted_predicates = array(typecode, bytes(edges.itemsize * (len(edges) // 3)))
+    sorted_values = array(typecode, bytes(edges.itemsize * (len(edges) // 3)))
+    for i in range(0, len(edges), 3):
+        key = edges[i + key_index] - first_key
+        position = positions[key]
+        sorted_predicates[position] = edges[i + 1]
+        sorted_values[position] = edges[i + value_index]
+        positions[key] = position + 1
+    return offsets, sorted_predicates, sorted_values
+
+
+def write_csr(directory, name, key_index, typecode, key_ranges):
+    """
+    Store the edges (see 'encode_triples') as compressed sparse rows, sorted by key (subject with key_index 0,
+    object with key_index 2), with the predicate and the other term of each edge.
+    With several key ranges (see 'get_key_ranges'), the edges are distributed into a bucket per range first,
+    and the buckets are sorted one after another.
+    Return: None
+    """
+    path = os.path.join(directory, name)
+    edges_path = os.path.join(directory, EDGES_NAME)
+    bucket_paths = [edges_path]
+    if len(key_ranges) > 1:
+        bucket_paths = [path + ".bucket_" + str(i).zfill(3) for i in range(len(key_ranges))]
+        write_buckets(edges_path, bucket_paths, key_ranges, key_index, typecode)
+    position = 0
+    with open(path + ".offsets", "wb") as fp_offsets, open(path + ".predicates", "wb") as fp_predicates, open(
+        path + ".neighbors", "wb"
+    ) as fp_neighbors:
+        for (start, end), bucket_path in zip(key_ranges, bucket_paths):
+            edges = read_array(bucket_path, typecode)
+            if bucket_path != edges_path:
+                os.remove(bucket_path)
+            offsets, predicates, values = sort_edges(edges, key_index, start, end - start, typecode)
+            array("Q", (position + offset for offset in offsets[:-1])).tofile(fp_offsets)
+            predicates.tofile(fp_predicates)
+            values.tofile(fp_neighbors)
+            position += len(predicates)
+        array("Q", [position]).tofile(fp_offsets)
+
+
+def find_string(offsets, data, number_of_strings, string):
+    """
+    Find the first string not smaller than the given one in the sorted string table (binary search).
+    Return: index (number_of_strings, if all strings are smaller)
+    """
+    low = 0
+    high = number_of_strings
+    while low < high:
+        middle = (low + high) // 2
+        if data[offsets[middle] : offsets[middle + 1]] < string:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def map_file(path, resources):
+    """
+    Memory-map the file read-only (the file and the mapping are added to the resources).
+    Return: mmap (or empty bytes for an empty file)
+    """
+    fp = open(path, "rb")
+    resources.append(fp)
+    if os.fstat(fp.fileno()).st_size == 0:
+        return b""
+    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    resources.append(data)
+    return data
+
+
+def map_array(path, typecode, resources):
+    """
+    Memory-map the file read-only as an array of the given type (see 'map_file').
+    Return: memoryview
+    """
+    view = memoryview(map_file(path, resources)).cast(typecode)
+    resources.append(view)
+    return view
+
+
+def close_resources(resources):
+    for resource in reversed(resources):
+        if isinstance(resource, memoryview):
+            resource.release()
+        else:
+            resource.close()
+
+
+def write_term_runs(input_path, directory, max_terms):
+    """
+    Collect the distinct terms of the output, and store them as sorted runs (see 'sorted_dicts.write_key_run'),
+    whenever there are more than max_terms, and at the end.
+    Return: list of run paths
+    """
+    run_paths = list()
+    terms = set()
+    for triples in iter_edge_batches(input_path):
+        for s, p, o in triples:
+            terms.add(s)
+            terms.add(p)
+            terms.add(o)
+        if len(terms) >= max_terms:
+            run_paths.append(os.path.join(directory, "terms.run_" + str(len(run_paths)).zfill(3)))
+            write_key_run(run_paths[-1], terms)
+            terms = set()
+    run_paths.append(os.path.join(directory, "terms.run_" + str(len(run_paths)).zfill(3)))
+    write_key_run(run_paths[-1], terms)
+    return run_paths
+
+
+def encode_triples(input_path, directory, number_of_terms, typecode, max_cached):
+    """
+    Encode the triples of the output as term IDs, looked up by binary search in the (memory-mapped) term table,
+    and store them in the order of the output (subject, predicate and object ID per edge, see EDGES_NAME).
+    The IDs of the last max_cached distinct terms are cached, since the terms of an entity repeat;
+    if the whole term table fits into the cache, it is loaded upfront (no binary search).
+    The edges are counted per block of subjects and of objects (see 'get_key_ranges').
+    Return: (number of edges, edges per block of subjects, edges per block of objects)
+    """
+    resources = list()
+    offsets = map_array(os.path.join(directory, "terms.offsets"), "Q", resources)
+    data = map_file(os.path.join(directory, "terms.data"), resources)
+    term_ids = dict()
+    if number_of_terms <= max_cached:
+        term_ids = {data[offsets[term_id] : offsets[term_id + 1]]: term_id for term_id in range(number_of_terms)}
+
+    def get_term_id(term):
+        term_id = term_ids.get(term)
+        if term_id is None:
+            if len(term_ids) >= max_cached:
+                term_ids.clear()
+            term_id = term_ids[term] = find_string(offsets, data, number_of_terms, term)
+        return term_id
+
+    blocks = (number_of_terms >> KEY_BLOCK_BITS) + 1
+    subject_histogram = array("Q", bytes(8 * blocks))
+    object_histogram = array("Q", bytes(8 * blocks))
+    number_of_edges = 0
+    with open(os.path.join(directory, EDGES_NAME), "wb") as fp:
+        for triples in iter_edge_batches(input_path):
+            edges = array(typecode)
+            for s, p, o in triples:
+                subject_id = get_term_id(s)
+                object_id = get_term_id(o)
+                edges.extend((subject_id, get_term_id(p), object_id))
+                subject_histogram[subject_id >> KEY_BLOCK_BITS] += 1
+                object_histogram[object_id >> KEY_BLOCK_BITS] += 1
+            edges.tofile(fp)
+            number_of_edges += len(triples)
+    close_resources(resources)
+    return number_of_edges, subject_histogram, object_histogram
+
+
+def build_graph_store(
+    input_path=PATH_TO_OUTPUT_FILE, directory=PATH_TO_GRAPH_DIR, memory_budget=DEFAULT_MEMORY_BUDGET
+):
+    """
+    Build the graph store from the output of resolve_qualifiers.py within the memory budget (in bytes), in two passes:
+    first, the term table is built from sorted runs of the distinct terms, merged with a k-way merge;
+    then the facts are encoded into a file of edges, which is sorted into CSR (by subject and by object)
+    in buckets of key ranges (see 'write_csr'). Beyond MAX_BUCKETS buckets, the buckets exceed the budget.
+    Return: None
+    """
+    os.makedirs(directory, exist_ok=True)
+    max_terms = max(1, memory_budget // TERM_MEMORY)
+    run_paths = write_term_runs(input_path, directory, max_terms)
+    number_of_terms = write_strings(directory, "terms", iter_merged_keys(run_paths))
+    typecode = "I" if number_of_terms < 1 << 32 else "Q"
+    number_of_edges, subject_histogram, object_histogram = encode_triples(
+        input_path, directory, number_of_terms, typecode, max_terms
+    )
+    edge_memory = BUCKET_IDS * array(typecode).itemsize
+    memory_budget = max(memory_budget, -(-get_sort_memory(number_of_terms, number_of_edges) // MAX_BUCKETS))
+    for name, key_index, histogram in [("out", 0, subject_histogram), ("in", 2, object_histogram)]:
+        key_ranges = get_key_ranges(histogram, number_of_terms, memory_budget, edge_memory)
+        write_csr(directory, name, key_index, typecode, key_ranges)
+    os.remove(os.path.join(directory, EDGES_NAME))
+    meta = {"terms": number_of_terms, "edges": number_of_edges, "typecode": typecode, "byteorder": sys.byteorder}
+    with open(os.path.join(directory, META_NAME), "w") as fp:
+        json.dump(meta, fp)
+
+
+class GraphStore:
+    """
+    Read-only access to the graph store.
+    Terms are given and returned as strings (e.g. 'Q42', 'P31-7', '"some literal"').
+    """
+
+    def __init__(
+        self, directory=PATH_TO_GRAPH_DIR, labels_path=PATH_TO_LABELS, wikipedia_path=PATH_TO_WIKIPEDIA_MAPPINGS
+    ):
+        with open(os.path.join(directory, META_NAME), "r") as fp:
+            meta = json.load(fp)
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("Graph store was built on a machine with different byte order: " + directory)
+        self.number_of_terms = meta["terms"]
+        self.number_of_edges = meta["edges"]
+        self.resources = list()
+        typecode = meta["typecode"]
+        self.term_offsets = map_array(os.path.join(directory, "terms.offsets"), "Q", self.resources)
+        self.term_data = map_file(os.path.join(directory, "terms.data"), self.resources)
+        self.out_edges = [
+            map_array(os.path.join(directory, "out.offsets"), "Q", self.resources),
+            map_array(os.path.join(directory, "out.predicates"), typecode, self.resources),
+            map_array(os.path.join(directory, "out.neighbors"), typecode, self.resources),
+        ]
+        self.in_edges = [
+            map_array(os.path.join(directory, "in.offsets"), "Q", self.resources),
+            map_array(os.path.join(directory, "in.predicates"), typecode, self.resources),
+            map_array(os.path.join(directory, "in.neighbors"), typecode, self.resources),
+        ]
+        self.labels = SortedDict(labels_path) if labels_path and os.path.exists(labels_path) else None
+        self.wikipedia = SortedDict(wikipedia_path) if wikipedia_path and os.path.exists(wikipedia_path) else None
+
+    def get_id(self, term):
+        """
+        Look up the ID of the term (binary search in the term table).
+        Return: int (or None, if the term is not in the graph)
+        """
+        term = term.encode("utf-8", "surrogateescape")
+        offsets = self.term_offsets
+        term_id = find_string(offsets, self.term_data, self.number_of_terms, term)
+        if term_id < self.number_of_terms and self.term_data[offsets[term_id] : offsets[term_id + 1]] == term:
+            return term_id
+        return None
+
+    def get_term(self, term_id):
+        """
+        Look up the term with the ID.
+        Return: str
+        """
+        return self.term_data[self.term_offsets[term_id] : self.term_offsets[term_id + 1]].decode(
+            "utf-8", "surrogateescape"
+        )
+
+    def iter_degrees(self):
+        """
+        Iterate over all terms with their degree (number of outgoing and incoming edges), sorted by term.
+        Return: generator of (term as bytes, degree)
+        """
+        offsets = self.term_offsets
+        out_offsets = self.out_edges[0]
+        in_offsets = self.in_edges[0]
+        for term_id in range(self.number_of_terms):
+            degree = out_offsets[term_id + 1] - out_offsets[term_id] + in_offsets[term_id + 1] - in_offsets[term_id]
+            yield self.term_data[offsets[term_id] : offsets[term_id + 1]], degree
+
+    def get_edges(self, term, edges):
+        term_id = self.get_id(term)
+        if term_id is None:
+            return []
+        offsets, predicates, neighbors = edges
+        start, end = offsets[term_id], offsets[term_id + 1]
+        return [
+            (self.get_term(predicate), self.get_term(neighbor))
+            for predicate, neighbor in zip(predicates[start:end], neighbors[start:end])
+        ]
+
+    def neighbors(self, term):
+        """
+        Get the outgoing edges of the term.
+        Return: list of (predicate, object)
+        """
+        return self.get_edges(term, self.out_edges)
+
+    def incoming(self, term):
+        """
+        Get the incoming edges of the term.
+        Return: list of (predicate, subject)
+        """
+        return self.get_edges(term, self.in_edges)
+
+    def facts(self, entity):
+        """
+        Get the facts of the entity, with their qualifiers: the qualifiers of a fact
+        are the outgoing edges of its fact-specific predicate (e.g. 'P39-4').
+        Return: list of (predicate, object, list of (qualifier predicate, qualifier object))
+        """
+        return [(p, o, self.neighbors(p)) for p, o in self.neighbors(entity)]
+
+    def label(self, entity):
+        """
+        Look up the (English) labels of the entity.
+        Return: list of str
+        """
+        if self.labels is None:
+            return []
+        return self.labels.get(entity, [])
+
+    def wikipedia_mapping(self, entity):
+        """
+        Look up the Wikipedia link of the entity.
+        Return: str (or None)
+        """
+        if self.wikipedia is None:
+            return None
+        return self.wikipedia.get(entity)
+
+    def close(self):
+        if self.labels:
+            self.labels.close()
+        if self.wikipedia:
+            self.wikipedia.close()
+        close_resources(self.resources)
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("resolved_dump_path", nargs="?", default=PATH_TO_OUTPUT_FILE)
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) for the distinct terms (spilled to sorted runs), the term ID cache and the sorted edges",
+    )
+    args = parser.parse_args()
+    input_path = args.resolved_dump_path
+    output_paths = [os.path.join(PATH_TO_GRAPH_DIR, name) for name in STORE_FILES + [META_NAME]]
+    checkpoint = Checkpoint("graph_store", get_stage_key([input_path], {}))
+    if checkpoint.is_finished(output_paths):
+        print("Graph store was built already from the same input, skipping graph_store.py")
+        sys.exit()
+    start_time = time.time()
+    build_graph_store(input_path, memory_budget=args.memory_budget << 20)
+    checkpoint.finish(output_paths)
+    print("Time(graph_store): " + str(time.time() - start_time))
@@ -0,0 +1,538 @@
+"""
+Incremental rebuild of the cleaned KG from a newer dump, with stable fact-specific predicates.
+A build keeps a state in dumps/wikidata_clean_state/: per entity, a content hash of its block of lines in the dump
+and its rows in the output (which carry the counters assigned to its facts), and the next free counter per predicate
+(and per type). An update streams the new dump entity by entity: entities with an unchanged hash are skipped,
+the others are filtered (with the filter chain of filter_wikidata.py) and resolved on their own (see 'resolve_block').
+Facts that existed before keep their fact-specific predicates (matched by predicate, object and qualifiers,
+see 'assign_ids'), new facts get fresh counters, and counters of removed facts are not reused.
+Then dumps/wikidata_clean.csv and the dicts are patched: the rows and dict entries of changed and deleted entities
+are removed, and those of changed and added entities are appended.
+Without a state (or with --full), all entities are new, i.e. the dump is built from scratch, and the state is created.
+The state also records the filter config and the predicate catalog, as unchanged entities are not filtered again
+(see 'load_state').
+
+The lines of an entity (its statement nodes and sitelinks, and the reference and value nodes following them)
+need to be contiguous in the dump, as in the Wikidata dumps. Statement nodes are resolved within their entity,
+so the counters differ from resolve_qualifiers.py, but the facts are the same (see 'get_fact_set').
+"""
+
+import argparse
+import collections
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+
+from dump_io import iter_line_batches
+from extract_special_predicates import (
+    EXT_ID_TYPES,
+    GEO_TYPES,
+    extract_special_predicates,
+    get_catalog_path,
+    load_special_predicates,
+    store_predicate_catalog,
+)
+from filter_wikidata import (
+    DEFAULT_MEMORY_BUDGET,
+    DICT_ENTRY_MEMORY,
+    PATH_TO_RUNS_DIR,
+    FilterChain,
+    count_dict_entries,
+    create_dicts,
+    extract_aliases,
+    extract_descriptions,
+    extract_labels,
+    extract_wikipedia_mappings,
+    filter_non_wikidata_id_subjects,
+    get_dict_names,
+    get_dict_path,
+    get_line_entity,
+    get_run_path,
+    init_worker,
+    is_domain_restricted,
+    load_filter_config,
+    write_dict_runs,
+)
+from literals import get_primary_language, parse_literal
+from resolve_qualifiers import PATH_TO_OUTPUT_FILE, EntitySet, make_unique, parse_triple, resolve_entity, write_rows
+from sorted_dicts import SortedDict, iter_entries, merge_runs, write_run
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+PATH_TO_STATE_DIR = "dumps/wikidata_clean_state"
+HASHES_NAME = "hashes.tsv"
+ROWS_NAME = "rows.tsv"
+COUNTERS_NAME = "counters.json"
+META_NAME = "meta.json"
+ADDED_ROWS_NAME = "added_rows.csv"
+TYPE_PREDICATE = b"P31"
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def iter_entity_blocks(path):
+    """
+    Iterate over the blocks of lines of the entities in the dump.
+    A line belongs to its entity (see 'filter_wikidata.get_line_entity'),
+    lines without entity (e.g. of reference nodes) to the current block.
+    Return: generator of (entity, list of lines)
+    """
+    entity = None
+    block = list()
+    for lines in iter_line_batches(path):
+        for line in lines:
+            s, p, o = line.split(b" ", 2)
+            line_entity = get_line_entity(s, p, o)
+            if line_entity and line_entity != entity:
+                if block and entity:
+                    yield entity, block
+                entity = line_entity
+                block = list()
+            block.append(line)
+    if block and entity:
+        yield entity, block
+
+
+def hash_block(lines):
+    return hashlib.blake2b(b"\n".join(lines), digest_size=16).hexdigest()
+
+
+def filter_block(lines, classify, dicts):
+    """
+    Filter the lines of an entity, and extract its labels, aliases, descriptions and wikipedia mappings
+    into the dicts (as in 'filter_wikidata.prune_triples').
+    Return: list of (normalized) triples
+    """
+    labels, aliases, descriptions, wikipedia_mappings, inverse_wikipedia_mappings = dicts
+    triples = list()
+    for line in lines:
+        s, p, o = line.split(b" ", 2)
+        extract_wikipedia_mappings(s, p, o, wikipedia_mappings, inverse_wikipedia_mappings)
+        if filter_non_wikidata_id_subjects(s):
+            continue
+        value, language, datatype = parse_literal(o)
+        if language:
+            language = get_primary_language(language)
+            extract_labels(s, p, value, language, labels)
+            extract_aliases(s, p, value, language, aliases)
+            extract_descriptions(s, p, value, language, descriptions)
+        if classify(s, p, o, language) != -1:
+            continue
+        triples.append(parse_triple(line))
+    return triples
+
+
+def resolve_block(triples):
+    """
+    Resolve the qualifiers within the triples of an entity, with counters starting at 0
+    (see 'resolve_qualifiers.resolve_qualifiers_streaming'). Statement triples whose statement node
+    is not among the triples of the entity are dropped.
+    Return: list of rows
+    """
+    predicate_nodes = dict()
+    type_nodes = dict()
+    intermediate_nodes = dict()
+    entity_triples = list()
+    for s, p, o in triples:
+        p, o = make_unique(p, o, predicate_nodes, type_nodes)
+        if b"-" in o:
+            if o.startswith(s) or o.startswith(b"q" + s[1:]):
+                intermediate_nodes[o] = p
+                continue
+            if o.startswith(b"p" + s[1:]):
+                continue
+        entity_triples.append((s, p, o))
+    rows = list()
+    resolve_entity(entity_triples, intermediate_nodes, rows, (io.BytesIO(), io.BytesIO()))
+    return rows
+
+
+def get_base(term):
+    return term.rsplit(b"-", 1)[0]
+
+
+def get_canonical_object(p, o):
+    """
+    Get the object without the counter of type nodes (in P31 facts).
+    Return: bytes
+    """
+    return get_base(o) if get_base(p) == TYPE_PREDICATE else o
+
+
+def group_facts(rows):
+    """
+    Group the rows of an entity by fact: the rows of the fact (with the fact-specific predicate as predicate),
+    and its qualifier rows (with the fact-specific predicate as subject).
+    Return: dict (fact-specific predicate -> (list of objects, list of (qualifier predicate, object)))
+    """
+    facts = dict()
+    for row in rows:
+        s, p, o = row.split(b",", 2)
+        if b"-" in s:
+            facts.setdefault(s, ([], []))[1].append((p, o))
+        else:
+            facts.setdefault(p, ([], []))[0].append(o)
+    return facts
+
+
+def get_signature(fact_id, objects, qualifiers):
+    """
+    Get the signature of a fact: its predicate, objects and qualifiers, without counters.
+    Return: tuple
+    """
+    canonical_objects = tuple(get_canonical_object(fact_id, o) for o in objects)
+    canonical_qualifiers = tuple(sorted((get_base(q), get_canonical_object(q, o)) for q, o in qualifiers))
+    return get_base(fact_id), canonical_objects, canonical_qualifiers
+
+
+def get_signatures(facts):
+    """
+    Index the facts by their signature, numbered by occurrence (for facts with equal signatures).
+    Return: dict (signature -> fact-specific predicate)
+    """
+    signatures = dict()
+    occurrences = collections.Counter()
+    for fact_id, (objects, qualifiers) in facts.items():
+        signature = get_signature(fact_id, objects, qualifiers)
+        signatures[signature + (occurrences[signature],)] = fact_id
+        occurrences[signature] += 1
+    return signatures
+
+
+def get_fresh_term(term, counters):
+    """
+    Replace the counter of the term (e.g. 'P31-0') by the next free counter of its base.
+    Return: bytes
+    """
+    base = get_base(term)
+    key = base.decode("utf-8")
+    counter = counters.get(key, 0)
+    counters[key] = counter + 1
+    return base + b"-" + str(counter).encode()
+
+
+def sort_qualifiers(qualifiers):
+    return sorted(qualifiers, key=lambda qualifier: (get_base(qualifier[0]), get_canonical_object(*qualifier)))
+
+
+def assign_ids(rows, old_rows, counters):
+    """
+    Replace the (temporary) counters in the rows of an entity: facts matching a fact in the old rows
+    of the entity (by signature) get the fact-specific predicates (and qualifier predicates and type nodes) of the
+    old fact, other facts get fresh counters.
+    Return: list of rows
+    """
+    facts = group_facts(rows)
+    old_facts = group_facts(old_rows)
+    old_signatures = get_signatures(old_facts)
+    terms = dict()
+    for signature, fact_id in get_signatures(facts).items():
+        objects, qualifiers = facts[fact_id]
+        old_fact_id = old_signatures.get(signature)
+        if old_fact_id is None:
+            terms[fact_id] = get_fresh_term(fact_id, counters["predicates"])
+            for q, o in qualifiers:
+                terms[q] = get_fresh_term(q, counters["predicates"])
+                if get_base(q) == TYPE_PREDICATE:
+                    terms[o] = get_fresh_term(o, counters["types"])
+            if get_base(fact_id) == TYPE_PREDICATE:
+                for o in objects:
+                    terms[o] = get_fresh_term(o, counters["types"])
+            continue
+        old_objects, old_qualifiers = old_facts[old_fact_id]
+        terms[fact_id] = old_fact_id
+        for (q, o), (old_q, old_o) in zip(sort_qualifiers(qualifiers), sort_qualifiers(old_qualifiers)):
+            terms[q] = old_q
+            if get_base(q) == TYPE_PREDICATE:
+                terms[o] = old_o
+        if get_base(fact_id) == TYPE_PREDICATE:
+            terms.update(zip(objects, old_objects))
+    resolved_rows = list()
+    for row in rows:
+        s, p, o = row.split(b",", 2)
+        if get_base(p) == TYPE_PREDICATE:
+            o = terms[o]
+        resolved_rows.append(terms.get(s, s) + b"," + terms[p] + b"," + o)
+    return resolved_rows
+
+
+def get_fact_ids(rows):
+    """
+    Get the fact-specific predicates of the facts in the rows of an entity
+    (including facts whose main triple was pruned, with qualifier rows only).
+    Return: set of bytes
+    """
+    return set(group_facts(rows))
+
+
+def get_fact_set(path):
+    """
+    Load the facts of an output file without counters: per fact, its entity, predicate, objects and qualifiers
+    (see 'get_signature'), such that outputs with different counters can be compared.
+    The whole output is loaded into memory.
+    Return: collections.Counter of facts
+    """
+    rows = [line for lines in iter_line_batches(path) for line in lines]
+    entities = dict()
+    for row in rows:
+        s, p, _ = row.split(b",", 2)
+        if not b"-" in s:
+            entities[p] = s
+    facts = group_facts(rows)
+    return collections.Counter(
+        (entities.get(fact_id),) + get_signature(fact_id, objects, qualifiers)
+        for fact_id, (objects, qualifiers) in facts.items()
+    )
+
+
+def get_predicate_class(predicate_type):
+    if predicate_type in EXT_ID_TYPES:
+        return "external_id"
+    return "geo" if predicate_type in GEO_TYPES else None
+
+
+def load_state(state_dir, filter_config, predicate_types):
+    """
+    Load the state of the previous build. The filters need to classify the triples of unchanged entities as before:
+    the state has to be built with the same filter config, and predicates in both dumps must not have changed
+    between identifier, geo and other types (new predicates are only used by added or changed entities).
+    Return: (hashes, rows, counters), with hashes and rows as SortedDict (None without state)
+    """
+    meta_path = os.path.join(state_dir, META_NAME)
+    counters = {"predicates": {}, "types": {}}
+    if not os.path.exists(meta_path):
+        return None, None, counters
+    with open(meta_path, "r") as fp:
+        meta = json.load(fp)
+    if meta["filter_config"] != filter_config:
+        raise ValueError("The state in " + state_dir + " was built with another filter config, use --full")
+    for p, predicate_type in meta["predicate_types"].items():
+        if p in predicate_types and get_predicate_class(predicate_type) != get_predicate_class(predicate_types[p]):
+            raise ValueError("The type of " + p + " changed since the last build, use --full")
+    with open(os.path.join(state_dir, COUNTERS_NAME), "r") as fp:
+        counters = json.load(fp)
+    return SortedDict(os.path.join(state_dir, HASHES_NAME)), SortedDict(os.path.join(state_dir, ROWS_NAME)), counters
+
+
+def write_state_file(state_dir, name, value):
+    path = os.path.join(state_dir, name)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(value, fp, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def filter_sorted_dict(path, output_path, removed, by_value=False):
+    """
+    Copy the sorted dict without the entries of the removed entities (the keys, or by_value the values).
+    Return: None
+    """
+    with open(output_path, "w", encoding="utf-8") as fp:
+        if not os.path.exists(path):
+            return
+        for key, _, value in iter_entries(path, 0):
+            entity = json.loads(value).encode("utf-8") if by_value else key
+            if not entity in removed:
+                fp.write(key.decode("utf-8") + "\t" + value + "\n")
+
+
+def patch_sorted_dict(path, run_paths, removed, union, by_value=False):
+    """
+    Remove the entries of the removed entities from the sorted dict, and merge the runs with the new entries into it.
+    Return: None
+    """
+    base_path = path + ".base"
+    filter_sorted_dict(path, base_path, removed, by_value)
+    merge_runs([base_path] + run_paths, path, union)
+
+
+def patch_output(output_path, removed, added_rows_path):
+    """
+    Remove the rows of the removed entities and facts from the output, and append the added rows.
+    Return: None
+    """
+    with open(output_path + ".tmp", "wb") as fp_out:
+        if os.path.exists(output_path):
+            for lines in iter_line_batches(output_path):
+                write_rows(fp_out, [line for line in lines if not line.split(b",", 1)[0] in removed])
+        with open(added_rows_path, "rb") as fp_added:
+            shutil.copyfileobj(fp_added, fp_out)
+    os.replace(output_path + ".tmp", output_path)
+    os.remove(added_rows_path)
+
+
+def get_state_run_path(state_dir, name, run):
+    return os.path.join(state_dir, name + "_" + str(run).zfill(3))
+
+
+def write_state_runs(state_dir, hashes, entity_rows, dicts, languages, run):
+    """
+    Store the state and the dict entries of the processed entities as sorted runs.
+    Return: None
+    """
+    write_run(get_state_run_path(state_dir, HASHES_NAME, run), hashes)
+    write_run(get_state_run_path(state_dir, ROWS_NAME, run), entity_rows)
+    write_dict_runs(dicts, languages, 0, run)
+
+
+def update_build(
+    dump_path,
+    filter_config,
+    predicate_types,
+    full=False,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    state_dir=PATH_TO_STATE_DIR,
+):
+    """
+    Update the output, the dicts and the state from the (newer) dump, reprocessing only added and changed entities.
+    The predicate types are the catalog of the dump (see 'extract_special_predicates'), with which the filters are
+    initialized ('filter_wikidata.init_worker'). With full (or without state), the output and the dicts are built
+    from scratch.
+    Return: collections.Counter with the number of unchanged, changed, added and deleted entities
+    """
+    languages = [language.encode("utf-8") for language in filter_config["languages"]]
+    dict_names = get_dict_names(filter_config["languages"])
+    os.makedirs(state_dir, exist_ok=True)
+    os.makedirs(PATH_TO_RUNS_DIR, exist_ok=True)
+    old_hashes, old_rows, counters = (None, None, {"predicates": {}, "types": {}})
+    if not full:
+        old_hashes, old_rows, counters = load_state(state_dir, filter_config, predicate_types)
+    full = old_hashes is None
+    classify = FilterChain(filter_config).classify
+    max_entries = max(1, memory_budget // DICT_ENTRY_MEMORY)
+    dicts = create_dicts(languages)
+    hashes = dict()
+    entity_rows = dict()
+    runs = 0
+    # entities (and fact-specific predicates) whose rows and dict entries are removed
+    removed = set()
+    seen_entities = EntitySet()
+    statistics = collections.Counter()
+    added_rows_path = os.path.join(state_dir, ADDED_ROWS_NAME)
+    with open(added_rows_path, "wb") as fp_added:
+        for entity, lines in iter_entity_blocks(dump_path):
+            if not seen_entities.add(entity):
+                raise ValueError("The lines of " + entity.decode("utf-8") + " are not contiguous in the dump")
+            key = entity.decode("utf-8")
+            digest = hash_block(lines)
+            old_digest = old_hashes.get(key) if old_hashes else None
+            if digest == old_digest:
+                statistics["unchanged"] += 1
+                continue
+            previous_rows = list()
+            if old_digest is None:
+                statistics["added"] += 1
+            else:
+                statistics["changed"] += 1
+                previous_rows = [row.encode("utf-8") for row in old_rows.get(key, [])]
+                removed.add(entity)
+                removed.update(get_fact_ids(previous_rows))
+            rows = assign_ids(resolve_block(filter_block(lines, classify, dicts)), previous_rows, counters)
+            hashes[key] = digest
+            entity_rows[key] = [row.decode("utf-8") for row in rows]
+            write_rows(fp_added, list(rows))
+            # store the new state and dict entries as sorted runs, if memory budget exceeded
+            if len(hashes) + count_dict_entries(dicts) >= max_entries:
+                write_state_runs(state_dir, hashes, entity_rows, dicts, languages, runs)
+                runs += 1
+                dicts = create_dicts(languages)
+                hashes = dict()
+                entity_rows = dict()
+    write_state_runs(state_dir, hashes, entity_rows, dicts, languages, runs)
+    runs += 1
+    # deleted entities
+    if not full:
+        for key, _, value in iter_entries(os.path.join(state_dir, HASHES_NAME), 0):
+            if not key in seen_entities:
+                statistics["deleted"] += 1
+                removed.add(key)
+                removed.update(get_fact_ids([row.encode("utf-8") for row in old_rows.get(key.decode("utf-8"), [])]))
+        old_hashes.close()
+        old_rows.close()
+    #############################################################
+    # Patch the output, the dicts and the state                 #
+    #############################################################
+    if full:
+        for path in [PATH_TO_OUTPUT_FILE] + [os.path.join(state_dir, name) for name in (HASHES_NAME, ROWS_NAME)]:
+            if os.path.exists(path):
+                os.remove(path)
+    patch_output(PATH_TO_OUTPUT_FILE, removed, added_rows_path)
+    for dict_name in dict_names:
+        path = get_dict_path(dict_name) + ".tsv"
+        if full and os.path.exists(path):
+            os.remove(path)
+        union = dict_name.startswith("labels") or dict_name.startswith("aliases")
+        run_paths = [get_run_path(dict_name, 0, run) for run in range(runs)]
+        patch_sorted_dict(path, run_paths, removed, union, by_value=dict_name == "inverse_wikipedia_mappings")
+    for name in (HASHES_NAME, ROWS_NAME):
+        path = os.path.join(state_dir, name)
+        patch_sorted_dict(path, [get_state_run_path(state_dir, name, run) for run in range(runs)], removed, False)
+    write_state_file(state_dir, COUNTERS_NAME, counters)
+    write_state_file(state_dir, META_NAME, {"filter_config": filter_config, "predicate_types": predicate_types})
+    return statistics
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wikidata_dump_path")
+    parser.add_argument(
+        "--filter-config",
+        help="path to a JSON file selecting the filters to apply (see filter_wikidata.py), same as for the last build",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        help="languages for which labels, aliases and descriptions are extracted (overrides the filter config)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the state of the last build, and build the output and dicts from scratch",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) for the state and dict entries of changed entities, before they are stored as runs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of workers for extracting the predicate catalog of the dump (if missing)",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="CSV",
+        help="check that the output has the same facts as the given output (e.g. of a full build), "
+        "regardless of the counters; loads both outputs into memory",
+    )
+    args = parser.parse_args()
+    WIKIDATA_DUMP_PATH = args.wikidata_dump_path
+    filter_config = load_filter_config(args.filter_config)
+    if args.languages:
+        filter_config["languages"] = args.languages
+    if is_domain_restricted(filter_config):
+        parser.error("incremental builds do not support domain-restricted filter configs")
+    start_time = time.time()
+    if not os.path.exists(get_catalog_path(WIKIDATA_DUMP_PATH)):
+        catalog = extract_special_predicates(WIKIDATA_DUMP_PATH, args.workers)
+        store_predicate_catalog(catalog, get_catalog_path(WIKIDATA_DUMP_PATH))
+    ext_id_predicates, geo_predicates = load_special_predicates(WIKIDATA_DUMP_PATH)
+    init_worker({p.encode("utf-8") for p in ext_id_predicates}, {p.encode("utf-8") for p in geo_predicates})
+    with open(get_catalog_path(WIKIDATA_DUMP_PATH), "r") as fp:
+        predicate_types = json.load(fp)
+    statistics = update_build(WIKIDATA_DUMP_PATH, filter_config, predicate_types, args.full, args.memory_budget << 20)
+    print(", ".join(str(statistics[name]) + " " + name for name in ["unchanged", "changed", "added", "deleted"]))
+    print("Time(incremental): " + str(time.time() - start_time))
+    if args.compare:
+        if get_fact_set(PATH_TO_OUTPUT_FILE) != get_fact_set(args.compare):
+            raise SystemExit("The facts of " + PATH_TO_OUTPUT_FILE + " differ from " + args.compare)
+        print("The facts of " + PATH_TO_OUTPUT_FILE + " are the same as in " + args.compare)
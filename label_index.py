@@ -0,0 +1,432 @@
+"""
+Search index over the labels and aliases of the entities (text -> ranked entities), e.g. for entity linking.
+Labels and aliases are normalized into surface forms (case-folded, without accents and punctuation),
+which are looked up exactly, by prefix, or by similarity of their character n-grams (trigrams).
+Candidates are ranked by their popularity, i.e. their degree in the graph store (see 'graph_store.py').
+
+Files (in native byte order, see 'meta.json'):
+    entities.offsets, entities.data, entities.degrees:  entity table (sorted IDs) with degrees
+    forms.offsets, forms.data:                          surface forms (sorted)
+    postings.offsets, postings.entities:                entities per surface form (by descending degree)
+    ngrams.offsets, ngrams.data:                        trigrams (sorted)
+    ngram_postings.offsets, ngram_postings.forms:       surface forms per trigram
+
+The index is built from the sorted dicts with bounded memory (sorted runs, see 'sorted_dicts.py'),
+and memory-mapped read-only for lookups.
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from filter_wikidata import PATH_TO_DICTS_DIR, get_dict_name
+from graph_store import PATH_TO_GRAPH_DIR, GraphStore, close_resources, find_string, map_array, map_file, write_array
+from sorted_dicts import iter_merged_entries, write_run
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+PATH_TO_LABEL_INDEX_DIR = "dicts/label_index"
+META_NAME = "meta.json"
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+NGRAM_SIZE = 3
+MAX_DEGREE = 0xFFFFFFFF
+DEFAULT_MEMORY_BUDGET = 1 << 30
+# approximate memory of an entry of the in-memory runs (dict of str -> set of int)
+ENTRY_MEMORY = 300
+DEFAULT_RESULTS = 10
+# bounds for the lookups of short prefixes and frequent n-grams
+MAX_PREFIX_FORMS = 10000
+MAX_NGRAM_CANDIDATES = 100
+MIN_SIMILARITY = 0.5
+# cost of looking up a surface form in the postings of a trigram (binary search), relative to counting a posting
+BISECT_COST = 20
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def normalize(text):
+    """
+    Normalize the text into a surface form: case-folded, without accents,
+    and with runs of punctuation and whitespace replaced by single spaces.
+    Return: str
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(NON_WORD_PATTERN.sub(" ", text).split())
+
+
+def get_ngrams(form):
+    """
+    Get the character n-grams of the surface form (padded with a space on both sides).
+    Return: set of str
+    """
+    padded = " " + form + " "
+    return {padded[i : i + NGRAM_SIZE] for i in range(max(1, len(padded) - NGRAM_SIZE + 1))}
+
+
+def iter_entity_degrees(entries, degrees):
+    """
+    Join the sorted (entity, surface forms) entries with the sorted (term, degree) pairs of the graph store.
+    The type nodes of P31 facts are stored as their class, so the degree of a class counts its instances.
+    Return: generator of (entity, surface forms, degree), with degree 0 for entities without facts
+    """
+    term, degree = next(degrees, (None, 0))
+    for entity, surface_forms in entries:
+        key = entity.encode("utf-8")
+        while term is not None and term < key:
+            term, degree = next(degrees, (None, 0))
+        yield entity, surface_forms, degree if term == key else 0
+
+
+def spill_run(run_dir, name, runs, entries):
+    """
+    Store the entries (str -> set of int) as a sorted run, see 'sorted_dicts.write_run'.
+    Return: None
+    """
+    if entries:
+        run_path = os.path.join(run_dir, name + "_" + str(len(runs)).zfill(5) + ".tsv")
+        write_run(run_path, entries)
+        runs.append(run_path)
+
+
+def remove_runs(runs):
+    for run_path in runs:
+        os.remove(run_path)
+
+
+def build_label_index(
+    dict_paths, graph_dir=PATH_TO_GRAPH_DIR, directory=PATH_TO_LABEL_INDEX_DIR, memory_budget=DEFAULT_MEMORY_BUDGET
+):
+    """
+    Build the search index over the given (sorted) dicts of labels and aliases, in two passes:
+    first, the entities are joined with their degrees and their surface forms are collected,
+    then the entities are stored per surface form, and the surface forms per trigram.
+    Return: (number of entities, number of surface forms)
+    """
+    run_dir = os.path.join(directory, "runs")
+    os.makedirs(run_dir, exist_ok=True)
+    max_entries = max(1, memory_budget // ENTRY_MEMORY)
+    # first pass: entities, degrees and runs of surface forms
+    graph = GraphStore(graph_dir, labels_path=None, wikipedia_path=None)
+    entries = iter_merged_entries([path for path in dict_paths if os.path.exists(path)], union=True)
+    degrees = array("I")
+    entity_offsets = array("Q", [0])
+    form_runs = list()
+    forms = dict()
+    with open(os.path.join(directory, "entities.data"), "wb") as fp:
+        for entity, surface_forms, degree in iter_entity_degrees(entries, graph.iter_degrees()):
+            entity_id = len(degrees)
+            entity = entity.encode("utf-8")
+            fp.write(entity)
+            entity_offsets.append(entity_offsets[-1] + len(entity))
+            degrees.append(min(degree, MAX_DEGREE))
+            for surface_form in surface_forms:
+                form = normalize(surface_form)
+                if form:
+                    forms.setdefault(form, set()).add(entity_id)
+            if len(forms) >= max_entries:
+                spill_run(run_dir, "forms", form_runs, forms)
+                forms = dict()
+    graph.close()
+    spill_run(run_dir, "forms", form_runs, forms)
+    forms = dict()
+    write_array(os.path.join(directory, "entities.offsets"), entity_offsets)
+    write_array(os.path.join(directory, "entities.degrees"), degrees)
+    # second pass: postings of the surface forms, and runs of trigrams
+    form_offsets = array("Q", [0])
+    postings_offsets = array("Q", [0])
+    ngram_runs = list()
+    ngrams = dict()
+    with open(os.path.join(directory, "forms.data"), "wb") as fp_forms, open(
+        os.path.join(directory, "postings.entities"), "wb"
+    ) as fp_postings:
+        for form_id, (form, entity_ids) in enumerate(iter_merged_entries(form_runs, union=True)):
+            data = form.encode("utf-8")
+            fp_forms.write(data)
+            form_offsets.append(form_offsets[-1] + len(data))
+            # stable sort: entities with the same degree stay sorted by ID
+            entity_ids.sort(key=lambda entity_id: -degrees[entity_id])
+            array("I", entity_ids).tofile(fp_postings)
+            postings_offsets.append(postings_offsets[-1] + len(entity_ids))
+            for ngram in get_ngrams(form):
+                ngrams.setdefault(ngram, set()).add(form_id)
+            if len(ngrams) >= max_entries:
+                spill_run(run_dir, "ngrams", ngram_runs, ngrams)
+                ngrams = dict()
+    remove_runs(form_runs)
+    spill_run(run_dir, "ngrams", ngram_runs, ngrams)
+    ngrams = dict()
+    write_array(os.path.join(directory, "forms.offsets"), form_offsets)
+    write_array(os.path.join(directory, "postings.offsets"), postings_offsets)
+    # trigrams with the (sorted) IDs of their surface forms
+    ngram_offsets = array("Q", [0])
+    ngram_postings_offsets = array("Q", [0])
+    with open(os.path.join(directory, "ngrams.data"), "wb") as fp_ngrams, open(
+        os.path.join(directory, "ngram_postings.forms"), "wb"
+    ) as fp_postings:
+        for ngram, form_ids in iter_merged_entries(ngram_runs, union=True):
+            data = ngram.encode("utf-8")
+            fp_ngrams.write(data)
+            ngram_offsets.append(ngram_offsets[-1] + len(data))
+            array("I", form_ids).tofile(fp_postings)
+            ngram_postings_offsets.append(ngram_postings_offsets[-1] + len(form_ids))
+    remove_runs(ngram_runs)
+    write_array(os.path.join(directory, "ngrams.offsets"), ngram_offsets)
+    write_array(os.path.join(directory, "ngram_postings.offsets"), ngram_postings_offsets)
+    meta = {
+        "entities": len(degrees),
+        "forms": len(form_offsets) - 1,
+        "ngrams": len(ngram_offsets) - 1,
+        "byteorder": sys.byteorder,
+    }
+    with open(os.path.join(directory, META_NAME), "w") as fp:
+        json.dump(meta, fp)
+    return meta["entities"], meta["forms"]
+
+
+class LabelIndex:
+    """
+    Read-only access to the search index.
+    All lookups return the IDs of the matching entities (e.g. ['Q42', ...]),
+    ranked by their degree (most popular first).
+    """
+
+    def __init__(self, directory=PATH_TO_LABEL_INDEX_DIR):
+        with open(os.path.join(directory, META_NAME), "r") as fp:
+            meta = json.load(fp)
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("Label index was built on a machine with different byte order: " + directory)
+        self.number_of_forms = meta["forms"]
+        self.number_of_ngrams = meta["ngrams"]
+        self.resources = list()
+        self.entity_offsets = map_array(os.path.join(directory, "entities.offsets"), "Q", self.resources)
+        self.entity_data = map_file(os.path.join(directory, "entities.data"), self.resources)
+        self.degrees = map_array(os.path.join(directory, "entities.degrees"), "I", self.resources)
+        self.form_offsets = map_array(os.path.join(directory, "forms.offsets"), "Q", self.resources)
+        self.form_data = map_file(os.path.join(directory, "forms.data"), self.resources)
+        self.postings_offsets = map_array(os.path.join(directory, "postings.offsets"), "Q", self.resources)
+        self.postings = map_array(os.path.join(directory, "postings.entities"), "I", self.resources)
+        self.ngram_offsets = map_array(os.path.join(directory, "ngrams.offsets"), "Q", self.resources)
+        self.ngram_data = map_file(os.path.join(directory, "ngrams.data"), self.resources)
+        self.ngram_postings_offsets = map_array(
+            os.path.join(directory, "ngram_postings.offsets"), "Q", self.resources
+        )
+        self.ngram_postings = map_array(os.path.join(directory, "ngram_postings.forms"), "I", self.resources)
+
+    def get_entity(self, entity_id):
+        return self.entity_data[self.entity_offsets[entity_id] : self.entity_offsets[entity_id + 1]].decode("utf-8")
+
+    def get_form(self, form_id):
+        return self.form_data[self.form_offsets[form_id] : self.form_offsets[form_id + 1]]
+
+    def find_form(self, form):
+        """
+        Find the ID of the (encoded) surface form.
+        Return: int (or None, if the surface form is not in the index)
+        """
+        form_id = find_string(self.form_offsets, self.form_data, self.number_of_forms, form)
+        if form_id < self.number_of_forms and self.get_form(form_id) == form:
+            return form_id
+        return None
+
+    def get_entity_ids(self, form_id, k):
+        """
+        Get the k most popular entities of the surface form.
+        Return: list of entity IDs (int)
+        """
+        start = self.postings_offsets[form_id]
+        end = min(self.postings_offsets[form_id + 1], start + k)
+        return self.postings[start:end].tolist()
+
+    def rank(self, entity_ids, k):
+        """
+        Rank the entities by their degree (then by ID), without duplicates.
+        Return: list of the k first entities
+        """
+        degrees = self.degrees
+        entity_ids = heapq.nsmallest(k, set(entity_ids), key=lambda entity_id: (-degrees[entity_id], entity_id))
+        return [self.get_entity(entity_id) for entity_id in entity_ids]
+
+    def exact(self, text, k=DEFAULT_RESULTS):
+        """
+        Look up the entities with the given text (after normalization) as label or alias.
+        Return: list of entities
+        """
+        form_id = self.find_form(normalize(text).encode("utf-8"))
+        if form_id is None:
+            return []
+        return [self.get_entity(entity_id) for entity_id in self.get_entity_ids(form_id, k)]
+
+    def prefix(self, text, k=DEFAULT_RESULTS):
+        """
+        Look up the entities with a label or alias starting with the given text (after normalization).
+        For short prefixes, only the first MAX_PREFIX_FORMS surface forms are considered.
+        Return: list of entities
+        """
+        prefix = normalize(text).encode("utf-8")
+        if not prefix:
+            return []
+        start = find_string(self.form_offsets, self.form_data, self.number_of_forms, prefix)
+        # UTF-8 has no byte 0xFF: all surface forms with the prefix are smaller
+        end = find_string(self.form_offsets, self.form_data, self.number_of_forms, prefix + b"\xff")
+        offsets = self.postings_offsets[start : min(end, start + MAX_PREFIX_FORMS) + 1].tolist()
+        entity_ids = list()
+        for form_start, form_end in zip(offsets, offsets[1:]):
+            entity_ids.extend(self.postings[form_start : min(form_end, form_start + k)])
+        return self.rank(entity_ids, k)
+
+    def ngram(self, text, k=DEFAULT_RESULTS, min_similarity=MIN_SIMILARITY):
+        """
+        Look up the entities with a label or alias similar to the given text (after normalization),
+        by the Dice coefficient of their trigrams. Matches are ranked by similarity, then by degree.
+        Candidates are collected from the postings of the rarest trigrams only (prefix filtering):
+        surface forms sharing none of them cannot reach the minimum similarity.
+        Return: list of entities
+        """
+        form = normalize(text)
+        if not form:
+            return []
+        ngrams = get_ngrams(form)
+        postings = list()
+        for ngram in ngrams:
+            ngram = ngram.encode("utf-8")
+            ngram_id = find_string(self.ngram_offsets, self.ngram_data, self.number_of_ngrams, ngram)
+            start = end = 0
+            if ngram_id < self.number_of_ngrams:
+                if self.ngram_data[self.ngram_offsets[ngram_id] : self.ngram_offsets[ngram_id + 1]] == ngram:
+                    start = self.ngram_postings_offsets[ngram_id]
+                    end = self.ngram_postings_offsets[ngram_id + 1]
+            postings.append((end - start, start, end))
+        postings.sort()
+        # minimum number of shared trigrams for the minimum similarity (for the smallest possible surface form)
+        min_overlap = max(1, math.ceil(min_similarity * len(ngrams) / (2 - min_similarity)))
+        counts = Counter()
+        for _, start, end in postings[: len(postings) - min_overlap + 1]:
+            counts.update(self.ngram_postings[start:end])
+        for length, start, end in postings[len(postings) - min_overlap + 1 :]:
+            if len(counts) * BISECT_COST < length:
+                for form_id in counts:
+                    position = bisect_left(self.ngram_postings, form_id, start, end)
+                    if position < end and self.ngram_postings[position] == form_id:
+                        counts[form_id] += 1
+            else:
+                # cheaper to count all: surface forms which are no candidates stay below the minimum overlap
+                counts.update(self.ngram_postings[start:end])
+        candidates = list()
+        for form_id, count in counts.most_common(MAX_NGRAM_CANDIDATES):
+            form_ngrams = get_ngrams(self.get_form(form_id).decode("utf-8"))
+            similarity = 2 * count / (len(ngrams) + len(form_ngrams))
+            if similarity >= min_similarity:
+                for entity_id in self.get_entity_ids(form_id, k):
+                    candidates.append((-similarity, -self.degrees[entity_id], entity_id))
+        entities = list()
+        for _, _, entity_id in sorted(candidates):
+            entity = self.get_entity(entity_id)
+            if not entity in entities:
+                entities.append(entity)
+                if len(entities) == k:
+                    break
+        return entities
+
+    def search(self, text, k=DEFAULT_RESULTS):
+        """
+        Look up the entities for the text: exact matches first, then prefix matches, then similar matches.
+        Return: list of entities
+        """
+        entities = self.exact(text, k)
+        for lookup in (self.prefix, self.ngram):
+            if len(entities) >= k:
+                break
+            entities.extend(entity for entity in lookup(text, k) if not entity in entities)
+        return entities[:k]
+
+    def close(self):
+        close_resources(self.resources)
+
+
+def get_sample_queries(index, number_of_queries, seed=0):
+    """
+    Sample queries from the surface forms of the index: the surface form itself,
+    its first half (prefix), and a misspelled version (two characters swapped).
+    Return: list of (exact query, prefix query, misspelled query)
+    """
+    rng = random.Random(seed)
+    queries = list()
+    for _ in range(number_of_queries):
+        form = index.get_form(rng.randrange(index.number_of_forms)).decode("utf-8")
+        position = rng.randrange(len(form) - 1) if len(form) > 1 else 0
+        misspelled = form[:position] + form[position + 1 : position + 2] + form[position : position + 1]
+        misspelled += form[position + 2 :]
+        queries.append((form, form[: max(1, len(form) // 2)], misspelled))
+    return queries
+
+
+def benchmark(index, number_of_queries, k=DEFAULT_RESULTS):
+    """
+    Measure the latency of the lookups over a sample of queries (see 'get_sample_queries').
+    Return: dict lookup -> (median, 95th percentile, 99th percentile) latency in milliseconds
+    """
+    queries = get_sample_queries(index, number_of_queries)
+    lookups = [
+        ("exact", index.exact, 0),
+        ("prefix", index.prefix, 1),
+        ("ngram", index.ngram, 2),
+        ("search", index.search, 2),
+    ]
+    results = dict()
+    for name, lookup, query_index in lookups:
+        latencies = list()
+        for query in queries:
+            start_time = time.perf_counter()
+            lookup(query[query_index], k)
+            latencies.append(1000 * (time.perf_counter() - start_time))
+        latencies.sort()
+        results[name] = tuple(latencies[int(q * (len(latencies) - 1))] for q in (0.5, 0.95, 0.99))
+    return results
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--language", default="en", help="language of the labels and aliases to index (default: en)")
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) for building the index; larger runs are spilled to disk (default: 1024)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="NUMBER_OF_QUERIES",
+        help="measure the lookup latency of the existing index over a sample of queries, instead of building it",
+    )
+    args = parser.parse_args()
+    start_time = time.time()
+    if args.benchmark:
+        index = LabelIndex()
+        for name, latencies in benchmark(index, args.benchmark).items():
+            print(name + ": median/p95/p99 = " + "/".join("{:.3f}".format(latency) for latency in latencies) + " ms")
+        index.close()
+    else:
+        dict_paths = [
+            os.path.join(PATH_TO_DICTS_DIR, get_dict_name(dict_type, args.language) + "_dict.tsv")
+            for dict_type in ("labels", "aliases")
+        ]
+        entities, forms = build_label_index(dict_paths, memory_budget=args.memory_budget << 20)
+        print("Indexed " + str(forms) + " surface forms of " + str(entities) + " entities")
+    print("Time(label_index): " + str(time.time() - start_time))
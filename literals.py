@@ -0,0 +1,49 @@
+"""
+Parse literals in n-triples.
+A literal is parsed once per line (closing quote, language tag and datatype),
+and the result is shared by all extractors and filters.
+"""
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+NON_LITERAL = (None, b"", b"")
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def parse_literal(o):
+    """
+    Parse the given object (+ " .", the line ending), if it is a literal.
+    Language tags and datatypes cannot contain quotes,
+    so the last quote in the object closes the literal.
+    Return: (value, language, datatype) with the language tag in lower case,
+            or NON_LITERAL if the object is not a literal
+    """
+    if not o.startswith(b'"'):
+        return NON_LITERAL
+    closing_quote = o.rfind(b'"')
+    value = o[1:closing_quote]
+    suffix = o[closing_quote + 1 :].split(b" ", 1)[0]
+    if suffix.startswith(b"@"):
+        return value, suffix[1:].lower(), b""
+    if suffix.startswith(b"^^"):
+        return value, b"", suffix[2:]
+    return value, b"", b""
+
+
+def get_primary_language(language):
+    """
+    Get the primary subtag of the language tag (e.g. 'en' for 'en-gb').
+    Return: bytes
+    """
+    return language.split(b"-", 1)[0]
+
+
+def get_literal_text(value):
+    """
+    Get the text of the literal value, as stored in the label/alias/description dicts.
+    Return: str
+    """
+    return value.replace(b'"', b"").decode("utf-8")
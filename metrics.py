@@ -0,0 +1,190 @@
+"""
+Optional instrumentation of the pipeline stages.
+Metrics are enabled by 'configure' (e.g. with --metrics <directory> in the stages), which stores the settings
+in the environment, such that all worker processes inherit them. Each process collects its metrics
+(e.g. processed lines, hits per filter, dict sizes, peak RSS) at batch granularity, and reports them periodically:
+as a line in <directory>/metrics.jsonl (shared by all processes), and as a Prometheus text file
+<directory>/<stage>_<pid>.prom (e.g. for the textfile collector of the node exporter).
+Optionally, a sampling profiler records the stacks of each process (see 'SamplingProfiler'),
+and stores them in <directory>/<stage>_<pid>.folded (collapsed stacks, e.g. for flamegraph.pl).
+Without 'configure', 'get_metrics' returns None, so stages only check for None once per batch.
+"""
+
+import atexit
+import collections
+import json
+import os
+import resource
+import signal
+import sys
+import time
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+METRICS_DIR_VARIABLE = "WIKIDATA_METRICS_DIR"
+PROFILE_INTERVAL_VARIABLE = "WIKIDATA_PROFILE_INTERVAL"
+METRICS_FILE_NAME = "metrics.jsonl"
+METRIC_PREFIX = "wikidata_"
+REPORT_INTERVAL = 10.0
+PROC_STATUS_PATH = "/proc/self/status"
+# metrics of the current process, per stage
+REGISTRY = dict()
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def configure(directory, profile_interval=None):
+    """
+    Enable the metrics (and optionally the sampling profiler, with the given interval in seconds)
+    for this process and all processes started by it.
+    Return: None
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[METRICS_DIR_VARIABLE] = os.path.abspath(directory)
+    if profile_interval:
+        os.environ[PROFILE_INTERVAL_VARIABLE] = str(profile_interval)
+
+
+def get_metrics(stage):
+    """
+    Get the metrics of the stage in the current process (created on first use).
+    Return: Metrics (or None, if metrics are not enabled)
+    """
+    directory = os.environ.get(METRICS_DIR_VARIABLE)
+    if not directory:
+        return None
+    metrics = REGISTRY.get(stage)
+    if metrics is None or metrics.pid != os.getpid():
+        profile_interval = os.environ.get(PROFILE_INTERVAL_VARIABLE)
+        metrics = REGISTRY[stage] = Metrics(directory, stage, float(profile_interval) if profile_interval else None)
+    return metrics
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the current process.
+    On Linux, the high-water mark of the address space is used, as the maximum RSS of getrusage
+    is inherited by spawned processes (i.e. includes the peak of the parent process before exec).
+    Return: int (bytes)
+    """
+    if os.path.exists(PROC_STATUS_PATH):
+        with open(PROC_STATUS_PATH, "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def format_labels(labels):
+    return ",".join(name + '="' + str(value).replace('"', '\\"') + '"' for name, value in labels)
+
+
+class Metrics:
+    """
+    Counters and gauges of a stage in the current process, with optional labels (e.g. the filter).
+    Names ending with '_total' are counters, other names gauges.
+    """
+
+    def __init__(self, directory, stage, profile_interval=None, interval=REPORT_INTERVAL):
+        self.directory = directory
+        self.stage = stage
+        self.pid = os.getpid()
+        self.interval = interval
+        self.values = dict()
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.profiler = SamplingProfiler(profile_interval) if profile_interval else None
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def update_rates(self, seconds):
+        """
+        Set the throughput (lines and bytes per second) from the processed lines and bytes (if counted),
+        and the given time, as well as the peak RSS.
+        Return: None
+        """
+        for unit in ("lines", "bytes"):
+            if seconds > 0 and (unit + "_total", ()) in self.values:
+                self.set(unit + "_per_second", round(self.get(unit + "_total") / seconds, 1))
+        self.set("peak_rss_bytes", get_peak_rss())
+
+    def report(self, force=False):
+        """
+        Write the metrics (if the report interval has passed since the last report, or forced):
+        append a line to the JSON-lines file, and replace the Prometheus text file of the process.
+        Return: None
+        """
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        self.set("peak_rss_bytes", get_peak_rss())
+        values = [(key, round(value, 6) if isinstance(value, float) else value) for key, value in self.values.items()]
+        values.sort()
+        record = {"time": round(now, 3), "stage": self.stage, "pid": self.pid, "metrics": dict()}
+        for (name, labels), value in values:
+            record["metrics"][name + ("{" + format_labels(labels) + "}" if labels else "")] = value
+        with open(os.path.join(self.directory, METRICS_FILE_NAME), "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+        lines = list()
+        described = set()
+        for (name, labels), value in values:
+            metric = METRIC_PREFIX + name
+            if not metric in described:
+                described.add(metric)
+                lines.append("# TYPE " + metric + (" counter" if name.endswith("_total") else " gauge"))
+            labels = (("stage", self.stage), ("pid", self.pid)) + labels
+            lines.append(metric + "{" + format_labels(labels) + "} " + str(value))
+        path = os.path.join(self.directory, self.stage + "_" + str(self.pid))
+        with open(path + ".prom.tmp", "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(path + ".prom.tmp", path + ".prom")
+        if self.profiler:
+            self.profiler.write(path + ".folded")
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a timer signal (on the CPU time of the process) interrupts the process
+    every interval (seconds), and the current stack is counted.
+    """
+
+    def __init__(self, interval):
+        self.stacks = collections.Counter()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        # the signal handlers are reset when the interpreter shuts down, a pending timer would kill the process
+        atexit.register(self.stop)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+    def sample(self, signum, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        """
+        Store the sampled stacks in the collapsed format ("frame;frame;frame count" per line).
+        Return: None
+        """
+        with open(path + ".tmp", "w") as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write(stack + " " + str(count) + "\n")
+        os.replace(path + ".tmp", path)
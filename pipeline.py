@@ -0,0 +1,547 @@
+"""
+Run the whole pipeline (predicate catalog, filtering, qualifier resolution, graph store) with a single pool of workers.
+The stages form a DAG, and are split into tasks, which start as soon as their inputs are available:
+
+    catalog -> filter -> partition -> unique_predicates -> qualifiers -> pruning -> output -> graph_store
+                      -> merge_dicts
+
+The shard of each chunk is partitioned by subject entity (see 'resolve_qualifiers.partition_shard') as soon as
+the chunk is filtered, instead of after the whole dump. Once all shards are partitioned, the counter ranges of
+the fact-specific predicates are known, and the passes of each partition run as a chain of tasks.
+The dicts are merged alongside the resolution of the qualifiers.
+At most one task per worker is in flight, and ready tasks of later stages go first, such that intermediate
+data is consumed as soon as it is produced. The output is identical to running the stages one after another
+(resolve_qualifiers.py with the same number of workers).
+Per stage, the elapsed time (from the start of its first task to the end of its last task)
+and the total time of its tasks are reported (and with --metrics, also written periodically, see 'metrics').
+"""
+
+import argparse
+import concurrent.futures
+import heapq
+import itertools
+import os
+import shutil
+import time
+
+from checkpoints import Checkpoint, get_stage_key, remove_checkpoint
+from dump_io import (
+    COMPRESSION_EXTENSIONS,
+    MANIFEST_NAME,
+    compress_file,
+    compute_byte_ranges,
+    write_manifest,
+)
+from extract_special_predicates import (
+    extract_predicate_types,
+    get_catalog_path,
+    load_special_predicates,
+    store_predicate_catalog,
+)
+from filter_wikidata import (
+    DEFAULT_CHUNK_SIZE,
+    DOMAIN_DICT_NAME,
+    PATH_TO_CHUNK_LOG,
+    PATH_TO_OUTPUT_DIR,
+    PATH_TO_RUNS_DIR,
+    commit_chunk,
+    get_chunks,
+    get_committed_chunks,
+    get_dict_names,
+    get_filter_stage_key,
+    get_output_paths,
+    init_worker,
+    is_domain_restricted,
+    load_entity_ids,
+    load_filter_config,
+    merge_dict,
+    prune_triples,
+    remove_stale_files,
+    split_byte_range,
+)
+from graph_store import META_NAME, PATH_TO_GRAPH_DIR, STORE_FILES, build_graph_store
+from metrics import configure, get_metrics
+from resolve_qualifiers import (
+    PATH_TO_COLUMNAR_OUTPUT_FILE,
+    PATH_TO_OUTPUT_FILE,
+    PATH_TO_PARTITIONS_DIR,
+    compute_offsets,
+    concatenate_partitions,
+    create_partition_unique_predicates,
+    export_columnar,
+    partition_shard,
+    prune_partition_duplicates,
+    remove_partition_inputs,
+    resolve_partition,
+    resolve_partition_qualifiers,
+    sum_partition_counts,
+)
+from statement_index import DEFAULT_MEMORY_BUDGET
+from stream_io import add_io_arguments, configure_io_from_args
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+# stages with their upstream stages (in topological order, later stages have priority)
+STAGES = {
+    "catalog": [],
+    "filter": ["catalog"],
+    "partition": ["filter"],
+    "merge_dicts": ["filter"],
+    "unique_predicates": ["partition"],
+    "qualifiers": ["unique_predicates"],
+    "pruning": ["qualifiers"],
+    "output": ["pruning"],
+    "graph_store": ["output"],
+}
+DIRECTORIES = ["tmp_dumps", "dicts", "dumps", "checkpoints", PATH_TO_OUTPUT_DIR, PATH_TO_RUNS_DIR]
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def run_task(function, args):
+    """
+    Run the function of a task (in a worker), and measure its time.
+    Return: (result, start time, end time)
+    """
+    start_time = time.time()
+    result = function(*args)
+    return result, start_time, time.time()
+
+
+def filter_chunk(ext_id_predicates, geo_predicates, *args):
+    """
+    Filter a chunk of the dump (see 'filter_wikidata.prune_triples'), with the special predicates of the dump.
+    Return: dict
+    """
+    init_worker(ext_id_predicates, geo_predicates)
+    return prune_triples(*args)
+
+
+def write_output(partitions, columnar, compression):
+    """
+    Concatenate the outputs of the partitions into the output file, and optionally
+    export it in the columnar format, or compress it.
+    Return: None
+    """
+    concatenate_partitions(partitions)
+    if columnar:
+        export_columnar()
+    if compression:
+        compress_file(PATH_TO_OUTPUT_FILE, compression)
+
+
+class Pipeline:
+    """
+    Run tasks on a pool of workers, as soon as their dependencies are done.
+    Dependencies are names of tasks or of stages: a stage is complete, once its upstream stages
+    are complete and all its tasks are done. When a stage is complete, its hook is called (in the
+    main process), which can add tasks to later stages. Tasks can also be added by the callbacks of tasks.
+    """
+
+    def __init__(self, workers, stages=STAGES):
+        self.workers = workers
+        self.stages = stages
+        self.priorities = {stage: -i for i, stage in enumerate(stages)}
+        self.sequence = itertools.count()
+        self.ready = list()
+        self.waiting = list()
+        self.done = set()
+        self.complete = set()
+        self.unfinished = {stage: 0 for stage in stages}
+        self.hooks = dict()
+        self.timings = {stage: {"tasks": 0, "start": None, "end": None, "busy": 0.0} for stage in stages}
+        self.metrics = get_metrics("pipeline")
+
+    def add(self, name, stage, function, args=(), dependencies=(), callback=None):
+        """
+        Add a task, which runs function(*args) in a worker, and passes the result to the callback.
+        Return: None
+        """
+        self.unfinished[stage] += 1
+        self.waiting.append((name, stage, function, args, list(dependencies), callback))
+
+    def on_complete(self, stage, hook):
+        self.hooks[stage] = hook
+
+    def update(self):
+        """
+        Complete the stages without unfinished tasks (calling their hooks),
+        and move the tasks whose dependencies are done to the ready tasks.
+        Return: None
+        """
+        for stage, upstream_stages in self.stages.items():
+            if stage in self.complete or self.unfinished[stage]:
+                continue
+            if all(upstream in self.complete for upstream in upstream_stages):
+                self.complete.add(stage)
+                if stage in self.hooks:
+                    self.hooks[stage]()
+        waiting = list()
+        for task in self.waiting:
+            if all(dependency in self.done or dependency in self.complete for dependency in task[4]):
+                heapq.heappush(self.ready, (self.priorities[task[1]], next(self.sequence), task))
+            else:
+                waiting.append(task)
+        self.waiting = waiting
+
+    def run(self):
+        """
+        Run all tasks (including the tasks added while running).
+        Return: None
+        """
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as executor:
+            futures = dict()
+            self.update()
+            while self.ready or futures:
+                while self.ready and len(futures) < self.workers:
+                    task = heapq.heappop(self.ready)[2]
+                    futures[executor.submit(run_task, task[2], task[3])] = task
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name, stage, _, _, _, callback = futures.pop(future)
+                    result, start_time, end_time = future.result()
+                    timing = self.timings[stage]
+                    timing["tasks"] += 1
+                    timing["start"] = min(timing["start"] or start_time, start_time)
+                    timing["end"] = max(timing["end"] or end_time, end_time)
+                    timing["busy"] += end_time - start_time
+                    if self.metrics:
+                        self.metrics.add("tasks_total", 1, step=stage)
+                        self.metrics.add("task_seconds_total", round(end_time - start_time, 3), step=stage)
+                        self.metrics.report()
+                    self.done.add(name)
+                    self.unfinished[stage] -= 1
+                    if callback:
+                        callback(result)
+                self.update()
+        if self.metrics:
+            self.metrics.report(force=True)
+        if self.waiting:
+            names = [task[0] for task in self.waiting]
+            raise RuntimeError("Tasks with unsatisfiable dependencies: " + ", ".join(names))
+
+    def print_summary(self):
+        for stage, timing in self.timings.items():
+            if not timing["tasks"]:
+                print(stage + ": skipped")
+                continue
+            elapsed = str(round(timing["end"] - timing["start"], 3)) + "s elapsed"
+            busy = str(round(timing["busy"], 3)) + "s in tasks"
+            print(stage + ": " + str(timing["tasks"]) + " tasks, " + elapsed + ", " + busy)
+
+
+class WikidataPipeline(Pipeline):
+    """
+    The tasks of all stages, added by the hooks of the stages and the callbacks of the tasks.
+    Stages that are finished with the same inputs are skipped, and the chunks committed by
+    an interrupted run of filter_wikidata.py (or of the pipeline) are not filtered again (see 'checkpoints').
+    Qualifiers are resolved from scratch, unless the stage is finished.
+    """
+
+    def __init__(self, file, workers, filter_config, args):
+        super().__init__(workers)
+        self.file = file
+        self.filter_config = filter_config
+        self.args = args
+        self.dict_names = get_dict_names(filter_config["languages"])
+        self.domain = is_domain_restricted(filter_config)
+        self.filter_outputs = get_output_paths(self.dict_names, args.json_dicts, self.domain)
+        self.columnar = args.export == "columnar"
+        if self.columnar:
+            self.output_path = PATH_TO_COLUMNAR_OUTPUT_FILE
+        else:
+            self.output_path = PATH_TO_OUTPUT_FILE + COMPRESSION_EXTENSIONS.get(args.compress, "")
+        self.graph_outputs = [os.path.join(PATH_TO_GRAPH_DIR, name) for name in STORE_FILES + [META_NAME]]
+        self.catalog_path = get_catalog_path(file)
+        self.predicate_types = dict()
+        self.results = list()
+        self.counts = dict()
+        self.filtered = False
+        self.resolve = True
+        self.log = None
+        for stage in self.stages:
+            if hasattr(self, "complete_" + stage):
+                self.on_complete(stage, getattr(self, "complete_" + stage))
+        # catalog: scan byte ranges of the dump for the types of the predicates
+        if not os.path.exists(self.catalog_path):
+            for i, (start, end) in enumerate(compute_byte_ranges(file, workers)):
+                callback = self.predicate_types.update
+                self.add("catalog_" + str(i), "catalog", extract_predicate_types, (file, start, end), [], callback)
+
+    def get_resolve_checkpoint(self):
+        # same key as resolve_qualifiers.py with the same number of workers
+        parameters = {
+            "workers": self.workers,
+            "streaming": self.args.streaming,
+            "export": self.args.export,
+            "compress": self.args.compress,
+        }
+        stage_key = get_stage_key([os.path.join(PATH_TO_OUTPUT_DIR, MANIFEST_NAME)], parameters)
+        return Checkpoint("resolve_qualifiers", stage_key, restart=self.args.restart)
+
+    def add_chunk(self, start, end):
+        chunk_id = next(self.chunk_ids)
+        chunk_args = (self.file, start, end, chunk_id, self.filter_config, self.args.binary, None)
+        chunk_args += (self.args.memory_budget << 20, self.args.split_slow_chunks)
+        self.add("chunk_" + str(chunk_id), "filter", filter_chunk, self.predicates + chunk_args, [], self.commit_chunk)
+
+    def commit_chunk(self, result):
+        self.results.append(result)
+        commit_chunk(self.checkpoint, self.log, self.file, result)
+        if result["rest"]:
+            for start, end in split_byte_range(*result["rest"], self.workers):
+                self.add_chunk(start, end)
+        self.add_partition(result)
+
+    def add_partition(self, result):
+        """
+        Add the task partitioning the shard of the chunk (see 'resolve_qualifiers.partition_shard').
+        Return: None
+        """
+        if not self.resolve:
+            return
+        chunk_id = result["chunk"]
+        shard_path = os.path.join(PATH_TO_OUTPUT_DIR, result["shard"]["name"])
+
+        def callback(counts):
+            self.counts[chunk_id] = counts
+
+        task_args = (chunk_id, shard_path, self.workers)
+        self.add("partition_" + str(chunk_id), "partition", partition_shard, task_args, [], callback)
+
+    def complete_catalog(self):
+        if self.predicate_types:
+            store_predicate_catalog(self.predicate_types, self.catalog_path)
+        ext_id_predicates, geo_predicates = load_special_predicates(self.file)
+        self.predicates = (
+            {p.encode("utf-8") for p in ext_id_predicates},
+            {p.encode("utf-8") for p in geo_predicates},
+        )
+        stage_key = get_filter_stage_key(self.file, self.filter_config, self.args.binary, None)
+        self.checkpoint = Checkpoint("filter_wikidata", stage_key, restart=self.args.restart)
+        self.filtered = self.checkpoint.is_finished(self.filter_outputs)
+        if self.filtered:
+            self.resolve = not self.get_resolve_checkpoint().is_finished([self.output_path])
+        if self.resolve:
+            # the partitions are not resumed, so a checkpoint of resolve_qualifiers.py would be stale
+            remove_checkpoint("resolve_qualifiers")
+            shutil.rmtree(PATH_TO_PARTITIONS_DIR, ignore_errors=True)
+            os.makedirs(PATH_TO_PARTITIONS_DIR)
+        self.results = get_committed_chunks(self.checkpoint)
+        for result in self.results:
+            self.add_partition(result)
+        if self.filtered:
+            return
+        remove_stale_files(self.results)
+        self.log = open(PATH_TO_CHUNK_LOG, "a" if self.results else "w")
+        self.chunk_ids = itertools.count(max([result["chunk"] + 1 for result in self.results], default=0))
+        committed_ranges = [(result["start"], result["end"]) for result in self.results]
+        for start, end in get_chunks(self.file, self.workers, self.args.chunk_size << 20, committed_ranges):
+            self.add_chunk(start, end)
+
+    def complete_filter(self):
+        self.results.sort(key=lambda result: result["start"])
+        if self.filtered:
+            return
+        self.log.close()
+        write_manifest(PATH_TO_OUTPUT_DIR, [result["shard"] for result in self.results])
+        if self.domain and not self.checkpoint.is_done("merge_" + DOMAIN_DICT_NAME):
+            # the other dicts are restricted to the entities in the domain dict
+            task_args = (DOMAIN_DICT_NAME, self.get_chunk_runs(), self.args.json_dicts)
+            self.add("merge_" + DOMAIN_DICT_NAME, "merge_dicts", merge_dict, task_args, [], self.merge_domain_dicts)
+        else:
+            self.merge_dicts()
+
+    def get_chunk_runs(self):
+        return [(result["chunk"], result["runs"]) for result in self.results]
+
+    def merge_domain_dicts(self, _):
+        self.checkpoint.commit("merge_" + DOMAIN_DICT_NAME)
+        self.merge_dicts()
+
+    def merge_dicts(self):
+        chunks = self.get_chunk_runs()
+        for dict_name in self.dict_names:
+            step = "merge_" + dict_name
+            if not self.checkpoint.is_done(step):
+                task_args = (dict_name, chunks, self.args.json_dicts, self.domain)
+                callback = lambda _, step=step: self.checkpoint.commit(step)
+                self.add(step, "merge_dicts", merge_dict, task_args, [], callback)
+
+    def complete_merge_dicts(self):
+        if not self.filtered:
+            self.checkpoint.finish(self.filter_outputs)
+
+    def complete_partition(self):
+        """
+        Compute the counter ranges of the partitions (see 'resolve_qualifiers.compute_offsets'),
+        and add the passes of each partition as a chain of tasks.
+        Return: None
+        """
+        if not self.resolve:
+            return
+        shard_ids = [result["chunk"] for result in self.results]
+        offsets = compute_offsets(sum_partition_counts([self.counts[i] for i in shard_ids], self.workers))
+        memory_budget = (self.args.memory_budget << 20) // self.workers
+        for k in range(self.workers):
+            predicate_offsets, type_offsets = offsets[k]
+            callback = lambda _, k=k: remove_partition_inputs(k, shard_ids)
+            if self.args.streaming:
+                task_args = (k, shard_ids, predicate_offsets, type_offsets, True, memory_budget)
+                self.add("qualifiers_" + str(k), "qualifiers", resolve_partition, task_args, [], callback)
+                continue
+            task_args = (k, shard_ids, predicate_offsets, type_offsets, memory_budget)
+            self.add("unique_predicates_" + str(k), "unique_predicates", create_partition_unique_predicates, task_args)
+            task_args = (k, memory_budget)
+            dependencies = ["unique_predicates_" + str(k)]
+            self.add("qualifiers_" + str(k), "qualifiers", resolve_partition_qualifiers, task_args, dependencies)
+            dependencies = ["qualifiers_" + str(k)]
+            self.add("pruning_" + str(k), "pruning", prune_partition_duplicates, (k,), dependencies, callback)
+
+    def complete_pruning(self):
+        if self.resolve:
+            self.add("output", "output", write_output, (self.workers, self.columnar, self.args.compress))
+
+    def complete_output(self):
+        if self.resolve:
+            self.get_resolve_checkpoint().finish([self.output_path])
+        if self.args.skip_graph_store:
+            return
+        self.graph_checkpoint = Checkpoint("graph_store", get_stage_key([self.output_path], {}))
+        if not self.graph_checkpoint.is_finished(self.graph_outputs):
+            graph_args = (self.output_path, PATH_TO_GRAPH_DIR, self.args.memory_budget << 20)
+            self.add("graph_store", "graph_store", build_graph_store, graph_args)
+
+    def complete_graph_store(self):
+        if not self.args.skip_graph_store:
+            self.graph_checkpoint.finish(self.graph_outputs)
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wikidata_dump_path")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument(
+        "--work-dir",
+        default=".",
+        help="directory in which the outputs (dicts/, dumps/, tmp_dumps/, checkpoints/) are stored",
+    )
+    parser.add_argument(
+        "--filter-config",
+        help="path to a JSON file selecting the filters to apply (see filter_wikidata.py)",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        help="languages for which labels, aliases and descriptions are extracted (overrides the filter config)",
+    )
+    parser.add_argument(
+        "--domain-classes",
+        nargs="+",
+        metavar="CLASS",
+        help="keep only the instances (P31) of the given classes (and the --domain-entities), overrides the config",
+    )
+    parser.add_argument(
+        "--domain-entities",
+        metavar="PATH",
+        help="keep only the entities listed in the file (one id per line), and the instances of the --domain-classes",
+    )
+    parser.add_argument(
+        "--domain-neighborhood",
+        action="store_true",
+        help="additionally keep the labels (and other dict entries) of the entities referenced by the domain",
+    )
+    parser.add_argument(
+        "--json-dicts",
+        action="store_true",
+        help="additionally store the merged dicts as JSON objects (e.g. dicts/labels_dict.json)",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the filtered shards as (normalized) binary triples",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE >> 20,
+        help="size (in MB) of the chunks of the dump, which are assigned to idle workers",
+    )
+    parser.add_argument(
+        "--split-slow-chunks",
+        type=float,
+        metavar="SECONDS",
+        help="split the rest of chunks taking longer than the given time into smaller chunks for idle workers",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) per worker for the dicts, in total for the statement indexes and the graph store",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="resolve the qualifiers of each partition in a single pass (see resolve_qualifiers.py)",
+    )
+    parser.add_argument(
+        "--export",
+        choices=["csv", "columnar"],
+        default="csv",
+        help="format of the resolved dump (see resolve_qualifiers.py)",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="compress the comma-separated output; zstd requires the zstandard package",
+    )
+    parser.add_argument("--skip-graph-store", action="store_true", help="do not build the graph store")
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the checkpoints of previous runs, and run all stages again",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="write metrics of the stages and workers (e.g. hits per filter, dict sizes) periodically to DIR",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="with --metrics, sample the stacks of the workers every SECONDS (CPU time) into DIR",
+    )
+    add_io_arguments(parser)
+    args = parser.parse_args()
+    if args.compress and args.export == "columnar":
+        parser.error("--compress requires the csv export (the columnar export is compressed already)")
+    if args.profile and not args.metrics:
+        parser.error("--profile requires --metrics")
+    if args.metrics:
+        configure(args.metrics, args.profile)
+    configure_io_from_args(args)
+    WIKIDATA_DUMP_PATH = os.path.abspath(args.wikidata_dump_path)
+    filter_config = load_filter_config(args.filter_config)
+    if args.languages:
+        filter_config["languages"] = args.languages
+    if args.domain_classes:
+        filter_config["domain_classes"] = args.domain_classes
+    if args.domain_entities:
+        filter_config["domain_entities"] = load_entity_ids(args.domain_entities)
+    if args.domain_neighborhood:
+        filter_config["domain_neighborhood"] = True
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.chdir(args.work_dir)
+    for directory in DIRECTORIES:
+        os.makedirs(directory, exist_ok=True)
+    start_time = time.time()
+    pipeline = WikidataPipeline(WIKIDATA_DUMP_PATH, args.workers, filter_config, args)
+    pipeline.run()
+    pipeline.print_summary()
+    print("Time(pipeline): " + str(time.time() - start_time))
@@ -0,0 +1,441 @@
+"""
+Dry run of a build: estimate its resources from a sample of the dump, and recommend the number of workers
+and the memory budget for this machine.
+The dump is divided into equally sized strata, and a small window (the lines starting within a byte range,
+see 'dump_io.iter_line_batches') at a random offset within each stratum is processed by the real stages:
+the scan for the predicate catalog, the filter chain with the dict extraction (see 'filter_wikidata.prune_triples'),
+the merge of the dicts, the passes of the qualifier resolution on the filtered sample, and the graph store.
+Counts, sizes and times are extrapolated to the whole dump by the share of its bytes in the sample.
+Statements cut at the edges of the windows are not resolved, so the resolution is estimated slightly low.
+Without a predicate catalog of the dump, the types of the predicates defined within the sample are used.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from dump_io import (
+    PATH_TO_GZIP_INDEX,
+    fingerprint_file,
+    get_compression,
+    get_dump_size,
+    iter_line_batches,
+    supports_random_access,
+    write_manifest,
+)
+from extract_special_predicates import EXT_ID_TYPES, GEO_TYPES, extract_predicate_types, get_catalog_path
+from filter_wikidata import (
+    DEFAULT_CHUNK_SIZE,
+    DICT_ENTRY_MEMORY,
+    DOMAIN_DICT_NAME,
+    PATH_TO_OUTPUT_DIR,
+    PATH_TO_RUNS_DIR,
+    get_dict_names,
+    get_dict_path,
+    init_worker,
+    is_domain_restricted,
+    load_filter_config,
+    merge_dict,
+    prune_triples,
+)
+from graph_store import META_NAME, PATH_TO_GRAPH_DIR, TERM_MEMORY, build_graph_store, get_sort_memory
+from metrics import get_peak_rss
+from resolve_qualifiers import (
+    PATH_TO_INTERMEDIATE_NODES,
+    PATH_TO_OUTPUT_FILE,
+    PATH_TO_QUALIFIER_DUMP,
+    PATH_TO_QUALIFIER_TRIPLES,
+    PATH_TO_UNIQUE_PREDICATES_DUMP,
+    create_unique_predicates,
+    prune_duplicate_lines,
+    resolve_qualifiers,
+)
+from statement_index import ENTRY_MEMORY, StatementIndex
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+DEFAULT_WINDOWS = 100
+DEFAULT_WINDOW_SIZE = 1 << 20
+DIRECTORIES = ["dicts", PATH_TO_RUNS_DIR, PATH_TO_OUTPUT_DIR, "tmp_dumps"]
+# share of the available memory that is planned for the workers
+MEMORY_SAFETY = 0.8
+MIN_MEMORY_BUDGET = 64 << 20
+MEMINFO_PATH = "/proc/meminfo"
+# z-score of the 95% confidence interval of the estimated number of triples
+CONFIDENCE_Z = 1.96
+RESOLVE_PASSES = [
+    ("create_unique_predicates", create_unique_predicates),
+    ("resolve_qualifiers", resolve_qualifiers),
+    ("prune_duplicate_lines", prune_duplicate_lines),
+]
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def get_windows(size, windows, window_size, seed=0):
+    """
+    Draw a window (byte range) at a random offset within each of the (equally sized) strata of the dump.
+    Return: list of (start, end) tuples, sorted
+    """
+    rng = random.Random(seed)
+    windows = max(1, min(windows, size // max(1, window_size)))
+    ranges = list()
+    for i in range(windows):
+        stratum_start = size * i // windows
+        stratum_end = size * (i + 1) // windows
+        start = stratum_start + rng.randrange(max(1, stratum_end - stratum_start - window_size + 1))
+        ranges.append((start, min(start + window_size, stratum_end)))
+    return ranges
+
+
+def get_available_memory():
+    """
+    Get the memory available for new processes (without swapping).
+    Return: int (bytes)
+    """
+    if os.path.exists(MEMINFO_PATH):
+        with open(MEMINFO_PATH, "r") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def count_lines(paths):
+    """
+    Count the lines and (uncompressed) bytes of the files.
+    Return: (int, int)
+    """
+    lines = 0
+    size = 0
+    for path in paths:
+        for batch in iter_line_batches(path):
+            lines += len(batch)
+            size += sum(map(len, batch)) + len(batch)
+    return lines, size
+
+
+def get_predicate_sets(predicate_types):
+    """
+    Get the identifier predicates and geo predicates (see 'extract_special_predicates.load_special_predicates').
+    Return: (set, set) of bytes
+    """
+    ext_id_predicates = {p.encode("utf-8") for p, t in predicate_types.items() if t in EXT_ID_TYPES}
+    geo_predicates = {p.encode("utf-8") for p, t in predicate_types.items() if t in GEO_TYPES}
+    return ext_id_predicates, geo_predicates
+
+
+def sample_dump(dump_path, windows, filter_config, predicate_types=None):
+    """
+    Run the stages on the windows of the dump (in the current directory, see 'DIRECTORIES').
+    Without predicate types, the catalog is taken from the scan of the windows.
+    Return: dict with the measurements
+    """
+    sample = {"bytes": 0, "window_lines": [], "window_bytes": []}
+    sample_types = dict()
+    start_time = time.perf_counter()
+    for start, end in windows:
+        sample_types.update(extract_predicate_types(dump_path, start, end))
+    sample["catalog_seconds"] = time.perf_counter() - start_time
+    sample["catalog"] = predicate_types is not None
+    init_worker(*get_predicate_sets(predicate_types if predicate_types is not None else sample_types))
+    # filter each window as a chunk
+    results = list()
+    for chunk_id, (start, end) in enumerate(windows):
+        result = prune_triples(dump_path, start, end, chunk_id, filter_config)
+        results.append(result)
+        sample["bytes"] += end - start
+        sample["window_bytes"].append(end - start)
+        sample["window_lines"].append(result["lines"])
+    sample["lines"] = sum(result["lines"] for result in results)
+    sample["filter_seconds"] = sum(result["seconds"] for result in results)
+    sample["kept_lines"] = sum(result["shard"]["lines"] for result in results)
+    sample["shard_bytes"] = sum(result["shard"]["bytes"] for result in results)
+    # lines without a wikidata subject are skipped before the filter chain
+    sample["hits"] = {"non_wikidata_subjects": sample["lines"] - sample["kept_lines"]}
+    for result in results:
+        for name, count in result["hits"].items():
+            sample["hits"][name] = sample["hits"].get(name, 0) + count
+            sample["hits"]["non_wikidata_subjects"] -= count
+    # dicts: entries of the runs of each chunk, and the merged dicts
+    chunk_entries = dict()
+    for name in os.listdir(PATH_TO_RUNS_DIR):
+        chunk_id = int(name.rsplit("_", 2)[1])
+        entries, _ = count_lines([os.path.join(PATH_TO_RUNS_DIR, name)])
+        chunk_entries[chunk_id] = chunk_entries.get(chunk_id, 0) + entries
+    sample["dict_entries"] = sum(chunk_entries.values())
+    sample["max_dict_entries_per_byte"] = max(
+        chunk_entries.get(result["chunk"], 0) / max(1, result["end"] - result["start"]) for result in results
+    )
+    domain = is_domain_restricted(filter_config)
+    dict_names = ([DOMAIN_DICT_NAME] if domain else []) + get_dict_names(filter_config["languages"])
+    chunks = [(result["chunk"], result["runs"]) for result in results]
+    start_time = time.perf_counter()
+    for dict_name in dict_names:
+        merge_dict(dict_name, chunks, False, domain and dict_name != DOMAIN_DICT_NAME)
+    sample["merge_seconds"] = time.perf_counter() - start_time
+    sample["dicts"] = len(dict_names)
+    sample["dict_bytes"] = sum(os.path.getsize(get_dict_path(dict_name) + ".tsv") for dict_name in dict_names)
+    # qualifier resolution on the filtered sample
+    write_manifest(PATH_TO_OUTPUT_DIR, [result["shard"] for result in results])
+    sample["resolve_seconds"] = dict()
+    for name, function in RESOLVE_PASSES:
+        start_time = time.perf_counter()
+        function()
+        sample["resolve_seconds"][name] = time.perf_counter() - start_time
+        if name == "create_unique_predicates":
+            intermediate_nodes = StatementIndex(PATH_TO_INTERMEDIATE_NODES)
+            sample["intermediate_nodes"] = intermediate_nodes.records
+            intermediate_nodes.close()
+        elif name == "resolve_qualifiers":
+            qualifier_triples = StatementIndex(PATH_TO_QUALIFIER_TRIPLES)
+            sample["qualifier_triples"] = qualifier_triples.records
+            qualifier_triples.close()
+    sample["tmp_bytes"] = os.path.getsize(PATH_TO_UNIQUE_PREDICATES_DUMP) + os.path.getsize(PATH_TO_QUALIFIER_DUMP)
+    sample["output_lines"], sample["output_bytes"] = count_lines([PATH_TO_OUTPUT_FILE])
+    # peak RSS of the stages run by the workers
+    sample["peak_rss_bytes"] = get_peak_rss()
+    start_time = time.perf_counter()
+    build_graph_store(PATH_TO_OUTPUT_FILE, PATH_TO_GRAPH_DIR)
+    sample["graph_seconds"] = time.perf_counter() - start_time
+    with open(os.path.join(PATH_TO_GRAPH_DIR, META_NAME), "r") as fp:
+        sample["graph_terms"] = json.load(fp)["terms"]
+    return sample
+
+
+def estimate_build(sample, size, workers, chunk_size):
+    """
+    Extrapolate the measurements of the sample to the whole dump, for a build with the given number of workers.
+    The stages are assumed to scale linearly with the workers (the dicts are merged in parallel per dict).
+    Return: dict with the estimates
+    """
+    scale = size / sample["bytes"]
+    lines = sample["lines"] * scale
+    densities = [lines / window_size for lines, window_size in zip(sample["window_lines"], sample["window_bytes"])]
+    error = 0.0
+    if len(densities) > 1:
+        error = CONFIDENCE_Z * statistics.stdev(densities) / math.sqrt(len(densities)) * size
+    kept_share = sample["kept_lines"] / max(1, sample["lines"])
+    filtered_lines = lines * kept_share
+    # per filtered triple of the sample
+    resolve_scale = filtered_lines / max(1, sample["kept_lines"])
+    chunk_size = min(chunk_size, -(-size // workers))
+    graph_terms = sample["graph_terms"] * resolve_scale
+    output_triples = sample["output_lines"] * resolve_scale
+    estimate = {
+        "triples": round(lines),
+        "triples_error": round(error),
+        "filtered_triples": round(filtered_lines),
+        "output_triples": round(output_triples),
+        "survival": dict(),
+        "shard_bytes": round(sample["shard_bytes"] * scale),
+        "dict_entries": round(sample["dict_entries"] * scale),
+        "dict_bytes": round(sample["dict_bytes"] * scale),
+        "tmp_bytes": round(sample["tmp_bytes"] * resolve_scale),
+        "output_bytes": round(sample["output_bytes"] * resolve_scale),
+        # dicts of a chunk held in memory by a worker (without memory budget)
+        "chunk_dict_memory": round(sample["max_dict_entries_per_byte"] * chunk_size * DICT_ENTRY_MEMORY),
+        "intermediate_node_memory": round(sample["intermediate_nodes"] * resolve_scale * ENTRY_MEMORY),
+        "qualifier_triple_memory": round(sample["qualifier_triples"] * resolve_scale * ENTRY_MEMORY),
+        # the graph store (a single process) spills its terms and edges beyond the budget
+        "graph_term_memory": round(graph_terms * TERM_MEMORY),
+        "graph_edge_memory": get_sort_memory(round(graph_terms), round(output_triples)),
+        "worker_rss": sample["peak_rss_bytes"],
+        "seconds": {
+            "catalog": sample["catalog_seconds"] * scale / workers,
+            "filter": sample["filter_seconds"] * scale / workers,
+            "merge_dicts": sample["merge_seconds"] * scale / min(workers, sample["dicts"]),
+            "resolve_qualifiers": sum(sample["resolve_seconds"].values()) * resolve_scale / workers,
+            "graph_store": sample["graph_seconds"] * resolve_scale,
+        },
+    }
+    # share of the triples remaining after each filter (in the order pruning most triples first)
+    remaining = sample["lines"]
+    for name, hits in sorted(sample["hits"].items(), key=lambda item: -item[1]):
+        remaining -= hits
+        estimate["survival"][name] = {
+            "pruned": hits / max(1, sample["lines"]),
+            "remaining": remaining / max(1, sample["lines"]),
+        }
+    return estimate
+
+
+def recommend(sample, size, chunk_size, cpus, memory):
+    """
+    Recommend the number of workers and the memory budget (see filter_wikidata.py and pipeline.py):
+    as many workers as CPUs, such that each worker (its base memory and the dicts of its chunk within the budget)
+    fits into the available memory. The budget avoids spilling the dicts of a chunk if the memory allows,
+    and is at least MIN_MEMORY_BUDGET (with fewer workers, if required).
+    Return: (workers, memory budget in bytes, estimate for the workers, see 'estimate_build')
+    """
+    usable = memory * MEMORY_SAFETY
+    worker_rss = sample["peak_rss_bytes"]
+    workers = max(1, cpus)
+    while True:
+        estimate = estimate_build(sample, size, workers, chunk_size)
+        per_worker = usable / workers - worker_rss
+        memory_budget = min(per_worker, max(MIN_MEMORY_BUDGET, estimate["chunk_dict_memory"]))
+        if memory_budget >= MIN_MEMORY_BUDGET or workers == 1:
+            break
+        workers = max(1, min(workers - 1, int(usable // (worker_rss + MIN_MEMORY_BUDGET))))
+    memory_budget = max(MIN_MEMORY_BUDGET, int(memory_budget) >> 20 << 20)
+    return workers, memory_budget, estimate
+
+
+def format_bytes(value):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(value) < 1024 or unit == "TB":
+            return str(round(value, 1)) + " " + unit
+        value /= 1024
+
+
+def format_seconds(value):
+    hours, rest = divmod(int(value), 3600)
+    return "%d:%02d:%02d" % (hours, rest // 60, rest % 60)
+
+
+def print_plan(sample, estimate, workers, memory_budget, cpus, memory):
+    print("Sample: " + str(len(sample["window_lines"])) + " windows, " + format_bytes(sample["bytes"]))
+    if not sample["catalog"]:
+        # the filters of identifier and geo predicates are estimated low
+        print("No predicate catalog of the dump (see extract_special_predicates.py), using the types in the sample")
+    print("Triples: %d (+- %d)" % (estimate["triples"], estimate["triples_error"]))
+    print("Filtered triples: %d, output triples: %d" % (estimate["filtered_triples"], estimate["output_triples"]))
+    print("Filters (pruned share, remaining share):")
+    for name, survival in estimate["survival"].items():
+        print("    %-24s %6.2f%% %6.2f%%" % (name, 100 * survival["pruned"], 100 * survival["remaining"]))
+    print("Sizes:")
+    print("    filtered shards           " + format_bytes(estimate["shard_bytes"]))
+    print("    dicts                     " + format_bytes(estimate["dict_bytes"]))
+    print("    intermediate dumps        " + format_bytes(estimate["tmp_bytes"]))
+    print("    output                    " + format_bytes(estimate["output_bytes"]))
+    print("Memory:")
+    print("    worker base (peak RSS)    " + format_bytes(estimate["worker_rss"]))
+    print("    dicts per chunk           " + format_bytes(estimate["chunk_dict_memory"]))
+    print("    statement node index      " + format_bytes(estimate["intermediate_node_memory"]))
+    print("    qualifier triple index    " + format_bytes(estimate["qualifier_triple_memory"]))
+    print("    graph store terms         " + format_bytes(estimate["graph_term_memory"]))
+    print("    graph store edges         " + format_bytes(estimate["graph_edge_memory"]))
+    print("Time with " + str(workers) + " workers:")
+    for stage, seconds in estimate["seconds"].items():
+        print("    %-25s %s" % (stage, format_seconds(seconds)))
+    print("    %-25s %s" % ("total", format_seconds(sum(estimate["seconds"].values()))))
+    print("Recommended for " + str(cpus) + " CPUs and " + format_bytes(memory) + " available memory:")
+    print("    " + get_pipeline_args(workers, memory_budget))
+
+
+def get_pipeline_args(workers, memory_budget):
+    return "--workers " + str(workers) + " --memory-budget " + str(memory_budget >> 20)
+
+
+def plan_build(dump_path, windows, filter_config, catalog_dir=None):
+    """
+    Sample the dump in a temporary directory (see 'sample_dump'), with the predicate catalog and the gzip index
+    of the dump from catalog_dir/dicts (if they exist there), such that they are not built again.
+    Return: dict with the measurements
+    """
+    work_dir = tempfile.mkdtemp(prefix="wikidata_plan_")
+    try:
+        os.chdir(work_dir)
+        for directory in DIRECTORIES:
+            os.makedirs(directory, exist_ok=True)
+        fingerprint = fingerprint_file(dump_path)
+        predicate_types = None
+        for path in [get_catalog_path(dump_path), PATH_TO_GZIP_INDEX.format(fingerprint)]:
+            if catalog_dir and os.path.exists(os.path.join(catalog_dir, path)):
+                shutil.copyfile(os.path.join(catalog_dir, path), path)
+        if os.path.exists(get_catalog_path(dump_path)):
+            with open(get_catalog_path(dump_path), "r") as fp:
+                predicate_types = json.load(fp)
+        return sample_dump(dump_path, windows, filter_config, predicate_types)
+    finally:
+        os.chdir(os.path.dirname(work_dir))
+        shutil.rmtree(work_dir)
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wikidata_dump_path")
+    parser.add_argument("--windows", type=int, default=DEFAULT_WINDOWS, help="number of windows sampled from the dump")
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=DEFAULT_WINDOW_SIZE >> 10,
+        help="size (in KB) of the windows, the sample contains the lines starting within them",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the offsets of the windows")
+    parser.add_argument(
+        "--work-dir",
+        default=".",
+        help="directory of the build, whose predicate catalog and gzip index (in dicts/) are used if they exist",
+    )
+    parser.add_argument(
+        "--filter-config",
+        help="path to a JSON file selecting the filters to apply (see filter_wikidata.py)",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        help="languages for which labels, aliases and descriptions are extracted (overrides the filter config)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE >> 20,
+        help="size (in MB) of the chunks of the dump, as in the build",
+    )
+    parser.add_argument("--cpus", type=int, default=os.cpu_count(), help="number of CPUs of the build machine")
+    parser.add_argument(
+        "--memory",
+        type=int,
+        help="memory (in MB) of the build machine (by default, the memory available on this machine)",
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="print the measurements and estimates as JSON")
+    output.add_argument(
+        "--pipeline-args",
+        action="store_true",
+        help="print only the recommended arguments of pipeline.py (e.g. for prepare_wikidata_for_qa.sh)",
+    )
+    args = parser.parse_args()
+    WIKIDATA_DUMP_PATH = os.path.abspath(args.wikidata_dump_path)
+    filter_config = load_filter_config(args.filter_config)
+    if args.languages:
+        filter_config["languages"] = args.languages
+    memory = args.memory << 20 if args.memory else get_available_memory()
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.chdir(args.work_dir)
+    # the gzip index is built in dicts/ of the build on first use
+    if not supports_random_access(WIKIDATA_DUMP_PATH):
+        compression = get_compression(WIKIDATA_DUMP_PATH)
+        sys.exit("The " + compression + " dump cannot be sampled without decompressing it from the start")
+    size = get_dump_size(WIKIDATA_DUMP_PATH)
+    windows = get_windows(size, args.windows, args.window_size << 10, args.seed)
+    start_time = time.time()
+    # a spawned process starts without the memory of this process, such that its peak RSS is the one of a worker
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        sample = executor.submit(plan_build, WIKIDATA_DUMP_PATH, windows, filter_config, os.getcwd()).result()
+    workers, memory_budget, estimate = recommend(sample, size, args.chunk_size << 20, args.cpus, memory)
+    if args.pipeline_args:
+        print(get_pipeline_args(workers, memory_budget))
+    elif args.json:
+        plan = {"sample": sample, "estimate": estimate, "workers": workers, "memory_budget": memory_budget}
+        print(json.dumps(plan, indent=2))
+    else:
+        print_plan(sample, estimate, workers, memory_budget, args.cpus, memory)
+        print("Time(plan): " + str(time.time() - start_time))
@@ -1,22 +1,23 @@
 #!/bin/bash 
-if [ "$#" -ne 2 ]; then
-    echo "Error: Illegal number of parameters. Usage: ./prepare_wikidata_for_qa.sh <wikidata_dump_path> <number_of_workers>"
+if [ "$#" -lt 1 ] || [ "$#" -gt 2 ]; then
+    echo "Error: Illegal number of parameters. Usage: ./prepare_wikidata_for_qa.sh <wikidata_dump_path> [<number_of_workers>]"
     exit 1
 fi
 WIKIDATA_DUMP_PATH=$1
-NUMBER_OF_TMP_DUMPS=$2
-# create needed directories
-mkdir tmp_dumps
-mkdir dicts
-mkdir dumps
-# compute tmp_dump_size
-WIKIDATA_SIZE=$(stat -c%s "$WIKIDATA_DUMP_PATH")
-# wikidata size of <= 13000000000 triples assumed
-TMP_DUMP_LINES=$((13000000000/NUMBER_OF_TMP_DUMPS)) 
-# extract identifier_predicates
-python3 extract_special_predicates.py $WIKIDATA_DUMP_PATH
-split -l $TMP_DUMP_LINES $WIKIDATA_DUMP_PATH tmp_dumps/wd
-# filter wikidata and store result in nt-format
-python3 filter_wikidata.py
-# resolve qualifiers and store result in csv-format
-python3 resolve_qualifiers.py
\ No newline at end of file
+if [ "$#" -eq 2 ]; then
+    PIPELINE_ARGS="--workers $2"
+else
+    # without a number of workers, the workers and the memory budget are planned from a sample of the dump,
+    # see plan_build.py (run it without --pipeline-args for the estimated sizes and times)
+    PIPELINE_ARGS=$(python3 plan_build.py $WIKIDATA_DUMP_PATH --pipeline-args) || exit 1
+    echo "Planned: $PIPELINE_ARGS"
+fi
+# run all stages (predicate catalog, filtering, qualifier resolution, graph store) with overlapping tasks,
+# see pipeline.py for more options; the stages can also be run one after another:
+#   python3 extract_special_predicates.py $WIKIDATA_DUMP_PATH <number_of_workers>
+#   python3 filter_wikidata.py $WIKIDATA_DUMP_PATH <number_of_workers>
+#   python3 resolve_qualifiers.py --workers <number_of_workers>
+#   python3 graph_store.py
+# (each stage continues from its checkpoint in checkpoints/ after an interruption,
+# and is skipped if its inputs and outputs are unchanged)
+python3 pipeline.py $WIKIDATA_DUMP_PATH $PIPELINE_ARGS
@@ -1,186 +1,1040 @@
+import argparse
 import csv
 import json
+import os
 import re
+import struct
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+from binary_triples import EXTENSION, TripleWriter, is_binary_path, iter_triple_blocks
+from checkpoints import Checkpoint, get_stage_key
+from columnar import ColumnarWriter, is_columnar_path
+from dump_io import (
+    COMPRESSION_EXTENSIONS,
+    MANIFEST_NAME,
+    compress_file,
+    concatenate_shards,
+    get_shard_name,
+    get_shard_paths,
+    iter_line_batches,
+    write_manifest,
+)
+from literals import parse_literal
+from metrics import configure, get_metrics
+from statement_index import DEFAULT_MEMORY_BUDGET, StatementIndex, StatementIndexWriter, hash_term
+from stream_io import WriteBehind, add_io_arguments, configure_io_from_args
 
 #####################################################
 # CONSTANTS                                         #
 #####################################################
 DUMP_SPECIFICATION = "wikidata_clean"
-PATH_TO_INPUT_FILE = "dumps/" + DUMP_SPECIFICATION + ".nt"
+PATH_TO_INPUT_DIR = "dumps/" + DUMP_SPECIFICATION
 PATH_TO_UNIQUE_PREDICATES_DUMP = "tmp_dumps//" + DUMP_SPECIFICATION + "_unique_predicates.csv"
 PATH_TO_QUALIFIER_DUMP = "tmp_dumps//" + DUMP_SPECIFICATION + "_qualifiers_resolved.csv"
 PATH_TO_OUTPUT_FILE = "dumps/" + DUMP_SPECIFICATION + ".csv"
+PATH_TO_COLUMNAR_OUTPUT_FILE = "dumps/" + DUMP_SPECIFICATION + ".wdc"
+PATH_TO_INTERMEDIATE_NODES = "tmp_dumps/qualifier_intermediate_nodes.idx"
+PATH_TO_QUALIFIER_TRIPLES = "tmp_dumps/qualifier_triples.idx"
+PATH_TO_PARTITIONS_DIR = "tmp_dumps/partitions"
+PATH_TO_SPILL_FILE = "tmp_dumps/qualifier_spill"
 
 TYPE_PATTERN = re.compile("Q[0-9]+\-[0-9]+")
 
+# intermediate nodes index: statement node -> unique predicate (predicate id, counter)
+NODE_KEY_SIZE = 16
+UNIQUE_PREDICATE = struct.Struct(">IQ")
+# qualifier triples index: (subject, object) -> (base object, base predicate, unique predicate)
+SUBJECT_KEY_SIZE = 16
+TERM_KEY_SIZE = 8
+QUALIFIER_TRIPLE_VALUE_SIZE = 3 * TERM_KEY_SIZE
+TYPE_PREDICATE_HASH = hash_term(b"P31", TERM_KEY_SIZE)
+SUBJECT_CACHE_SIZE = 64
+
 #####################################################
 # FUNCTIONS                                         #
 #####################################################
 def normalize_object(kg_object):
-    if "http://www.wikidata.org" in kg_object:
-        return kg_object.rsplit("/", 1)[1]
-    if '"^^' in kg_object:
-        kg_object = kg_object.rsplit('"^^', 1)[0]
-        kg_object += '"'
-    if '"@en' in kg_object:
-        kg_object = kg_object.replace('"@en', "")
-        kg_object += '"'
-    o = kg_object
-    return o
+    """
+    Normalize the object: wikidata items are reduced to their id, and literals to their quoted value,
+    without datatype or language tag (see 'literals.parse_literal'), such that the literals of all kept languages
+    (e.g. '@en', '@en-gb' and '@de') are stored the same way.
+    Return: bytes
+    """
+    if b"http://www.wikidata.org" in kg_object:
+        return kg_object.rsplit(b"/", 1)[1]
+    value, _, _ = parse_literal(kg_object)
+    if value is None:
+        return kg_object
+    return b'"' + value + b'"'
 
 
 def normalize_wikidata_url(kg_item):
-    return kg_item.rsplit("/", 1)[1]
+    return kg_item.rsplit(b"/", 1)[1]
 
 
-def create_unique_predicates():
-    predicate_nodes = dict()
-    type_nodes = dict()
-    intermediate_nodes = dict()
-    with open(PATH_TO_INPUT_FILE, "r") as fp_in:
-        with open(PATH_TO_UNIQUE_PREDICATES_DUMP, "w") as fp_out:
-            line = fp_in.readline()
-            rows = ""
-            count = -1
-            while line:
-                currentLine = line
-                line = fp_in.readline()
-                s, p, o = currentLine.replace(">", "").replace("<", "").split(" ", 2)
-                # remove " .\n" at end of each triple from object
-                o = o[:-3]
-                # remove prefix-url from kg item
-                s, p, o = normalize_wikidata_url(s), normalize_wikidata_url(p), normalize_object(o)
-                o = o.strip()
-                # create unique type nodes
-                if p == "P31":
-                    if not type_nodes.get(o):
-                        type_nodes[o] = 1
-                        type_index = 0
-                    else:
-                        type_index = type_nodes[o]
-                        type_nodes[o] += 1
-                    o = o + "-" + str(type_index)
-                # create unique predicate nodes
-                if not predicate_nodes.get(p):
-                    predicate_nodes[p] = 1
-                    predicate_index = 0
-                else:
-                    predicate_index = predicate_nodes[p]
-                    predicate_nodes[p] += 1
-
-                p = p + "-" + str(predicate_index)
+def parse_triple(line):
+    """
+    Parse the n-triples line into (normalized) subject, predicate and object.
+    Return: (bytes, bytes, bytes)
+    """
+    s, p, o = line.replace(b">", b"").replace(b"<", b"").split(b" ", 2)
+    # remove " ." at end of each triple from object
+    o = o[:-2]
+    # remove prefix-url from kg item
+    s, p, o = normalize_wikidata_url(s), normalize_wikidata_url(p), normalize_object(o)
+    o = o.strip()
+    return s, p, o
+
+
+def iter_files_triple_batches(paths):
+    """
+    Iterate over the (normalized) triples of all files, in order.
+    Files are either n-triples files or binary triples files (see 'binary_triples').
+    Return: generator of lists of (s, p, o)
+    """
+    for path in paths:
+        if is_binary_path(path):
+            yield from iter_triple_blocks(path)
+        else:
+            for lines in iter_line_batches(path):
+                yield [parse_triple(line) for line in lines]
+
+
+def iter_intermediate_batches(path):
+    """
+    Iterate over the triples of an intermediate dump (comma-separated rows, or binary triples).
+    Return: generator of lists of (s, p, o)
+    """
+    if is_binary_path(path):
+        yield from iter_triple_blocks(path)
+    else:
+        for lines in iter_line_batches(path):
+            yield [line.split(b",", 2) for line in lines]
+
+
+def update_pass_metrics(metrics, step, triples, dict_sizes):
+    """
+    Update the metrics of the process after a batch of triples of a pass (step): processed triples,
+    throughput, the entries of the dicts held in memory, and the peak RSS; report them periodically.
+    Return: None
+    """
+    metrics.add("lines_total", len(triples))
+    metrics.add("triples_total", len(triples), step=step)
+    for name, size in dict_sizes.items():
+        metrics.set("dict_entries", size, dict=name)
+    metrics.update_rates(time.time() - metrics.start_time)
+    metrics.report()
+
+
+def get_intermediate_path(path, binary):
+    """
+    Get the path of the intermediate dump in the given format.
+    Return: str
+    """
+    if binary:
+        return os.path.splitext(path)[0] + EXTENSION
+    return path
+
+
+def write_rows(fp_out, rows):
+    if rows:
+        rows.append(b"")
+        fp_out.write(b"\n".join(rows))
+
+
+class CsvTripleWriter:
+    """
+    Write triples as comma-separated rows, with the interface of 'binary_triples.TripleWriter'.
+    """
+
+    def __init__(self, path):
+        self.fp = WriteBehind(open(path, "wb"))
+
+    def write(self, triples):
+        write_rows(self.fp, [s + b"," + p + b"," + o for s, p, o in triples])
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_triple_writer(path):
+    """
+    Open a writer for the triples on the given path, depending on the extension:
+    binary triples, columnar export (see 'columnar'), or comma-separated rows.
+    Return: TripleWriter, ColumnarWriter or CsvTripleWriter
+    """
+    if is_binary_path(path):
+        return TripleWriter(path)
+    if is_columnar_path(path):
+        return ColumnarWriter(path)
+    return CsvTripleWriter(path)
+
+
+def export_columnar(output_path=PATH_TO_OUTPUT_FILE, columnar_path=PATH_TO_COLUMNAR_OUTPUT_FILE):
+    """
+    Export the output (comma-separated rows) in the columnar format, and remove the output.
+    Return: None
+    """
+    with ColumnarWriter(columnar_path) as writer:
+        for triples in iter_intermediate_batches(output_path):
+            writer.write(triples)
+    os.remove(output_path)
+
+
+def make_unique(p, o, predicate_nodes, type_nodes):
+    """
+    Make the predicate (and the type in P31 facts) unique, by appending the next counter.
+    Return: (p, o)
+    """
+    # create unique type nodes
+    if p == b"P31":
+        if not type_nodes.get(o):
+            type_nodes[o] = 1
+            type_index = 0
+        else:
+            type_index = type_nodes[o]
+            type_nodes[o] += 1
+        o = o + b"-" + str(type_index).encode()
+    # create unique predicate nodes
+    if not predicate_nodes.get(p):
+        predicate_nodes[p] = 1
+        predicate_index = 0
+    else:
+        predicate_index = predicate_nodes[p]
+        predicate_nodes[p] += 1
+
+    p = p + b"-" + str(predicate_index).encode()
+    return p, o
+
+
+def resolve_statement(s, p, o, p_val, triples):
+    """
+    Resolve the triple with the statement node s, which belongs to the fact with the unique predicate p_val.
+    Return: (s, p)
+    """
+    # if qualifier predicate and predicate from dict are the same: create the corresponding triple from this
+    if p.split(b"-")[0] == p_val.split(b"-")[0]:
+        s = s.split(b"-")[0]
+        if s.startswith(b"q"):
+            s = b"Q" + s[1:]
+        p = p_val
+        # store in new dictionary subject, object, predicate (later used to prune direct triples)
+        if not s in triples:
+            triples[s] = dict()
+        triples[s][o] = p_val
+    # if not: add predicate as subject of this triple
+    else:
+        s = p_val
+    return s, p
+
+
+def index_subject_triples(subject_triples, type_predicate=b"P31"):
+    """
+    Index the qualifier triples (object, base object, base predicate, unique predicate) of a subject,
+    such that direct duplicates are found by a single lookup (see 'is_duplicate').
+    Triples are indexed by (base predicate, object), and type triples by (base predicate, base object).
+    Return: dict (key -> set of unique predicates)
+    """
+    subject_index = dict()
+    for o_s, o_s_base, p_s_base, p_s in subject_triples:
+        key = (p_s_base, o_s_base) if p_s_base == type_predicate else (p_s_base, o_s)
+        predicates = subject_index.get(key)
+        if predicates is None:
+            subject_index[key] = {p_s}
+        else:
+            predicates.add(p_s)
+    return subject_index
+
+
+def index_qualifier_triples(triples):
+    """
+    Index the qualifier triples (subject -> object -> unique predicate) per subject (see 'index_subject_triples').
+    Return: dict (subject -> subject index)
+    """
+    qualifier_index = dict()
+    for s, subject_triples in triples.items():
+        qualifier_index[s] = index_subject_triples(
+            (o_s, o_s.split(b"-")[0], p_s.split(b"-")[0], p_s) for o_s, p_s in subject_triples.items()
+        )
+    return qualifier_index
+
+
+def is_duplicate(p, o, subject_index):
+    """
+    Check whether the triple (with the subject of the given qualifier triples) is a direct triple,
+    which is already represented by a fact resolved from a statement node, i.e. a qualifier triple has
+    the same object (for types: the same base object) and a different predicate with the same base predicate.
+    Return: bool
+    """
+    p_base = p.split(b"-")[0]
+    key = (p_base, o.split(b"-")[0]) if p_base == b"P31" else (p_base, o)
+    predicates = subject_index.get(key)
+    return bool(predicates) and (len(predicates) > 1 or not p in predicates)
+
+
+def encode_unique_predicate(p, predicate_ids):
+    """
+    Encode the unique predicate (e.g. 'P31-42') as (predicate id, counter).
+    Predicates without id get the next free id.
+    Return: bytes
+    """
+    predicate, counter = p.rsplit(b"-", 1)
+    predicate_id = predicate_ids.get(predicate)
+    if predicate_id is None:
+        predicate_id = predicate_ids[predicate] = len(predicate_ids)
+    return UNIQUE_PREDICATE.pack(predicate_id, int(counter))
+
+
+def decode_unique_predicate(value, predicates):
+    predicate_id, counter = UNIQUE_PREDICATE.unpack(value)
+    return predicates[predicate_id] + b"-" + str(counter).encode()
+
+
+def encode_qualifier_triple(s, o, p_val):
+    """
+    Encode the qualifier triple for the qualifier triples index.
+    Within a subject, terms are identified by (shorter) hashes.
+    Return: (key, value)
+    """
+    key = hash_term(s, SUBJECT_KEY_SIZE) + hash_term(o, TERM_KEY_SIZE)
+    value = (
+        hash_term(o.split(b"-")[0], TERM_KEY_SIZE)
+        + hash_term(p_val.split(b"-")[0], TERM_KEY_SIZE)
+        + hash_term(p_val, TERM_KEY_SIZE)
+    )
+    return key, value
+
+
+def load_subject_index(qualifier_triples, s):
+    """
+    Look up the qualifier triples with the subject in the index, and index them (see 'index_subject_triples').
+    Return: dict
+    """
+    subject_triples = list()
+    for o_s, value in qualifier_triples.get_prefix(hash_term(s, SUBJECT_KEY_SIZE)):
+        o_s_base, p_s_base, p_s = value[:TERM_KEY_SIZE], value[TERM_KEY_SIZE:-TERM_KEY_SIZE], value[-TERM_KEY_SIZE:]
+        subject_triples.append((o_s, o_s_base, p_s_base, p_s))
+    return index_subject_triples(subject_triples, TYPE_PREDICATE_HASH)
+
+
+def is_indexed_duplicate(p, o, subject_index, predicate_hashes):
+    """
+    Same as 'is_duplicate', for qualifier triples loaded from the index (see 'load_subject_index').
+    Hashes of base predicates are cached in the given dict.
+    Return: bool
+    """
+    p_base = p.split(b"-")[0]
+    p_base_hash = predicate_hashes.get(p_base)
+    if p_base_hash is None:
+        p_base_hash = predicate_hashes[p_base] = hash_term(p_base, TERM_KEY_SIZE)
+    if p_base == b"P31":
+        key = (p_base_hash, hash_term(o.split(b"-")[0], TERM_KEY_SIZE))
+    else:
+        key = (p_base_hash, hash_term(o, TERM_KEY_SIZE))
+    predicates = subject_index.get(key)
+    return bool(predicates) and (len(predicates) > 1 or not hash_term(p, TERM_KEY_SIZE) in predicates)
+
+
+def create_unique_predicates(
+    input_paths=None,
+    unique_predicates_path=PATH_TO_UNIQUE_PREDICATES_DUMP,
+    intermediate_nodes_path=PATH_TO_INTERMEDIATE_NODES,
+    predicate_offsets=None,
+    type_offsets=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Make each appearance of a predicate (and of a type in P31 facts) unique, by appending a counter.
+    By default, all shards of the filtered dump are processed, and counters start at 0.
+    With offsets, the counter of each predicate (type) starts at the given offset.
+    The unique predicates of the statement nodes are stored in an index (see 'statement_index').
+    Return: None
+    """
+    if input_paths is None:
+        input_paths = get_shard_paths(PATH_TO_INPUT_DIR)
+    predicate_nodes = dict(predicate_offsets or {})
+    type_nodes = dict(type_offsets or {})
+    predicate_ids = dict()
+    intermediate_nodes = StatementIndexWriter(
+        intermediate_nodes_path, NODE_KEY_SIZE, UNIQUE_PREDICATE.size, memory_budget
+    )
+    metrics = get_metrics("resolve_qualifiers")
+    with open_triple_writer(unique_predicates_path) as writer:
+        for triples in iter_files_triple_batches(input_paths):
+            rows = []
+            for s, p, o in triples:
+                p, o = make_unique(p, o, predicate_nodes, type_nodes)
                 # check for statements
-                if "-" in o:
-                    if o.startswith(s) or o.startswith("q" + s[1:]):
-                        # store in dict dummy node and unique predicate, remove this line from dump
-                        intermediate_nodes[o] = p
+                if b"-" in o:
+                    if o.startswith(s) or o.startswith(b"q" + s[1:]):
+                        # store in index dummy node and unique predicate, remove this line from dump
+                        intermediate_nodes.add(hash_term(o, NODE_KEY_SIZE), encode_unique_predicate(p, predicate_ids))
                         continue
-                    if o.startswith("p" + s[1:]):
+                    if o.startswith(b"p" + s[1:]):
                         continue
 
-                count += 1
-                rows += str(s) + "," + str(p) + "," + str(o) + "\n"
-                if count == 1000:
-                    count = 0
-                    fp_out.write(rows)
-                    rows = ""
+                rows.append((s, p, o))
+            writer.write(rows)
+            if metrics:
+                dict_sizes = {
+                    "predicate_counters": len(predicate_nodes),
+                    "type_counters": len(type_nodes),
+                    "intermediate_nodes": len(intermediate_nodes.entries),
+                }
+                update_pass_metrics(metrics, "unique_predicates", triples, dict_sizes)
 
-            fp_out.write(rows)
-            with open("tmp_dumps/qualifier_intermediate_nodes.json", "w") as json_file:
-                json.dump(intermediate_nodes, json_file)
+    predicates = sorted(predicate_ids, key=predicate_ids.get)
+    intermediate_nodes.close({"predicates": [predicate.decode("utf-8") for predicate in predicates]})
+    if metrics:
+        metrics.report(force=True)
     return
 
 
-def resolve_qualifiers():
-    triples = dict()
-    with open("tmp_dumps/qualifier_intermediate_nodes.json", "r") as json_file:
-        intermediate_nodes = json.load(json_file)
-    with open(PATH_TO_UNIQUE_PREDICATES_DUMP, "r") as fp_in:
-        with open(PATH_TO_QUALIFIER_DUMP, "w") as fp_out:
-            line = fp_in.readline()
-            rows = ""
-            count = -1
-            while line:
-                currentLine = line
-                line = fp_in.readline()
-                s, p, o = currentLine.split(",", 2)
-                o = o.strip()
+def resolve_qualifiers(
+    unique_predicates_path=PATH_TO_UNIQUE_PREDICATES_DUMP,
+    intermediate_nodes_path=PATH_TO_INTERMEDIATE_NODES,
+    qualifier_dump_path=PATH_TO_QUALIFIER_DUMP,
+    qualifier_triples_path=PATH_TO_QUALIFIER_TRIPLES,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    intermediate_nodes = StatementIndex(intermediate_nodes_path)
+    predicates = [predicate.encode("utf-8") for predicate in intermediate_nodes.metadata["predicates"]]
+    qualifier_triples = StatementIndexWriter(
+        qualifier_triples_path, SUBJECT_KEY_SIZE + TERM_KEY_SIZE, QUALIFIER_TRIPLE_VALUE_SIZE, memory_budget
+    )
+    metrics = get_metrics("resolve_qualifiers")
+    with open_triple_writer(qualifier_dump_path) as writer:
+        for unique_triples in iter_intermediate_batches(unique_predicates_path):
+            rows = []
+            triples = dict()
+            for s, p, o in unique_triples:
                 # check for statement
-                if "-" in s:
-                    # look up corresponding predicate in dictionary, if not contained in dict: 00 will be returned
-                    p_val = intermediate_nodes.get(s, "00")
+                if b"-" in s:
+                    # look up corresponding predicate in index
+                    value = intermediate_nodes.get(hash_term(s, NODE_KEY_SIZE))
                     # actually a lot of dummy nodes as subject are apparently not as objects in dump due to earlier pruning (see csv.log for a list of them)
-                    if p_val == "00":
+                    if value is None:
                         continue
-                    # if qualifier predicate and predicate from dict are the same: create the corresponding triple from this
-                    if p.split("-")[0] == p_val.split("-")[0]:
-                        s = s.split("-")[0]
-                        if s.startswith("q"):
-                            s = "Q" + s[1:]
-                        p = p_val
-                        # store in new dictionary subject, object, predicate (later used to prune direct triples)
-                        if not s in triples.keys():
-                            triples[s] = dict()
-                        triples[s][o] = p_val
-                    # if not: add predicate as subject of this triple
-                    else:
-                        s = p_val
-
-                count += 1
-                rows += str(s) + "," + str(p) + "," + str(o) + "\n"
-                if count == 1000:
-                    count = 0
-                    fp_out.write(rows)
-                    rows = ""
-
-            fp_out.write(rows)
-            with open("tmp_dumps/qualifier_triples.json", "w") as json_file:
-                json.dump(triples, json_file)
+                    p_val = decode_unique_predicate(value, predicates)
+                    s, p = resolve_statement(s, p, o, p_val, triples)
+
+                rows.append((s, p, o))
+            writer.write(rows)
+            # store in index subject, object, predicate (later used to prune direct triples)
+            for s, subject_triples in triples.items():
+                for o, p_val in subject_triples.items():
+                    qualifier_triples.add(*encode_qualifier_triple(s, o, p_val))
+            if metrics:
+                dict_sizes = {"statement_triples": len(triples), "qualifier_triples": len(qualifier_triples.entries)}
+                update_pass_metrics(metrics, "qualifiers", unique_triples, dict_sizes)
+
+    intermediate_nodes.close()
+    qualifier_triples.close()
+    if metrics:
+        metrics.report(force=True)
+    return
+
+
+def prune_duplicate_lines(
+    qualifier_dump_path=PATH_TO_QUALIFIER_DUMP,
+    qualifier_triples_path=PATH_TO_QUALIFIER_TRIPLES,
+    output_path=PATH_TO_OUTPUT_FILE,
+):
+    qualifier_triples = StatementIndex(qualifier_triples_path)
+    predicate_hashes = dict()
+    subject_indexes = dict()
+    metrics = get_metrics("resolve_qualifiers")
+    with open_triple_writer(output_path) as writer:
+        for resolved_triples in iter_intermediate_batches(qualifier_dump_path):
+            rows = []
+            for s, p, o in resolved_triples:
+                # the triples of a subject are close to each other, interleaved with its qualifier triples
+                subject_index = subject_indexes.get(s)
+                if subject_index is None:
+                    subject_index = load_subject_index(qualifier_triples, s)
+                    # only subjects with qualifier triples are cached
+                    if subject_index:
+                        if len(subject_indexes) >= SUBJECT_CACHE_SIZE:
+                            subject_indexes.clear()
+                        subject_indexes[s] = subject_index
+                if subject_index and is_indexed_duplicate(p, o, subject_index, predicate_hashes):
+                    continue
+                rows.append((s, p, o))
+            writer.write(rows)
+            if metrics:
+                update_pass_metrics(metrics, "pruning", resolved_triples, {"subject_cache": len(subject_indexes)})
+    qualifier_triples.close()
+    if metrics:
+        metrics.report(force=True)
     return
 
 
-def prune_duplicate_lines():
-    continue_flag = False
-    with open("tmp_dumps/qualifier_triples.json", "r") as json_file:
-        triples = json.load(json_file)
-    with open(PATH_TO_QUALIFIER_DUMP, "r") as fp_in:
-        with open(PATH_TO_OUTPUT_FILE, "w") as fp_out:
-            line = fp_in.readline()
-            rows = ""
-            count = -1
-            while line:
-                currentLine = line
-                line = fp_in.readline()
-                s, p, o = currentLine.split(",", 2)
-                o = o.strip()
-                if s in triples.keys():
-                    for o_s in triples[s].keys():
-                        if o == o_s:
-                            # get stored predicate
-                            p_s = triples[s][o_s]
-                            # check if direct predicate which can be pruned
-                            if not p == p_s and p.split("-")[0] == p_s.split("-")[0]:
-                                continue_flag = True
-                        elif p.split("-")[0] == "P31":
-                            if o_s.split("-")[0] == o.split("-")[0]:
-                                p_s = triples[s][o_s]
-                                if not p_s == p:
-                                    if p.split("-")[0] == p_s.split("-")[0]:
-                                        continue_flag = True
-                    if continue_flag:
-                        continue_flag = False
+def get_subject_entity(s):
+    """
+    Get the entity of the (normalized) subject: statement nodes (e.g. 'q42-...') belong to their entity ('Q42').
+    Return: bytes
+    """
+    entity = s.split(b"-", 1)[0]
+    if entity.startswith(b"q"):
+        entity = b"Q" + entity[1:]
+    return entity
+
+
+#####################################################
+# STREAMING MODE                                    #
+#####################################################
+def resolve_qualifiers_streaming(
+    input_paths=None,
+    output_path=PATH_TO_OUTPUT_FILE,
+    predicate_offsets=None,
+    type_offsets=None,
+    spill_path=PATH_TO_SPILL_FILE,
+):
+    """
+    Run all passes (unique predicates, qualifier resolution, duplicate pruning) in a single pass.
+    The dump groups the triples of each entity and its statement nodes together, so the triples
+    are buffered per entity, and each buffer is resolved on its own (see 'resolve_entity').
+    Memory depends on the largest entity instead of the whole graph. Statement triples whose
+    statement node is not in the buffer of their entity go to a spill file, reconciled at the end
+    (see 'reconcile_spill'). The output is identical to the three passes, except for the order
+    of reconciled triples.
+    Return: None
+    """
+    if input_paths is None:
+        input_paths = get_shard_paths(PATH_TO_INPUT_DIR)
+    predicate_nodes = dict(predicate_offsets or {})
+    type_nodes = dict(type_offsets or {})
+    seen_entities = EntitySet()
+    reopened = False
+    current_entity = None
+    statement_prefixes = tuple()
+    entity_triples = list()
+    intermediate_nodes = dict()
+    metrics = get_metrics("resolve_qualifiers")
+    with WriteBehind(open(output_path, "wb")) as fp_out, open(spill_path + ".rows", "wb") as fp_spill_rows, open(
+        spill_path + ".nodes", "wb"
+    ) as fp_spill_nodes:
+        spill = (fp_spill_rows, fp_spill_nodes)
+        for triples in iter_files_triple_batches(input_paths):
+            rows = []
+            for s, p, o in triples:
+                # fast path: subject is the current entity or one of its statement nodes
+                if s != current_entity and not s.startswith(statement_prefixes):
+                    entity = get_subject_entity(s)
+                    if entity != current_entity:
+                        resolve_entity(entity_triples, intermediate_nodes, rows, spill)
+                        current_entity = entity
+                        statement_prefixes = (entity + b"-", b"q" + entity[1:] + b"-")
+                        entity_triples = list()
+                        intermediate_nodes = dict()
+                        # the triples of the entity are not contiguous in the dump
+                        if not seen_entities.add(entity):
+                            reopened = True
+                p, o = make_unique(p, o, predicate_nodes, type_nodes)
+                # check for statements
+                if b"-" in o:
+                    if o.startswith(s) or o.startswith(b"q" + s[1:]):
+                        # store in dict dummy node and unique predicate, remove this line from dump
+                        intermediate_nodes[o] = p
+                        continue
+                    if o.startswith(b"p" + s[1:]):
                         continue
-                count += 1
-                rows += str(s) + "," + str(p) + "," + str(o) + "\n"
-                if count == 1000:
-                    count = 0
-                    fp_out.write(rows)
-                    rows = ""
-            fp_out.write(rows)
+                entity_triples.append((s, p, o))
+            write_rows(fp_out, rows)
+            if metrics:
+                dict_sizes = {
+                    "predicate_counters": len(predicate_nodes),
+                    "type_counters": len(type_nodes),
+                    "entity_triples": len(entity_triples),
+                }
+                update_pass_metrics(metrics, "streaming", triples, dict_sizes)
+        rows = []
+        resolve_entity(entity_triples, intermediate_nodes, rows, spill)
+        write_rows(fp_out, rows)
+    reconcile_spill(spill_path, output_path, reopened, input_paths, predicate_offsets, type_offsets)
+    if metrics:
+        metrics.report(force=True)
     return
 
 
-create_unique_predicates()
-resolve_qualifiers()
-prune_duplicate_lines()
-print("done")
+def resolve_entity(entity_triples, intermediate_nodes, rows, spill):
+    """
+    Resolve the statement nodes within the triples of a single entity, and prune direct duplicates.
+    Statement triples with statement nodes unknown within the entity, and statement nodes
+    not used by any triple of the entity, are written to the spill files.
+    Return: None
+    """
+    fp_spill_rows, fp_spill_nodes = spill
+    triples = dict()
+    resolved_triples = list()
+    used_nodes = set()
+    spilled_rows = list()
+    for s, p, o in entity_triples:
+        # check for statement
+        if b"-" in s:
+            p_val = intermediate_nodes.get(s)
+            if p_val is None:
+                spilled_rows.append(s + b"," + p + b"," + o)
+                continue
+            used_nodes.add(s)
+            s, p = resolve_statement(s, p, o, p_val, triples)
+        resolved_triples.append((s, p, o))
+    qualifier_index = index_qualifier_triples(triples)
+    for s, p, o in resolved_triples:
+        subject_index = qualifier_index.get(s)
+        if subject_index and is_duplicate(p, o, subject_index):
+            continue
+        rows.append(s + b"," + p + b"," + o)
+    write_rows(fp_spill_rows, spilled_rows)
+    if len(used_nodes) < len(intermediate_nodes):
+        spilled_nodes = [node + b"," + p for node, p in intermediate_nodes.items() if not node in used_nodes]
+        write_rows(fp_spill_nodes, spilled_nodes)
+
+
+def reconcile_spill(spill_path, output_path, reopened, input_paths, predicate_offsets, type_offsets):
+    """
+    Resolve the spilled statement triples with the spilled statement nodes, and append them to the output.
+    Spilled triples without statement node are dropped (as in the three passes), unless the triples
+    of some entity were not contiguous in the dump: then, the statement node might have been used by
+    another buffer of the entity, and its unique predicate is recovered by replaying the counters.
+    If this creates new facts, their direct duplicates are pruned from the output.
+    Return: None
+    """
+    spilled_triples = [line.split(b",", 2) for lines in iter_line_batches(spill_path + ".rows") for line in lines]
+    if spilled_triples:
+        needed_nodes = {s for s, _, _ in spilled_triples}
+        intermediate_nodes = dict()
+        for lines in iter_line_batches(spill_path + ".nodes"):
+            for line in lines:
+                node, p = line.split(b",", 1)
+                if node in needed_nodes:
+                    intermediate_nodes[node] = p
+        missing_nodes = needed_nodes - intermediate_nodes.keys()
+        if reopened and missing_nodes:
+            intermediate_nodes.update(
+                replay_intermediate_nodes(missing_nodes, input_paths, predicate_offsets, type_offsets)
+            )
+        triples = dict()
+        rows = list()
+        for s, p, o in spilled_triples:
+            p_val = intermediate_nodes.get(s)
+            # as in the three passes, triples of statement nodes that are not in the dump are dropped
+            if p_val is None:
+                continue
+            s, p = resolve_statement(s, p, o, p_val, triples)
+            rows.append(s + b"," + p + b"," + o)
+        with WriteBehind(open(output_path, "ab")) as fp_out:
+            write_rows(fp_out, rows)
+        if triples:
+            prune_output(output_path, triples)
+    os.remove(spill_path + ".rows")
+    os.remove(spill_path + ".nodes")
+
+
+def replay_intermediate_nodes(nodes, input_paths, predicate_offsets, type_offsets):
+    """
+    Recover the unique predicates of the given statement nodes, by replaying the counters over the input.
+    Return: dict
+    """
+    intermediate_nodes = dict()
+    predicate_nodes = dict(predicate_offsets or {})
+    type_nodes = dict(type_offsets or {})
+    for triples in iter_files_triple_batches(input_paths):
+        for s, p, o in triples:
+            p, o = make_unique(p, o, predicate_nodes, type_nodes)
+            if o in nodes and (o.startswith(s) or o.startswith(b"q" + s[1:])):
+                intermediate_nodes[o] = p
+    return intermediate_nodes
+
+
+class EntitySet:
+    """
+    Compact set of entity ids: ids of the form 'Q<number>' are stored in a bitmap.
+    """
+
+    def __init__(self):
+        self.bitmap = bytearray()
+        self.others = set()
+
+    def add(self, entity):
+        """
+        Add the entity to the set.
+        Return: False if the entity was already contained, True otherwise
+        """
+        if entity.startswith(b"Q") and entity[1:].isdigit():
+            number = int(entity[1:])
+            index, bit = number >> 3, 1 << (number & 7)
+            if index >= len(self.bitmap):
+                self.bitmap.extend(bytes(max(index + 1 - len(self.bitmap), len(self.bitmap))))
+            if self.bitmap[index] & bit:
+                return False
+            self.bitmap[index] |= bit
+            return True
+        if entity in self.others:
+            return False
+        self.others.add(entity)
+        return True
+
+    def __contains__(self, entity):
+        if entity.startswith(b"Q") and entity[1:].isdigit():
+            number = int(entity[1:])
+            index = number >> 3
+            return index < len(self.bitmap) and bool(self.bitmap[index] & (1 << (number & 7)))
+        return entity in self.others
+
+
+def prune_output(output_path, triples):
+    """
+    Prune direct duplicates of the given qualifier triples from the output.
+    Return: None
+    """
+    qualifier_index = index_qualifier_triples(triples)
+    with WriteBehind(open(output_path + ".tmp", "wb")) as fp_out:
+        for lines in iter_line_batches(output_path):
+            rows = []
+            for currentLine in lines:
+                s, p, o = currentLine.split(b",", 2)
+                subject_index = qualifier_index.get(s)
+                if subject_index and is_duplicate(p, o, subject_index):
+                    continue
+                rows.append(currentLine)
+            write_rows(fp_out, rows)
+    os.replace(output_path + ".tmp", output_path)
+
+
+#####################################################
+# PARALLEL MODE                                     #
+#####################################################
+def get_partition(s, partitions):
+    """
+    Get the partition of the (normalized) subject.
+    Statement nodes are assigned to the partition of their entity (see 'get_subject_entity'),
+    such that all triples of an entity and its statements end up in the same partition.
+    Return: int
+    """
+    return zlib.crc32(get_subject_entity(s)) % partitions
+
+
+def get_partition_path(partition, name):
+    return os.path.join(PATH_TO_PARTITIONS_DIR, "partition_" + str(partition).zfill(5) + "_" + name)
+
+
+def partition_shard(shard_index, shard_path, partitions):
+    """
+    Distribute the triples of the shard over the partitions (hash of the subject entity),
+    and count the appearances of each predicate (type) per partition.
+    The partitions are stored as binary triples, such that the triples are parsed only once.
+    Return: list of (predicate counts, type counts) per partition
+    """
+    counts = [(dict(), dict()) for _ in range(partitions)]
+    outputs = [TripleWriter(get_partition_path(k, get_shard_name(shard_index, EXTENSION))) for k in range(partitions)]
+    metrics = get_metrics("resolve_qualifiers")
+    for triples in iter_files_triple_batches([shard_path]):
+        rows = [[] for _ in range(partitions)]
+        for s, p, o in triples:
+            partition = get_partition(s, partitions)
+            rows[partition].append((s, p, o))
+            predicate_counts, type_counts = counts[partition]
+            predicate_counts[p] = predicate_counts.get(p, 0) + 1
+            if p == b"P31":
+                type_counts[o] = type_counts.get(o, 0) + 1
+        for partition in range(partitions):
+            outputs[partition].write(rows[partition])
+        if metrics:
+            update_pass_metrics(metrics, "partition", triples, {})
+    for output in outputs:
+        output.close()
+    if metrics:
+        metrics.report(force=True)
+    return counts
+
+
+def compute_offsets(partition_counts):
+    """
+    Compute the counter offsets of each partition: the counter of a predicate (type) in partition k
+    starts after all appearances of the predicate (type) in partitions 0, ..., k-1.
+    Return: list of (predicate offsets, type offsets) per partition
+    """
+    offsets = list()
+    predicate_totals = dict()
+    type_totals = dict()
+    for predicate_counts, type_counts in partition_counts:
+        offsets.append((dict(predicate_totals), dict(type_totals)))
+        for p, count in predicate_counts.items():
+            predicate_totals[p] = predicate_totals.get(p, 0) + count
+        for o, count in type_counts.items():
+            type_totals[o] = type_totals.get(o, 0) + count
+    return offsets
+
+
+def get_counts_path(shard_index):
+    return os.path.join(PATH_TO_PARTITIONS_DIR, get_shard_name(shard_index, "_counts.json"))
+
+
+def write_counts(path, counts):
+    """
+    Store the counts of a shard per partition (see 'partition_shard') as JSON.
+    Return: None
+    """
+    counts = [
+        [{key.decode("utf-8", "surrogateescape"): n for key, n in term_counts.items()} for term_counts in pair]
+        for pair in counts
+    ]
+    with open(path + ".tmp", "w") as fp:
+        json.dump(counts, fp)
+    os.replace(path + ".tmp", path)
+
+
+def read_counts(path):
+    """
+    Load the counts of a shard per partition (see 'write_counts').
+    Return: list of (predicate counts, type counts) per partition
+    """
+    with open(path, "r") as fp:
+        counts = json.load(fp)
+    return [
+        tuple({key.encode("utf-8", "surrogateescape"): n for key, n in term_counts.items()} for term_counts in pair)
+        for pair in counts
+    ]
+
+
+def resolve_partition(partition, shard_ids, predicate_offsets, type_offsets, streaming, memory_budget):
+    """
+    Run all passes (unique predicates, qualifier resolution, duplicate pruning) on the partition,
+    with the given memory budget for the statement indexes.
+    The shard IDs give the triples of the partition (see 'partition_shard'), in the order of the dump.
+    Return: None
+    """
+    if streaming:
+        resolve_qualifiers_streaming(
+            [get_partition_path(partition, get_shard_name(i, EXTENSION)) for i in shard_ids],
+            get_partition_path(partition, "output.csv"),
+            predicate_offsets,
+            type_offsets,
+            get_partition_path(partition, "spill"),
+        )
+        return
+    create_partition_unique_predicates(partition, shard_ids, predicate_offsets, type_offsets, memory_budget)
+    resolve_partition_qualifiers(partition, memory_budget)
+    prune_partition_duplicates(partition)
+    return
+
+
+def create_partition_unique_predicates(partition, shard_ids, predicate_offsets, type_offsets, memory_budget):
+    create_unique_predicates(
+        [get_partition_path(partition, get_shard_name(i, EXTENSION)) for i in shard_ids],
+        get_partition_path(partition, "unique_predicates" + EXTENSION),
+        get_partition_path(partition, "intermediate_nodes.idx"),
+        predicate_offsets,
+        type_offsets,
+        memory_budget,
+    )
+
+
+def resolve_partition_qualifiers(partition, memory_budget):
+    resolve_qualifiers(
+        get_partition_path(partition, "unique_predicates" + EXTENSION),
+        get_partition_path(partition, "intermediate_nodes.idx"),
+        get_partition_path(partition, "qualifiers_resolved" + EXTENSION),
+        get_partition_path(partition, "qualifier_triples.idx"),
+        memory_budget,
+    )
+
+
+def prune_partition_duplicates(partition):
+    prune_duplicate_lines(
+        get_partition_path(partition, "qualifiers_resolved" + EXTENSION),
+        get_partition_path(partition, "qualifier_triples.idx"),
+        get_partition_path(partition, "output.csv"),
+    )
+
+
+def remove_partition_inputs(partition, shard_ids):
+    for i in shard_ids:
+        path = get_partition_path(partition, get_shard_name(i, EXTENSION))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def sum_partition_counts(shard_counts, partitions):
+    """
+    Sum up the counts of the shards (see 'partition_shard') per partition.
+    Return: list of (predicate counts, type counts) per partition
+    """
+    partition_counts = [(dict(), dict()) for _ in range(partitions)]
+    for counts in shard_counts:
+        for (predicate_totals, type_totals), (predicate_counts, type_counts) in zip(partition_counts, counts):
+            for p, count in predicate_counts.items():
+                predicate_totals[p] = predicate_totals.get(p, 0) + count
+            for o, count in type_counts.items():
+                type_totals[o] = type_totals.get(o, 0) + count
+    return partition_counts
+
+
+def concatenate_partitions(partitions, output_path=PATH_TO_OUTPUT_FILE):
+    """
+    Concatenate the outputs of the partitions into the output file.
+    Return: None
+    """
+    partition_outputs = [os.path.basename(get_partition_path(k, "output.csv")) for k in range(partitions)]
+    write_manifest(PATH_TO_PARTITIONS_DIR, [{"name": name} for name in partition_outputs])
+    concatenate_shards(PATH_TO_PARTITIONS_DIR, output_path)
+
+
+def resolve_qualifiers_parallel(workers, streaming=False, memory_budget=DEFAULT_MEMORY_BUDGET, checkpoint=None):
+    """
+    Resolve qualifiers with the given number of workers, which share the memory budget.
+    The triples are hash-partitioned by subject entity (see 'get_partition'), and each
+    partition gets deterministic counter ranges for the unique predicates (see 'compute_offsets'),
+    so that the output is unique and reproducible for the given number of workers.
+    The partition outputs are concatenated into the output file.
+    With a checkpoint, each partitioned shard (with its counts, from which the counter ranges are derived)
+    and each resolved partition is committed, and committed steps are skipped when resuming.
+    Return: None
+    """
+    os.makedirs(PATH_TO_PARTITIONS_DIR, exist_ok=True)
+    shard_paths = get_shard_paths(PATH_TO_INPUT_DIR)
+    shard_ids = range(len(shard_paths))
+    is_done = checkpoint.is_done if checkpoint else lambda step: False
+    with Pool(workers) as pool:
+        pending = [
+            (i, pool.apply_async(partition_shard, (i, path, workers)))
+            for i, path in enumerate(shard_paths)
+            if not is_done("partition_" + str(i).zfill(5))
+        ]
+        for i, result in pending:
+            write_counts(get_counts_path(i), result.get())
+            if checkpoint:
+                checkpoint.commit("partition_" + str(i).zfill(5))
+        shard_counts = [read_counts(get_counts_path(i)) for i in shard_ids]
+        partition_counts = sum_partition_counts(shard_counts, workers)
+        offsets = compute_offsets(partition_counts)
+        pending = [
+            (k, pool.apply_async(resolve_partition, (k, shard_ids, *offsets[k], streaming, memory_budget // workers)))
+            for k in range(workers)
+            if not is_done("resolve_" + str(k).zfill(5))
+        ]
+        for k, result in pending:
+            result.get()
+            if checkpoint:
+                checkpoint.commit("resolve_" + str(k).zfill(5))
+            remove_partition_inputs(k, shard_ids)
+    # inputs of partitions committed right before an interruption
+    for k in range(workers):
+        remove_partition_inputs(k, shard_ids)
+    concatenate_partitions(workers)
+    return
+
+
+#####################################################
+# MAIN                                              #
+#####################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of workers; with more than one worker, the dump is partitioned by subject entity",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="resolve qualifiers in a single pass, buffering the triples of one entity at a time",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET >> 20,
+        help="memory (in MB) for the statement indexes; larger indexes are spilled to disk",
+    )
+    parser.add_argument(
+        "--export",
+        choices=["csv", "columnar"],
+        default="csv",
+        help="format of the output: comma-separated rows (" + PATH_TO_OUTPUT_FILE + "), "
+        "or columnar row groups (" + PATH_TO_COLUMNAR_OUTPUT_FILE + ", see columnar.py)",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="compress the comma-separated output (e.g. into " + PATH_TO_OUTPUT_FILE + ".gz), "
+        "zstd requires the zstandard package",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the checkpoint of a previous run, and resolve the qualifiers of the whole dump again",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="write metrics of the passes (e.g. triples per second, dict sizes) periodically to DIR (see metrics.py)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="with --metrics, sample the stacks of the processes every SECONDS (CPU time) into DIR",
+    )
+    add_io_arguments(parser)
+    args = parser.parse_args()
+    if args.compress and args.export == "columnar":
+        parser.error("--compress requires the csv export (the columnar export is compressed already)")
+    if args.profile and not args.metrics:
+        parser.error("--profile requires --metrics")
+    if args.metrics:
+        configure(args.metrics, args.profile)
+    configure_io_from_args(args)
+    memory_budget = args.memory_budget << 20
+    columnar = args.export == "columnar"
+    if columnar:
+        output_path = PATH_TO_COLUMNAR_OUTPUT_FILE
+    else:
+        output_path = PATH_TO_OUTPUT_FILE + COMPRESSION_EXTENSIONS.get(args.compress, "")
+    # the counters depend on the number of workers (see 'resolve_qualifiers_parallel')
+    stage_key = get_stage_key(
+        [os.path.join(PATH_TO_INPUT_DIR, MANIFEST_NAME)],
+        {"workers": args.workers, "streaming": args.streaming, "export": args.export, "compress": args.compress},
+    )
+    checkpoint = Checkpoint("resolve_qualifiers", stage_key, restart=args.restart)
+    if checkpoint.is_finished([output_path]):
+        print("Qualifiers were resolved already with the same inputs, skipping resolve_qualifiers.py (see --restart)")
+        sys.exit()
+    start_time = time.time()
+    if args.workers > 1:
+        resolve_qualifiers_parallel(args.workers, args.streaming, memory_budget, checkpoint)
+        if columnar:
+            export_columnar()
+    elif args.streaming:
+        resolve_qualifiers_streaming()
+        if columnar:
+            export_columnar()
+    else:
+        # the intermediate dumps are binary triples, if the filtered dump is
+        binary = any(is_binary_path(path) for path in get_shard_paths(PATH_TO_INPUT_DIR))
+        unique_predicates_path = get_intermediate_path(PATH_TO_UNIQUE_PREDICATES_DUMP, binary)
+        qualifier_dump_path = get_intermediate_path(PATH_TO_QUALIFIER_DUMP, binary)
+        # each pass only reads the outputs of the previous pass, so committed passes are skipped when resuming
+        if not checkpoint.is_done("unique_predicates"):
+            create_unique_predicates(unique_predicates_path=unique_predicates_path, memory_budget=memory_budget)
+            checkpoint.commit("unique_predicates")
+        if not checkpoint.is_done("qualifiers"):
+            resolve_qualifiers(
+                unique_predicates_path, qualifier_dump_path=qualifier_dump_path, memory_budget=memory_budget
+            )
+            checkpoint.commit("qualifiers")
+        prune_duplicate_lines(qualifier_dump_path, output_path=output_path if columnar else PATH_TO_OUTPUT_FILE)
+    if args.compress:
+        compress_file(PATH_TO_OUTPUT_FILE, args.compress)
+    checkpoint.finish([output_path])
+    print("Time(resolve_qualifiers): " + str(time.time() - start_time))
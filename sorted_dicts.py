@@ -0,0 +1,231 @@
+"""
+Sorted dicts on disk.
+Workers store their dicts (labels, aliases, descriptions, wikipedia mappings) as sorted,
+deduplicated runs, which are merged with a streaming k-way merge in bounded memory.
+Runs and merged dicts share the same format: one entry per line, "<key>\t<json value>\n",
+sorted by key (in UTF-8 byte order). This allows lookups by binary search without loading the dict.
+Sets of keys (e.g. the terms of the graph store) are stored as runs of keys without values (one per line, as bytes).
+"""
+
+import heapq
+import json
+import mmap
+import os
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+WRITE_BUFFER_SIZE = 1 << 20
+# maximum number of runs merged at once (bounds the number of open files)
+MAX_MERGE_RUNS = 256
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def write_run(path, dictionary):
+    """
+    Store the dict as a sorted run on the given path.
+    Set values (labels, aliases) are stored as sorted lists.
+    Return: None
+    """
+    with open(path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as fp:
+        for key in sorted(dictionary):
+            value = dictionary[key]
+            if isinstance(value, set):
+                value = sorted(value)
+            fp.write(key + "\t" + json.dumps(value, ensure_ascii=False) + "\n")
+
+
+def iter_entries(path, run_index):
+    with open(path, "r", encoding="utf-8") as fp:
+        for line in fp:
+            key, value = line.rstrip("\n").split("\t", 1)
+            yield key.encode("utf-8"), run_index, value
+
+
+def iter_merged_entries(run_paths, union):
+    """
+    Merge the sorted runs with a streaming k-way merge.
+    With union, the values (lists) of a key are united (and deduplicated).
+    Otherwise, the value of a key is taken from the last run containing the key.
+    Return: generator of (key, value) pairs, sorted by key
+    """
+    entries = heapq.merge(*[iter_entries(path, run_index) for run_index, path in enumerate(run_paths)])
+    current_key = None
+    current_values = list()
+    for key, _, value in entries:
+        if key != current_key and current_values:
+            yield current_key.decode("utf-8"), merge_values(current_values, union)
+            current_values = list()
+        current_key = key
+        current_values.append(value)
+    if current_values:
+        yield current_key.decode("utf-8"), merge_values(current_values, union)
+
+
+def merge_values(values, union):
+    if not union:
+        return json.loads(values[-1])
+    merged = set()
+    for value in values:
+        merged.update(json.loads(value))
+    return sorted(merged)
+
+
+def merge_runs(run_paths, output_path, union, json_path=None, remove_runs=True, keep=None):
+    """
+    Merge the sorted runs into a single sorted dict on the output path.
+    Optionally, the merged dict is additionally stored as a (single-line) JSON object,
+    which is written entry by entry as well.
+    With keep (a function of key and merged value), only the entries for which it returns true are stored.
+    More than MAX_MERGE_RUNS runs are merged in several levels: consecutive runs are merged
+    into intermediate runs first, such that the order of the runs is kept.
+    Return: number of entries
+    """
+    level = 0
+    while len(run_paths) > MAX_MERGE_RUNS:
+        merged_paths = list()
+        for i in range(0, len(run_paths), MAX_MERGE_RUNS):
+            merged_path = output_path + ".merge_" + str(level) + "_" + str(len(merged_paths))
+            merge_runs(run_paths[i : i + MAX_MERGE_RUNS], merged_path, union, remove_runs=remove_runs or level > 0)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+        level += 1
+    remove_runs = remove_runs or level > 0
+    entries = 0
+    json_fp = open(json_path, "w", buffering=WRITE_BUFFER_SIZE) if json_path else None
+    with open(output_path + ".tmp", "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as fp:
+        if json_fp:
+            json_fp.write("{")
+        for key, value in iter_merged_entries(run_paths, union):
+            if keep and not keep(key, value):
+                continue
+            fp.write(key + "\t" + json.dumps(value, ensure_ascii=False) + "\n")
+            if json_fp:
+                if entries:
+                    json_fp.write(",")
+                json_fp.write(json.dumps(key) + ":" + json.dumps(value, separators=(",", ":")))
+            entries += 1
+        if json_fp:
+            json_fp.write("}")
+            json_fp.close()
+    os.replace(output_path + ".tmp", output_path)
+    if remove_runs:
+        for path in run_paths:
+            os.remove(path)
+    return entries
+
+
+def write_key_run(path, keys):
+    """
+    Store the keys (bytes without newlines) as a sorted run without values, one key per line.
+    Return: None
+    """
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+        for key in sorted(keys):
+            fp.write(key + b"\n")
+
+
+def iter_keys(path):
+    with open(path, "rb", buffering=WRITE_BUFFER_SIZE) as fp:
+        for line in fp:
+            yield line[:-1]
+
+
+def merge_keys(run_paths):
+    previous = None
+    for key in heapq.merge(*[iter_keys(path) for path in run_paths]):
+        if key != previous:
+            yield key
+            previous = key
+
+
+def iter_merged_keys(run_paths, remove_runs=True):
+    """
+    Merge the sorted runs of keys (see 'write_key_run') with a streaming k-way merge, without duplicates.
+    More than MAX_MERGE_RUNS runs are merged in several levels (as in 'merge_runs').
+    Return: generator of keys (bytes), sorted
+    """
+    level = 0
+    while len(run_paths) > MAX_MERGE_RUNS:
+        merged_paths = list()
+        for i in range(0, len(run_paths), MAX_MERGE_RUNS):
+            merged_path = run_paths[0] + ".merge_" + str(level) + "_" + str(len(merged_paths))
+            with open(merged_path, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+                for key in merge_keys(run_paths[i : i + MAX_MERGE_RUNS]):
+                    fp.write(key + b"\n")
+            merged_paths.append(merged_path)
+        if remove_runs or level > 0:
+            for path in run_paths:
+                os.remove(path)
+        run_paths = merged_paths
+        level += 1
+    yield from merge_keys(run_paths)
+    if remove_runs or level > 0:
+        for path in run_paths:
+            os.remove(path)
+
+
+def load_sorted_dict(path):
+    """
+    Load the sorted dict on the given path into memory.
+    Return: dict
+    """
+    dictionary = dict()
+    with open(path, "r", encoding="utf-8") as fp:
+        for line in fp:
+            key, value = line.rstrip("\n").split("\t", 1)
+            dictionary[key] = json.loads(value)
+    return dictionary
+
+
+class SortedDict:
+    """
+    Read-only access to a sorted dict on disk.
+    The file is memory-mapped, and keys are looked up by binary search.
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, "rb")
+        size = os.fstat(self.fp.fileno()).st_size
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def get(self, key, default=None):
+        """
+        Look up the value of the key.
+        Return: value (or default if the key is not in the dict)
+        """
+        data = self.data
+        key = key.encode("utf-8")
+        # invariant: the entry for key (if any) starts within [low, high)
+        low = 0
+        high = len(data)
+        while low < high:
+            middle = (low + high) // 2
+            # move to the start of the next entry
+            start = data.rfind(b"\n", 0, middle) + 1
+            separator = data.find(b"\t", start)
+            entry_key = data[start:separator]
+            end = data.find(b"\n", separator)
+            if entry_key == key:
+                return json.loads(data[separator + 1 : end])
+            if entry_key < key:
+                low = end + 1
+            else:
+                high = start
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, KeyError) is not KeyError
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.fp.close()
@@ -0,0 +1,244 @@
+"""
+Memory-bounded index on disk, mapping fixed-size binary keys to fixed-size binary values.
+Terms (e.g. statement nodes) are integer-encoded by hashing (see 'hash_term').
+Entries are collected in memory up to a configurable budget, and spilled as sorted runs
+otherwise; the runs are merged into a single sorted index with a streaming k-way merge.
+The index is memory-mapped, and keys are looked up by binary search within hash buckets.
+
+Layout: header | records (sorted by key) | bucket directory | metadata (JSON)
+"""
+
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+from array import array
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+MAGIC = b"WDSTIDX1"
+HEADER = struct.Struct("<8sIIIQQ")
+DEFAULT_MEMORY_BUDGET = 1 << 30
+# approximate memory of an entry of the in-memory buffer (dict of bytes)
+ENTRY_MEMORY = 200
+BUCKET_SIZE = 16
+MAX_BUCKET_BITS = 22
+RUN_BLOCK_RECORDS = 1 << 16
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def hash_term(term, size=16):
+    """
+    Encode the term as a fixed-size integer (big-endian), with uniformly distributed bits.
+    Return: bytes
+    """
+    return hashlib.blake2b(term, digest_size=size).digest()
+
+
+def get_bucket_bits(records):
+    """
+    Get the number of bits of the bucket directory for (at most) the given number of records.
+    Return: int
+    """
+    return min(MAX_BUCKET_BITS, (records // BUCKET_SIZE).bit_length())
+
+
+def write_run(path, entries):
+    with open(path, "wb") as fp:
+        keys = sorted(entries)
+        for i in range(0, len(keys), RUN_BLOCK_RECORDS):
+            fp.write(b"".join(key + entries[key] for key in keys[i : i + RUN_BLOCK_RECORDS]))
+
+
+def iter_run(path, run_index, key_size, value_size):
+    record_size = key_size + value_size
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(record_size * RUN_BLOCK_RECORDS)
+            if not block:
+                break
+            for offset in range(0, len(block), record_size):
+                yield block[offset : offset + key_size], run_index, block[offset + key_size : offset + record_size]
+
+
+def iter_merged_runs(run_paths, key_size, value_size):
+    """
+    Merge the sorted runs with a streaming k-way merge.
+    The value of a key is taken from the last run containing the key.
+    Return: generator of (key, value) pairs, sorted by key
+    """
+    runs = [iter_run(path, run_index, key_size, value_size) for run_index, path in enumerate(run_paths)]
+    current_key = None
+    current_value = None
+    for key, _, value in heapq.merge(*runs):
+        if key != current_key and current_value is not None:
+            yield current_key, current_value
+        current_key = key
+        current_value = value
+    if current_value is not None:
+        yield current_key, current_value
+
+
+def write_index(path, key_size, value_size, records, max_records, metadata=None):
+    """
+    Store the sorted (key, value) pairs as an index on the given path.
+    Return: number of records
+    """
+    bits = get_bucket_bits(max_records)
+    shift = 32 - bits
+    bucket_counts = array("Q", bytes(8 * ((1 << bits) + 1)))
+    count = 0
+    with open(path + ".tmp", "wb") as fp:
+        fp.write(bytes(HEADER.size))
+        block = list()
+        for key, value in records:
+            block.append(key)
+            block.append(value)
+            bucket_counts[(int.from_bytes(key[:4], "big") >> shift) + 1] += 1
+            count += 1
+            if len(block) >= 2 * RUN_BLOCK_RECORDS:
+                fp.write(b"".join(block))
+                block = list()
+        fp.write(b"".join(block))
+        # bucket directory: index of the first record per bucket
+        for bucket in range(1, len(bucket_counts)):
+            bucket_counts[bucket] += bucket_counts[bucket - 1]
+        fp.write(bucket_counts.tobytes())
+        metadata = json.dumps(metadata or {}).encode("utf-8")
+        fp.write(metadata)
+        fp.seek(0)
+        fp.write(HEADER.pack(MAGIC, key_size, value_size, bits, count, len(metadata)))
+    os.replace(path + ".tmp", path)
+    return count
+
+
+class StatementIndexWriter:
+    """
+    Build an index with the given key and value sizes on the given path,
+    using (approximately) at most the given number of bytes in memory.
+    As in a dict, the last value added for a key is kept.
+    """
+
+    def __init__(self, path, key_size, value_size, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.path = path
+        self.key_size = key_size
+        self.value_size = value_size
+        self.max_entries = max(1, memory_budget // ENTRY_MEMORY)
+        self.entries = dict()
+        self.run_paths = list()
+        self.spilled_entries = 0
+
+    def add(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) >= self.max_entries:
+            self.spill()
+
+    def spill(self):
+        """
+        Store the entries in memory as a sorted run.
+        Return: None
+        """
+        run_path = self.path + ".run_" + str(len(self.run_paths)).zfill(5)
+        write_run(run_path, self.entries)
+        self.run_paths.append(run_path)
+        self.spilled_entries += len(self.entries)
+        self.entries = dict()
+
+    def close(self, metadata=None):
+        """
+        Write the index, with the (JSON-serializable) metadata.
+        Return: number of records
+        """
+        if self.run_paths:
+            if self.entries:
+                self.spill()
+            records = iter_merged_runs(self.run_paths, self.key_size, self.value_size)
+            max_records = self.spilled_entries
+        else:
+            records = ((key, self.entries[key]) for key in sorted(self.entries))
+            max_records = len(self.entries)
+        count = write_index(self.path, self.key_size, self.value_size, records, max_records, metadata)
+        for path in self.run_paths:
+            os.remove(path)
+        self.entries = dict()
+        self.run_paths = list()
+        return count
+
+
+class StatementIndex:
+    """
+    Read-only access to an index on disk.
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, "rb")
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_size, self.value_size, bits, self.records, metadata_length = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("Not a statement index: " + path)
+        self.record_size = self.key_size + self.value_size
+        self.shift = 32 - bits
+        directory_offset = HEADER.size + self.records * self.record_size
+        metadata_offset = directory_offset + 8 * ((1 << bits) + 1)
+        self.directory = array("Q")
+        self.directory.frombytes(self.data[directory_offset:metadata_offset])
+        self.metadata = json.loads(self.data[metadata_offset : metadata_offset + metadata_length])
+
+    def find(self, prefix):
+        """
+        Find the first record with a key not smaller than the prefix (of at least 4 bytes),
+        within the bucket of the prefix.
+        Return: (record index, end of the bucket)
+        """
+        data = self.data
+        record_size = self.record_size
+        length = len(prefix)
+        bucket = int.from_bytes(prefix[:4], "big") >> self.shift
+        low = self.directory[bucket]
+        end = high = self.directory[bucket + 1]
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * record_size
+            if data[offset : offset + length] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low, end
+
+    def get(self, key, default=None):
+        """
+        Look up the value of the key.
+        Return: value (or default if the key is not in the index)
+        """
+        index, end = self.find(key)
+        if index < end:
+            offset = HEADER.size + index * self.record_size
+            if self.data[offset : offset + self.key_size] == key:
+                return self.data[offset + self.key_size : offset + self.record_size]
+        return default
+
+    def get_prefix(self, prefix):
+        """
+        Look up all records with a key starting with the prefix (of at least 4 bytes).
+        Return: list of (remainder of the key, value) pairs, sorted by key
+        """
+        data = self.data
+        length = len(prefix)
+        index, end = self.find(prefix)
+        records = list()
+        offset = HEADER.size + index * self.record_size
+        while index < end and data[offset : offset + length] == prefix:
+            value = data[offset + self.key_size : offset + self.record_size]
+            records.append((data[offset + length : offset + self.key_size], value))
+            index += 1
+            offset += self.record_size
+        return records
+
+    def close(self):
+        self.data.close()
+        self.fp.close()
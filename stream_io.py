@@ -0,0 +1,265 @@
+"""
+Streaming I/O shared by the stages: reads and writes run in background threads, overlapping with the
+parsing and filtering on the main thread (file I/O, decompression and compression release the GIL).
+A reader thread reads ahead: blocks of the input are read (aligned to the page size, with read-ahead hints
+to the OS) into a bounded ring of buffers, ahead of the consumer (see 'iter_file_blocks' and 'iter_ahead').
+A writer thread writes behind: output batches are queued, and drained to the file (see 'WriteBehind'),
+such that the main thread does not block on a write or flush.
+The block size and the number of buffers are configured by 'configure_io' (e.g. with --read-ahead in the stages),
+which stores the settings in the environment, such that all worker processes inherit them.
+With zero buffers, reads and writes happen on the main thread.
+"""
+
+import os
+import queue
+import threading
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+BLOCK_SIZE_VARIABLE = "WIKIDATA_IO_BLOCK_SIZE"
+READ_AHEAD_VARIABLE = "WIKIDATA_READ_AHEAD"
+WRITE_BEHIND_VARIABLE = "WIKIDATA_WRITE_BEHIND"
+# blocks read ahead of the consumer
+DEFAULT_READ_AHEAD = 2
+# batches queued for the writer
+DEFAULT_WRITE_BEHIND = 8
+ALIGNMENT = 1 << 12
+# interval (seconds) in which a blocked thread checks whether it was stopped
+POLL_INTERVAL = 0.1
+END = object()
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def configure_io(block_size=None, read_ahead=None, write_behind=None):
+    """
+    Set the size of the blocks read (bytes), the number of blocks read ahead and the number of batches
+    written behind, for this process and all processes started by it.
+    Return: None
+    """
+    for variable, value in [
+        (BLOCK_SIZE_VARIABLE, block_size),
+        (READ_AHEAD_VARIABLE, read_ahead),
+        (WRITE_BEHIND_VARIABLE, write_behind),
+    ]:
+        if value is not None:
+            os.environ[variable] = str(value)
+
+
+def add_io_arguments(parser):
+    """
+    Add the options of 'configure_io' to the argument parser of a stage.
+    Return: None
+    """
+    parser.add_argument(
+        "--io-block-size",
+        type=int,
+        metavar="KB",
+        help="size (in KB) of the blocks read from the input files",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        metavar="BLOCKS",
+        help="number of blocks read ahead by a background thread, default: " + str(DEFAULT_READ_AHEAD),
+    )
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        metavar="BATCHES",
+        help="number of output batches queued for a background writer, default: " + str(DEFAULT_WRITE_BEHIND),
+    )
+
+
+def configure_io_from_args(args):
+    block_size = args.io_block_size << 10 if args.io_block_size else None
+    configure_io(block_size, args.read_ahead, args.write_behind)
+
+
+def get_block_size(default):
+    """
+    Get the configured size of the blocks read (rounded up to the alignment), or the given default.
+    Return: int
+    """
+    block_size = int(os.environ.get(BLOCK_SIZE_VARIABLE) or default)
+    return max(ALIGNMENT, -(-block_size // ALIGNMENT) * ALIGNMENT)
+
+
+def get_read_ahead():
+    return int(os.environ.get(READ_AHEAD_VARIABLE) or DEFAULT_READ_AHEAD)
+
+
+def get_write_behind():
+    return int(os.environ.get(WRITE_BEHIND_VARIABLE) or DEFAULT_WRITE_BEHIND)
+
+
+def put(items, item, stop):
+    """
+    Put the item into the bounded queue, unless the consumer stopped.
+    Return: False if the consumer stopped, True otherwise
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_ahead(iterator, depth=None):
+    """
+    Run the iterator in a background thread, at most depth items ahead of the consumer.
+    Exceptions of the iterator are raised in the consumer. If the consumer stops early,
+    the iterator is closed in the background thread.
+    Return: generator of the items of the iterator
+    """
+    depth = get_read_ahead() if depth is None else depth
+    if depth <= 0:
+        yield from iterator
+        return
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(items, (item, None), stop):
+                    break
+            else:
+                put(items, (END, None), stop)
+        except BaseException as error:
+            put(items, (END, error), stop)
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def advise(fd, start, end, advice_name):
+    # read-ahead hints are not available on all platforms (e.g. macOS)
+    advice = getattr(os, advice_name, None)
+    if advice is not None and hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, start, end - start, advice)
+        except OSError:
+            pass
+
+
+def read_file_blocks(fp, start, end, buffers):
+    """
+    Read the byte range [start, end) of the (unbuffered) file into the buffers, in turn.
+    After the first block, all reads start at multiples of the alignment, and the OS is asked
+    to read the next block ahead.
+    Return: generator of (buffer, length)
+    """
+    fd = fp.fileno()
+    advise(fd, start, end, "POSIX_FADV_SEQUENTIAL")
+    block_size = len(buffers[0])
+    position = start
+    fp.seek(position)
+    turn = 0
+    while position < end:
+        buffer = buffers[turn % len(buffers)]
+        turn += 1
+        # the first block ends at the alignment
+        length = min(block_size - position % ALIGNMENT, end - position)
+        advise(fd, position + length, min(end, position + length + block_size), "POSIX_FADV_WILLNEED")
+        length = fp.readinto(memoryview(buffer)[:length])
+        if not length:
+            break
+        position += length
+        yield buffer, length
+
+
+def iter_file_blocks(fp, start, end, block_size, read_ahead=None):
+    """
+    Iterate over the blocks of the byte range [start, end) of the (unbuffered) file, read ahead
+    by a background thread (see 'iter_ahead') into a ring of buffers. The buffer of a block is reused
+    once the consumer requested the following blocks, so its data needs to be copied before.
+    Return: generator of (bytearray, length)
+    """
+    read_ahead = get_read_ahead() if read_ahead is None else read_ahead
+    # the reader fills a buffer while the queue is full, and the consumer holds a buffer
+    buffers = [bytearray(block_size) for _ in range(read_ahead + 2 if read_ahead > 0 else 1)]
+    yield from iter_ahead(read_file_blocks(fp, start, end, buffers), read_ahead)
+
+
+class WriteBehind:
+    """
+    Write to the file object in a background thread: writes are queued (at most depth batches),
+    and the data needs to be immutable (bytes). Errors of the writer are raised by the next write, or by close.
+    """
+
+    def __init__(self, fp, depth=None):
+        self.fp = fp
+        self.depth = get_write_behind() if depth is None else depth
+        self.position = fp.tell() if fp.seekable() else 0
+        self.error = None
+        self.thread = None
+        if self.depth > 0:
+            self.batches = queue.Queue(self.depth)
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
+
+    def drain(self):
+        while True:
+            data = self.batches.get()
+            if data is END:
+                return
+            if self.error is None:
+                try:
+                    self.fp.write(data)
+                except BaseException as error:
+                    self.error = error
+
+    def write(self, data):
+        """
+        Queue the data (bytes), or write it directly without writer thread.
+        Return: int (number of bytes)
+        """
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.fp.write(data)
+        else:
+            self.batches.put(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        """
+        Wait until all queued data is written, and close the file.
+        Return: None
+        """
+        if self.thread is not None:
+            self.batches.put(END)
+            self.thread.join()
+            self.thread = None
+        self.fp.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
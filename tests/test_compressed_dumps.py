@@ -0,0 +1,136 @@
+"""
+Filter a synthetic dump (see 'generate_dump') stored plain, bzip2 (single- and multi-stream) and
+gzip (single- and multi-member) compressed, chunk by chunk (see 'filter_wikidata.get_chunks'),
+and check that the shards and the final CSV do not depend on the compression.
+"""
+
+import bz2
+import gzip
+import os
+
+import pytest
+
+from dump_io import get_dump_size, get_shard_paths, iter_line_batches, supports_random_access, write_manifest
+from extract_special_predicates import (
+    extract_predicate_types,
+    get_catalog_path,
+    load_special_predicates,
+    store_predicate_catalog,
+)
+from filter_wikidata import (
+    PATH_TO_OUTPUT_DIR,
+    PATH_TO_RUNS_DIR,
+    get_chunks,
+    init_worker,
+    load_filter_config,
+    prune_triples,
+)
+from generate_dump import generate_dump
+from resolve_qualifiers import PATH_TO_OUTPUT_FILE, create_unique_predicates, prune_duplicate_lines, resolve_qualifiers
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+ENTITIES = 300
+WORKERS = 4
+# streams (members) of the multi-stream (multi-member) dumps, which are cut within lines
+STREAMS = 5
+DIRECTORIES = ["dicts", PATH_TO_RUNS_DIR, PATH_TO_OUTPUT_DIR, "tmp_dumps"]
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def compress_streams(data, compress, streams):
+    """
+    Compress the data as the given number of concatenated streams (gzip members).
+    Return: bytes
+    """
+    cuts = [len(data) * i // streams for i in range(streams + 1)]
+    return b"".join(compress(data[start:end]) for start, end in zip(cuts, cuts[1:]))
+
+
+def write_dump(directory, name, data):
+    """
+    Write the (plain) dump data in the format of the given name.
+    Return: str (path of the dump)
+    """
+    # small bzip2 blocks (100k), such that the dump consists of many blocks
+    compressors = {
+        "plain": (".nt", lambda data: data, 1),
+        "bz2": (".nt.bz2", lambda data: bz2.compress(data, 1), 1),
+        "bz2_multistream": (".nt.bz2", lambda data: bz2.compress(data, 1), STREAMS),
+        "gz": (".nt.gz", gzip.compress, 1),
+        "gz_multimember": (".nt.gz", gzip.compress, STREAMS),
+    }
+    extension, compress, streams = compressors[name]
+    path = os.path.join(directory, "dump" + extension)
+    with open(path, "wb") as fp:
+        fp.write(compress_streams(data, compress, streams))
+    return path
+
+
+def read_lines(paths):
+    return [line for path in paths for batch in iter_line_batches(path) for line in batch]
+
+
+def build(dump_path):
+    """
+    Filter the dump (in the current directory) chunk by chunk, and resolve the qualifiers of the shards.
+    Return: (chunks, lines of the shards, final CSV)
+    """
+    for directory in DIRECTORIES:
+        os.makedirs(directory, exist_ok=True)
+    size = get_dump_size(dump_path)
+    store_predicate_catalog(extract_predicate_types(dump_path, 0, size), get_catalog_path(dump_path))
+    ext_id_predicates, geo_predicates = load_special_predicates(dump_path)
+    init_worker({p.encode("utf-8") for p in ext_id_predicates}, {p.encode("utf-8") for p in geo_predicates})
+    filter_config = load_filter_config()
+    chunks = get_chunks(dump_path, WORKERS, max(1, size // (2 * WORKERS)))
+    shards = [
+        prune_triples(dump_path, start, end, chunk_id, filter_config)["shard"]
+        for chunk_id, (start, end) in enumerate(chunks)
+    ]
+    write_manifest(PATH_TO_OUTPUT_DIR, shards)
+    create_unique_predicates()
+    resolve_qualifiers()
+    prune_duplicate_lines()
+    with open(PATH_TO_OUTPUT_FILE, "rb") as fp:
+        return chunks, read_lines(get_shard_paths(PATH_TO_OUTPUT_DIR)), fp.read()
+
+
+@pytest.fixture(scope="module")
+def dump_data(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("dump") / "dump.nt")
+    generate_dump(path, ENTITIES, seed=1)
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+@pytest.fixture(scope="module")
+def reference(dump_data, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("reference")
+    working_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        return build(write_dump(str(directory), "plain", dump_data))
+    finally:
+        os.chdir(working_directory)
+
+
+#####################################################
+# TESTS                                             #
+#####################################################
+@pytest.mark.parametrize("name", ["plain", "bz2", "bz2_multistream", "gz", "gz_multimember"])
+def test_compressed_dump(name, dump_data, reference, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dump_path = write_dump(str(tmp_path), name, dump_data)
+    chunks, lines, csv = build(dump_path)
+    # a single gzip member can only be decompressed from its beginning
+    if supports_random_access(dump_path):
+        assert len(chunks) > 1
+    else:
+        assert len(chunks) == 1
+    assert lines == reference[1]
+    assert csv == reference[2]
+    assert len(lines) > ENTITIES
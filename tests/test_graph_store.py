@@ -0,0 +1,99 @@
+"""
+Build the graph store (see 'graph_store.build_graph_store') from a small output of resolve_qualifiers.py,
+and look up facts, instances of classes and qualifiers.
+"""
+
+import os
+import random
+
+import pytest
+
+import graph_store
+from graph_store import GraphStore, build_graph_store
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+ROWS = [
+    "Q1,P31-0,Q5-0",
+    "Q1,P39-0,Q30",
+    "P39-0,P580-0,\"1999\"",
+    "P39-0,P31-2,Q7-0",
+    "Q2,P31-1,Q5-1",
+    "Q2,P31-3,Q6-0",
+    "Q2,P40-0,Q1",
+    "Q5,P279-0,Q6",
+]
+# edges of the random graph, and a memory budget (in bytes) that forces many buckets per CSR
+RANDOM_EDGES = 5000
+SMALL_MEMORY_BUDGET = 1000
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def write_rows(path, rows):
+    with open(path, "w") as fp:
+        fp.write("\n".join(rows) + "\n")
+
+
+def read_store(directory):
+    store = dict()
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as fp:
+            store[name] = fp.read()
+    return store
+
+
+#####################################################
+# TESTS                                             #
+#####################################################
+@pytest.fixture
+def graph(tmp_path):
+    input_path = str(tmp_path / "output.csv")
+    write_rows(input_path, ROWS)
+    build_graph_store(input_path, str(tmp_path / "graph"))
+    graph = GraphStore(str(tmp_path / "graph"), labels_path=None, wikipedia_path=None)
+    yield graph
+    graph.close()
+
+
+def test_instances_of_classes(graph):
+    assert graph.incoming("Q5") == [("P31-0", "Q1"), ("P31-1", "Q2")]
+    assert graph.incoming("Q6") == [("P31-3", "Q2"), ("P279-0", "Q5")]
+    assert graph.neighbors("Q2") == [("P31-1", "Q5"), ("P31-3", "Q6"), ("P40-0", "Q1")]
+    # type nodes are stored as their class
+    assert graph.get_id("Q5-0") is None
+
+
+def test_facts(graph):
+    assert graph.facts("Q1") == [
+        ("P31-0", "Q5", []),
+        ("P39-0", "Q30", [("P580-0", '"1999"'), ("P31-2", "Q7")]),
+    ]
+    assert graph.incoming("Q1") == [("P40-0", "Q2")]
+    assert graph.number_of_edges == len(ROWS)
+
+
+def test_small_memory_budget(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    rows = list()
+    for i in range(RANDOM_EDGES):
+        p = "P" + str(rng.randrange(50)) + "-" + str(i)
+        rows.append(",".join(["Q" + str(rng.randrange(2000)), p, "Q" + str(rng.randrange(2000))]))
+    input_path = str(tmp_path / "output.csv")
+    write_rows(input_path, rows)
+    build_graph_store(input_path, str(tmp_path / "default"))
+    # small blocks of keys, such that the edges are sorted in many buckets
+    monkeypatch.setattr(graph_store, "KEY_BLOCK_BITS", 4)
+    key_ranges = list()
+    write_csr = graph_store.write_csr
+
+    def record_key_ranges(directory, name, key_index, typecode, ranges):
+        key_ranges.append(ranges)
+        write_csr(directory, name, key_index, typecode, ranges)
+
+    monkeypatch.setattr(graph_store, "write_csr", record_key_ranges)
+    build_graph_store(input_path, str(tmp_path / "small"), SMALL_MEMORY_BUDGET)
+    assert all(len(ranges) > 100 for ranges in key_ranges)
+    assert read_store(str(tmp_path / "small")) == read_store(str(tmp_path / "default"))
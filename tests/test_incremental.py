@@ -0,0 +1,196 @@
+"""
+Update a build (see 'incremental.update_build') from a newer synthetic dump (see 'generate_dump'),
+in which a direct claim and a qualifier changed, an entity was deleted and one was added,
+and check the patched output and dicts against a full rebuild.
+"""
+
+import re
+
+import pytest
+
+from dump_io import get_dump_size
+from extract_special_predicates import EXT_ID_TYPES, GEO_TYPES, extract_predicate_types
+from filter_wikidata import get_dict_names, get_dict_path, init_worker, load_filter_config
+from generate_dump import generate_dump
+from incremental import (
+    TYPE_PREDICATE,
+    get_base,
+    get_fact_set,
+    get_signature,
+    group_facts,
+    iter_entity_blocks,
+    update_build,
+)
+from resolve_qualifiers import PATH_TO_OUTPUT_FILE
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+ENTITIES = 100
+ENTITY_PREFIX = b"<http://www.wikidata.org/entity/"
+DIRECT_PREFIX = b"<http://www.wikidata.org/prop/direct/"
+STATEMENT_PREFIX = b"<http://www.wikidata.org/prop/statement/"
+QUALIFIER_PREFIX = b"<http://www.wikidata.org/prop/qualifier/"
+
+
+#####################################################
+# FUNCTIONS                                         #
+#####################################################
+def write_dump(path, blocks):
+    with open(path, "wb") as fp:
+        for _, lines in blocks:
+            fp.write(b"\n".join(lines) + b"\n")
+
+
+def find_facts(rows):
+    """
+    Find a fact with a wikidata item as object (other than P31), and a qualifier with a wikidata item as object,
+    of different entities in the output.
+    Return: ((entity, predicate, object), (entity, qualifier predicate, object))
+    """
+    entities = {p: s for s, p, _ in (row.split(b",", 2) for row in rows) if not b"-" in s}
+    fact = qualifier = None
+    for row in rows:
+        s, p, o = row.split(b",", 2)
+        if not o.startswith(b"Q") or b"-" in o:
+            continue
+        if b"-" in s and qualifier is None and s in entities:
+            qualifier = (entities[s], get_base(p), o)
+        elif not b"-" in s and fact is None and get_base(p) != TYPE_PREDICATE:
+            fact = (s, get_base(p), o)
+    assert fact and qualifier and fact[0] != qualifier[0]
+    return fact, qualifier
+
+
+def replace_object(line, kg_object):
+    s, p, _ = line.split(b" ", 2)
+    return b" ".join([s, p, ENTITY_PREFIX + kg_object + b"> ."])
+
+
+def rename_entity(lines, entity, new_entity):
+    """
+    Rename the entity in its lines (including its statement nodes and sitelinks).
+    Return: list of lines
+    """
+    pattern = re.compile(b"(?<![0-9A-Za-z])" + re.escape(entity) + b"(?![0-9])")
+    return [pattern.sub(new_entity, line) for line in lines]
+
+
+def replace_objects(lines, predicates, kg_object, new_object):
+    """
+    Replace the object of the lines with one of the predicates (e.g. 'P6'), and the given object.
+    Return: list of lines
+    """
+    predicates = {prefix + p + b">" for prefix, p in predicates}
+    replaced = list()
+    for line in lines:
+        _, p, o = line.split(b" ", 2)
+        if p in predicates and o == ENTITY_PREFIX + kg_object + b"> .":
+            line = replace_object(line, new_object)
+        replaced.append(line)
+    assert replaced != lines
+    return replaced
+
+
+def modify_dump(blocks, rows):
+    """
+    Change the object of a direct claim (and of its statement) of one entity, and the object of a qualifier
+    of another (both found in the output rows of the dump), delete a third entity,
+    and add a copy of a fourth under a new id.
+    Return: (list of blocks, changed entities, deleted entity)
+    """
+    blocks = dict(blocks)
+    fact, qualifier = find_facts(rows)
+    for (entity, p, o), prefixes in [(fact, [DIRECT_PREFIX, STATEMENT_PREFIX]), (qualifier, [QUALIFIER_PREFIX])]:
+        new_object = b"Q1" if o != b"Q1" else b"Q2"
+        blocks[entity] = replace_objects(blocks[entity], [(prefix, p) for prefix in prefixes], o, new_object)
+    changed = [fact[0], qualifier[0]]
+    # entities with facts in the output
+    entities = {row.split(b",", 1)[0] for row in rows}
+    items = [entity for entity in blocks if entity.startswith(b"Q") and entity in entities and not entity in changed]
+    deleted = items[-1]
+    del blocks[deleted]
+    new_entity = b"Q" + str(ENTITIES + 1).encode()
+    blocks[new_entity] = rename_entity(blocks[items[0]], items[0], new_entity)
+    return list(blocks.items()), changed, deleted
+
+
+def build(dump_path, full=False):
+    """
+    Build (or with a state, update) the output and the dicts in the current directory from the dump.
+    Return: collections.Counter (see 'update_build')
+    """
+    predicate_types = extract_predicate_types(dump_path, 0, get_dump_size(dump_path))
+    ext_id_predicates = {p.encode("utf-8") for p, t in predicate_types.items() if t in EXT_ID_TYPES}
+    geo_predicates = {p.encode("utf-8") for p, t in predicate_types.items() if t in GEO_TYPES}
+    init_worker(ext_id_predicates, geo_predicates)
+    return update_build(dump_path, load_filter_config(), predicate_types, full)
+
+
+def read_dicts():
+    dicts = dict()
+    for dict_name in get_dict_names(load_filter_config()["languages"]):
+        with open(get_dict_path(dict_name) + ".tsv", "rb") as fp:
+            dicts[dict_name] = fp.read()
+    return dicts
+
+
+def get_fact_ids(path):
+    """
+    Get the fact-specific predicates of the facts in the output, by entity and signature (see 'get_signature').
+    Facts with the same signature as another fact of their entity are left out.
+    Return: dict ((entity,) + signature -> fact-specific predicate)
+    """
+    with open(path, "rb") as fp:
+        rows = fp.read().splitlines()
+    entities = {p: s for s, p, _ in (row.split(b",", 2) for row in rows) if not b"-" in s}
+    fact_ids = dict()
+    ambiguous = set()
+    for fact_id, (objects, qualifiers) in group_facts(rows).items():
+        key = (entities.get(fact_id),) + get_signature(fact_id, objects, qualifiers)
+        if key in fact_ids:
+            ambiguous.add(key)
+        fact_ids[key] = fact_id
+    return {key: fact_id for key, fact_id in fact_ids.items() if not key in ambiguous}
+
+
+@pytest.fixture(scope="module")
+def old_dump(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("dumps") / "old.nt")
+    generate_dump(path, ENTITIES, seed=2)
+    return path
+
+
+#####################################################
+# TESTS                                             #
+#####################################################
+def test_update_matches_full_build(old_dump, tmp_path, monkeypatch):
+    (tmp_path / "update").mkdir()
+    (tmp_path / "full").mkdir()
+    monkeypatch.chdir(tmp_path / "update")
+    build(old_dump)
+    with open(PATH_TO_OUTPUT_FILE, "rb") as fp:
+        blocks, changed, deleted = modify_dump(iter_entity_blocks(old_dump), fp.read().splitlines())
+    new_dump = str(tmp_path / "new.nt")
+    write_dump(new_dump, blocks)
+    old_fact_ids = get_fact_ids(PATH_TO_OUTPUT_FILE)
+    statistics = build(new_dump)
+    assert statistics["changed"] == 2
+    assert statistics["added"] == 1
+    assert statistics["deleted"] == 1
+    fact_set = get_fact_set(PATH_TO_OUTPUT_FILE)
+    fact_ids = get_fact_ids(PATH_TO_OUTPUT_FILE)
+    dicts = read_dicts()
+    monkeypatch.chdir(tmp_path / "full")
+    build(new_dump, full=True)
+    assert fact_set == get_fact_set(PATH_TO_OUTPUT_FILE)
+    assert dicts == read_dicts()
+    # the changed facts and the facts of the deleted entity are gone
+    for entity in changed + [deleted]:
+        assert any(key[0] == entity and not key in fact_ids for key in old_fact_ids)
+    assert not any(key[0] == deleted for key in fact_ids)
+    assert any(key[0] == b"Q" + str(ENTITIES + 1).encode() for key in fact_ids)
+    # facts in both dumps keep their fact-specific predicates, also in changed entities
+    kept = [key for key in old_fact_ids if key in fact_ids]
+    assert any(key[0] in changed for key in kept)
+    assert all(old_fact_ids[key] == fact_ids[key] for key in kept)
@@ -0,0 +1,47 @@
+"""
+Build the label index (see 'label_index.build_label_index') over a graph store (see 'graph_store.build_graph_store')
+of a small output of resolve_qualifiers.py, and check the ranking of the entities by their degree.
+"""
+
+import pytest
+
+from graph_store import build_graph_store
+from label_index import LabelIndex, build_label_index
+from sorted_dicts import write_run
+
+#####################################################
+# CONSTANTS                                         #
+#####################################################
+# three instances of the class Q5, and an entity with the same label and two facts
+ROWS = [
+    "Q1,P31-0,Q5-0",
+    "Q2,P31-1,Q5-1",
+    "Q3,P31-2,Q5-2",
+    "Q9,P40-0,Q30",
+    "Q9,P40-1,Q31",
+]
+LABELS = {"Q5": {"human"}, "Q9": {"Human"}, "Q1": {"Douglas Adams"}}
+
+
+#####################################################
+# TESTS                                             #
+#####################################################
+@pytest.fixture
+def index(tmp_path):
+    input_path = str(tmp_path / "output.csv")
+    with open(input_path, "w") as fp:
+        fp.write("\n".join(ROWS) + "\n")
+    labels_path = str(tmp_path / "labels_dict.tsv")
+    write_run(labels_path, LABELS)
+    build_graph_store(input_path, str(tmp_path / "graph"))
+    build_label_index([labels_path], str(tmp_path / "graph"), str(tmp_path / "index"))
+    index = LabelIndex(str(tmp_path / "index"))
+    yield index
+    index.close()
+
+
+def test_class_degree_counts_instances(index):
+    # the instances of a class are incoming edges of the class (not of its type nodes)
+    degrees = {index.get_entity(entity_id): index.degrees[entity_id] for entity_id in range(len(index.degrees))}
+    assert degrees == {"Q1": 1, "Q5": 3, "Q9": 2}
+    assert index.exact("human") == ["Q5", "Q9"]